@@ -1,173 +1,930 @@
 """
 Sistema de Cache Avançado para Performance
-Implementa cache em memória com TTL, invalidação inteligente e estatísticas
+Implementa cache com TTL, invalidação inteligente e estatísticas
+
+Backends de armazenamento (CACHE_BACKEND):
+- memory (padrão): dicionário no próprio processo
+- sqlite: arquivo compartilhado por todos os workers (CACHE_DB_PATH);
+  invalidações valem para todos e as estatísticas são somadas
 """
 
+import os
 import time
-from typing import Any, Optional, Callable
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Optional, Callable, Dict, Iterable, List
 from functools import wraps
 import hashlib
 import json
 
 
+# =============================
+# BACKENDS
+# =============================
+class CacheBackend:
+    """
+    Interface dos backends de armazenamento
+
+    Uma entrada é um dict com 'value', 'size' (bytes), 'stale_at',
+    'expires_at', 'created_at' e 'tags' (dependências: 'leads', 'lead:42',
+    'vendedor:7'...). Depois de stale_at o valor ainda pode ser servido
+    enquanto é recalculado; depois de expires_at, não.
+    """
+    name = "base"
+    shared = False  # True = visível para todos os workers
+
+    def get(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def set(self, key: str, entry: dict, max_size: int, max_bytes: int) -> int:
+        """Grava a entrada e remove as menos usadas acima dos limites; retorna quantas removeu"""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        """Remove as entradas marcadas com qualquer uma das tags"""
+        raise NotImplementedError
+
+    def clear(self) -> int:
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+    def memory_usage(self) -> Dict[str, dict]:
+        """Entradas e bytes por prefixo de chave ('leads', 'tags'...)"""
+        raise NotImplementedError
+
+    def publish_stats(self, worker_id: str, stats: dict):
+        """Publica as estatísticas do worker (só backends compartilhados)"""
+
+    def collect_stats(self) -> List[dict]:
+        """Estatísticas publicadas por todos os workers"""
+        return []
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Cache em memória do processo
+
+    OrderedDict na ordem de uso (o mais antigo primeiro): get, set e
+    remoção do LRU são O(1). O índice tag → chaves torna a invalidação
+    proporcional só ao número de entradas afetadas. Os bytes de cada
+    entrada são somados no total e por prefixo.
+    """
+    name = "memory"
+
+    def __init__(self):
+        self.cache = OrderedDict()
+        self.tag_index = {}
+        self.total_bytes = 0
+        self.prefix_usage: Dict[str, List[int]] = {}  # prefixo → [entradas, bytes]
+        # RLock: o SocketIO em modo threading atende requisições em paralelo
+        self._lock = threading.RLock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+            return entry
+
+    def _remove(self, key: str):
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            return
+        size = entry.get('size', 0)
+        self.total_bytes -= size
+        prefix = key.split(':', 1)[0]
+        usage = self.prefix_usage[prefix]
+        usage[0] -= 1
+        usage[1] -= size
+        if usage[0] == 0:
+            del self.prefix_usage[prefix]
+        for tag in entry.get('tags', ()):
+            keys = self.tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
+
+    def set(self, key: str, entry: dict, max_size: int, max_bytes: int) -> int:
+        size = entry.get('size', 0)
+        evicted = 0
+        with self._lock:
+            self._remove(key)
+            # Se cache cheio (em entradas ou em bytes), remove LRU
+            while self.cache and (len(self.cache) >= max_size or self.total_bytes + size > max_bytes):
+                self._remove(next(iter(self.cache)))
+                evicted += 1
+            self.cache[key] = entry
+            self.total_bytes += size
+            usage = self.prefix_usage.setdefault(key.split(':', 1)[0], [0, 0])
+            usage[0] += 1
+            usage[1] += size
+            for tag in entry.get('tags', ()):
+                self.tag_index.setdefault(tag, set()).add(key)
+        return evicted
+
+    def delete(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys |= self.tag_index.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self.cache)
+            self.cache.clear()
+            self.tag_index.clear()
+            self.prefix_usage.clear()
+            self.total_bytes = 0
+            return count
+
+    def size(self) -> int:
+        return len(self.cache)
+
+    def memory_usage(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                prefix: {'entries': entries, 'bytes': size}
+                for prefix, (entries, size) in sorted(self.prefix_usage.items())
+            }
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Cache compartilhado entre workers num arquivo SQLite (WAL)
+
+    Todos os processos leem e escrevem o mesmo arquivo, então um
+    invalidate() feito por qualquer worker vale para todos. Os valores são
+    serializados com pickle.
+    """
+    name = "sqlite"
+    shared = True
+    ACCESS_RESOLUTION = 10
+    # Limites conferidos a cada EVICTION_INTERVAL escritas deste processo;
+    # acima deles, remove os menos usados até EVICTION_TARGET do limite
+    EVICTION_INTERVAL = 32
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, path: str):
+        from connection_pool import get_pool
+
+        self.path = path
+        self.pool = get_pool(path)
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+        conn = self.pool.acquire()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    stale_at REAL,
+                    expires_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(cache_entries)")}
+            if 'stale_at' not in columns:
+                # Arquivo criado antes do TTL suave
+                conn.execute("ALTER TABLE cache_entries ADD COLUMN stale_at REAL")
+            if 'size' not in columns:
+                # Arquivo criado antes do limite em bytes
+                conn.execute("ALTER TABLE cache_entries ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                conn.execute("UPDATE cache_entries SET size = length(value)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries(accessed_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_tags (
+                    tag TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (tag, key)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_tags_key ON cache_tags(key)")
+            # Entrada removida (invalidação, LRU, expiração) leva junto suas tags
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_entries_ad AFTER DELETE ON cache_entries BEGIN
+                    DELETE FROM cache_tags WHERE key = old.key;
+                END
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_worker_stats (
+                    worker_id TEXT PRIMARY KEY,
+                    stats TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[dict]:
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute(
+                "SELECT value, stale_at, expires_at, created_at, accessed_at FROM cache_entries WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            # accessed_at só serve para o LRU: atualizado no máximo a cada ACCESS_RESOLUTION
+            # segundos, para que leituras não virem escritas
+            now = time.time()
+            if now - row['accessed_at'] > self.ACCESS_RESOLUTION:
+                conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (now, key))
+                conn.commit()
+            return {
+                'value': pickle.loads(row['value']),
+                'stale_at': row['stale_at'] if row['stale_at'] is not None else row['expires_at'],
+                'expires_at': row['expires_at'],
+                'created_at': row['created_at']
+            }
+        except (pickle.PickleError, EOFError, AttributeError, ImportError):
+            # Entrada gravada por outra versão do código
+            self.delete(key)
+            return None
+        finally:
+            conn.close()
+
+    def set(self, key: str, entry: dict, max_size: int, max_bytes: int) -> int:
+        blob = pickle.dumps(entry['value'], protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        conn = self.pool.acquire()
+        try:
+            conn.execute("""
+                INSERT INTO cache_entries (key, value, size, stale_at, expires_at, created_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = excluded.value,
+                    size = excluded.size,
+                    stale_at = excluded.stale_at,
+                    expires_at = excluded.expires_at,
+                    created_at = excluded.created_at,
+                    accessed_at = excluded.accessed_at
+            """, (key, blob, len(blob), entry['stale_at'], entry['expires_at'], entry['created_at'], now))
+            conn.execute("DELETE FROM cache_tags WHERE key = ?", (key,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                [(tag, key) for tag in entry.get('tags', ())]
+            )
+
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.EVICTION_INTERVAL == 0
+        return self._evict(max_size, max_bytes) if due else 0
+
+    def _evict(self, max_size: int, max_bytes: int) -> int:
+        """Acima do limite (em entradas ou em bytes): remove os menos usados recentemente"""
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+            if row[0] <= max_size and row[1] <= max_bytes:
+                return 0
+
+            excess_entries = row[0] - int(max_size * self.EVICTION_TARGET)
+            excess_bytes = row[1] - int(max_bytes * self.EVICTION_TARGET)
+            victims = []
+            # Do mais antigo para o mais novo pelo idx_cache_entries_accessed: só
+            # percorre as entradas que vão sair
+            oldest = conn.execute("SELECT key, size FROM cache_entries ORDER BY accessed_at")
+            for key, size in oldest:
+                if excess_entries <= 0 and excess_bytes <= 0:
+                    break
+                victims.append(key)
+                excess_entries -= 1
+                excess_bytes -= size
+            oldest.close()
+
+            cursor = conn.execute(
+                "DELETE FROM cache_entries WHERE key IN (SELECT value FROM json_each(?))",
+                (json.dumps(victims),)
+            )
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def delete(self, key: str):
+        conn = self.pool.acquire()
+        try:
+            conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        conn = self.pool.acquire()
+        try:
+            cursor = conn.execute("""
+                DELETE FROM cache_entries WHERE key IN (
+                    SELECT key FROM cache_tags WHERE tag IN (SELECT value FROM json_each(?))
+                )
+            """, (json.dumps(list(tags)),))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def clear(self) -> int:
+        conn = self.pool.acquire()
+        try:
+            cursor = conn.execute("DELETE FROM cache_entries")
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def size(self) -> int:
+        conn = self.pool.acquire()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        finally:
+            conn.close()
+
+    def memory_usage(self) -> Dict[str, dict]:
+        conn = self.pool.acquire()
+        try:
+            rows = conn.execute("""
+                SELECT
+                    CASE WHEN instr(key, ':') > 0 THEN substr(key, 1, instr(key, ':') - 1) ELSE key END AS prefix,
+                    COUNT(*) AS entries,
+                    SUM(size) AS bytes
+                FROM cache_entries
+                GROUP BY prefix
+                ORDER BY prefix
+            """).fetchall()
+            return {row['prefix']: {'entries': row['entries'], 'bytes': row['bytes']} for row in rows}
+        finally:
+            conn.close()
+
+    def publish_stats(self, worker_id: str, stats: dict):
+        conn = self.pool.acquire()
+        try:
+            conn.execute("""
+                INSERT INTO cache_worker_stats (worker_id, stats, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(worker_id) DO UPDATE SET stats = excluded.stats, updated_at = excluded.updated_at
+            """, (worker_id, json.dumps(stats), time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def collect_stats(self, max_age: int = 3600) -> List[dict]:
+        conn = self.pool.acquire()
+        try:
+            # Workers que não publicam há mais de max_age já morreram
+            conn.execute("DELETE FROM cache_worker_stats WHERE updated_at < ?", (time.time() - max_age,))
+            conn.commit()
+            rows = conn.execute("SELECT worker_id, stats FROM cache_worker_stats ORDER BY worker_id").fetchall()
+            return [dict(json.loads(row['stats']), worker_id=row['worker_id']) for row in rows]
+        finally:
+            conn.close()
+
+
+def create_backend(name: Optional[str] = None) -> CacheBackend:
+    """Cria o backend configurado em CACHE_BACKEND (memory | sqlite)"""
+    name = (name or os.getenv("CACHE_BACKEND", "memory")).lower()
+    if name == "sqlite":
+        try:
+            return SQLiteCacheBackend(os.getenv("CACHE_DB_PATH", "../cache.db"))
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache SQLite indisponível ({e}), usando memória")
+    return MemoryCacheBackend()
+
+
+class PackedValue:
+    """Valor grande guardado serializado e comprimido (zlib)"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def unpack(self) -> Any:
+        return pickle.loads(zlib.decompress(self.data))
+
+
+class SingleFlight:
+    """
+    Uma única recomputação em andamento por chave (no processo)
+
+    Quem chama begin() primeiro vira o responsável e recebe None; os
+    demais recebem o Event que será disparado no end() do responsável.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, threading.Event] = {}
+
+    def begin(self, key: str) -> Optional[threading.Event]:
+        with self._lock:
+            event = self._flights.get(key)
+            if event is not None:
+                return event
+            self._flights[key] = threading.Event()
+            return None
+
+    def end(self, key: str):
+        with self._lock:
+            event = self._flights.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+
 class AdvancedCache:
     """
     Sistema de cache avançado com:
-    - TTL (Time To Live)
-    - Invalidação por padrão
-    - Estatísticas de hit/miss
-    - LRU (Least Recently Used)
+    - TTL suave (stale_at) e rígido (expires_at): entre os dois o valor
+      antigo é servido enquanto uma única atualização roda em segundo plano
+    - Recomputação única por chave (single-flight): numa expiração, só uma
+      requisição recalcula e as demais esperam o resultado
+    - Invalidação por tags de dependência ('leads', 'lead:42', 'vendedor:7')
+    - Estatísticas de hit/miss (somadas entre workers no backend compartilhado)
+    - LRU (Least Recently Used) limitado em entradas e em bytes: o tamanho
+      de cada valor é medido na gravação e valores grandes podem ser
+      guardados comprimidos
+
+    Toda entrada recebe automaticamente como tag o prefixo da chave (o que
+    vem antes do primeiro ':'), então invalidate("leads") remove exatamente
+    as entradas "leads:...".
     """
-    
-    def __init__(self, max_size: int = 1000, default_ttl: int = 300):
+
+    # Intervalo mínimo entre publicações de estatísticas no backend compartilhado
+    STATS_PUBLISH_INTERVAL = 5
+    # Tempo máximo que uma requisição espera a recomputação de outra
+    FLIGHT_WAIT_TIMEOUT = float(os.getenv("CACHE_FLIGHT_WAIT_TIMEOUT", "10"))
+    # Bytes contados por entrada além do valor (chave, dict da entrada, tags)
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_size: int = 1000, default_ttl: int = 300, backend: Optional[CacheBackend] = None,
+                 max_bytes: int = 64 * 1024 * 1024, compress_min_bytes: int = 0):
         """
         Args:
             max_size: Número máximo de itens no cache
             default_ttl: TTL padrão em segundos
+            backend: Armazenamento (padrão: MemoryCacheBackend)
+            max_bytes: Memória máxima ocupada pelos valores
+            compress_min_bytes: Valores a partir deste tamanho são guardados
+                serializados e comprimidos (0 desliga)
         """
-        self.cache = {}
-        self.access_times = {}
+        self.backend = backend or MemoryCacheBackend()
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.compress_min_bytes = compress_min_bytes
         self.default_ttl = default_ttl
-        
+        self._pid = os.getpid()
+        self._last_publish = 0.0
+        self._stats_lock = threading.Lock()
+        self.flights = SingleFlight()
+
         # Estatísticas
         self.hits = 0
+        self.stale = 0
         self.misses = 0
+        self.refreshes = 0
+        self.waits = 0
         self.invalidations = 0
-    
+        self.evictions = 0
+        self.compressed = 0
+        self.oversized = 0
+
     def _generate_key(self, *args, **kwargs) -> str:
         """Gera chave única baseada nos argumentos"""
         key_data = f"{args}:{sorted(kwargs.items())}"
         return hashlib.md5(key_data.encode()).hexdigest()
-    
-    def _is_expired(self, key: str) -> bool:
-        """Verifica se item expirou"""
-        if key not in self.cache:
-            return True
-        
-        item = self.cache[key]
-        if time.time() > item['expires_at']:
-            del self.cache[key]
-            del self.access_times[key]
-            return True
-        
-        return False
-    
-    def _evict_lru(self):
-        """Remove item menos recentemente usado"""
-        if not self.access_times:
+
+    @property
+    def worker_id(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            # Processo filho (fork do gunicorn): estatísticas próprias a partir de zero
+            # e nenhuma recomputação herdada (as threads do pai não existem aqui)
+            self._pid = os.getpid()
+            self.hits = self.stale = self.misses = self.refreshes = self.waits = self.invalidations = 0
+            self.evictions = self.compressed = self.oversized = 0
+            self.flights = SingleFlight()
+
+    def _maybe_publish_stats(self):
+        if not self.backend.shared:
+            return
+        now = time.time()
+        if now - self._last_publish < self.STATS_PUBLISH_INTERVAL:
             return
-        
-        lru_key = min(self.access_times, key=self.access_times.get)
-        del self.cache[lru_key]
-        del self.access_times[lru_key]
-    
+        self._last_publish = now
+        try:
+            self.backend.publish_stats(self.worker_id, self._local_stats())
+        except sqlite3.Error as e:
+            print(f"⚠️ Erro ao publicar estatísticas do cache: {e}")
+
     def get(self, key: str) -> Optional[Any]:
-        """Busca valor no cache"""
-        if self._is_expired(key):
-            self.misses += 1
-            return None
-        
-        self.hits += 1
-        self.access_times[key] = time.time()
-        return self.cache[key]['value']
-    
-    def set(self, key: str, value: Any, ttl: Optional[int] = None):
-        """Armazena valor no cache"""
-        # Se cache cheio, remove LRU
-        if len(self.cache) >= self.max_size:
-            self._evict_lru()
-        
+        """Busca valor no cache (inclusive vencido pelo TTL suave)"""
+        return self.lookup(key)[0]
+
+    def lookup(self, key: str, record: bool = True):
+        """
+        Busca valor no cache
+
+        Returns:
+            (valor, vencido): valor None se ausente ou além do TTL rígido;
+            vencido=True se passou do TTL suave (deve ser atualizado)
+        """
+        self._check_fork()
+        entry = self.backend.get(key)
+        now = time.time()
+
+        if entry is None or now > entry['expires_at']:
+            if entry is not None:
+                self.backend.delete(key)
+            if record:
+                self._count('misses')
+                self._maybe_publish_stats()
+            return None, False
+
+        is_stale = now > entry.get('stale_at', entry['expires_at'])
+        if record:
+            self._count('stale' if is_stale else 'hits')
+            self._maybe_publish_stats()
+        value = entry['value']
+        if isinstance(value, PackedValue):
+            value = value.unpack()
+        return value, is_stale
+
+    def _count(self, field: str, amount: int = 1):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def _pack(self, value: Any):
+        """
+        Mede o valor e, se for grande, serializa e comprime
+
+        Returns:
+            (valor a guardar, tamanho em bytes)
+        """
+        serialized = None
+        if isinstance(value, dict) and value.get('__response__'):
+            size = len(value['body'])
+        elif isinstance(value, (bytes, str)):
+            size = len(value)
+        else:
+            try:
+                serialized = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                size = len(serialized)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # Não serializável: só o backend em memória consegue guardar
+                return value, sys.getsizeof(value) + self.ENTRY_OVERHEAD
+
+        if self.compress_min_bytes and size >= self.compress_min_bytes:
+            if serialized is None:
+                serialized = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            packed = PackedValue(zlib.compress(serialized, 1))
+            self._count('compressed')
+            return packed, len(packed.data) + self.ENTRY_OVERHEAD
+
+        return value, size + self.ENTRY_OVERHEAD
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None, tags: Optional[Iterable[str]] = None,
+            hard_ttl: Optional[int] = None):
+        """
+        Armazena valor no cache
+
+        Args:
+            ttl: TTL suave: depois dele o valor é atualizado
+            tags: Dependências da entrada (além do prefixo da chave)
+            hard_ttl: TTL rígido: até ele o valor antigo ainda pode ser
+                servido durante a atualização (padrão: igual ao ttl)
+        """
         ttl = ttl or self.default_ttl
-        self.cache[key] = {
-            'value': value,
-            'expires_at': time.time() + ttl,
-            'created_at': time.time()
-        }
-        self.access_times[key] = time.time()
-    
+        hard_ttl = max(hard_ttl or ttl, ttl)
+        stored, size = self._pack(value)
+        if size > self.max_bytes:
+            # Sozinho ocuparia o cache inteiro: não guarda
+            self._count('oversized')
+            return
+
+        now = time.time()
+        entry_tags = set(tags or ())
+        entry_tags.add(key.split(':', 1)[0])
+        evicted = self.backend.set(key, {
+            'value': stored,
+            'size': size,
+            'stale_at': now + ttl,
+            'expires_at': now + hard_ttl,
+            'created_at': now,
+            'tags': sorted(entry_tags)
+        }, self.max_size, self.max_bytes)
+        if evicted:
+            self._count('evictions', evicted)
+
     def invalidate(self, pattern: str = None):
-        """Invalida cache por padrão"""
+        """
+        Invalida cache por tag (em todos os workers, no backend compartilhado)
+
+        pattern é uma tag ou prefixo de chave ("leads"); None limpa tudo.
+        """
         if pattern is None:
-            # Limpa tudo
-            self.cache.clear()
-            self.access_times.clear()
-            self.invalidations += len(self.cache)
+            self._check_fork()
+            self._count('invalidations', self.backend.clear())
+            self._maybe_publish_stats()
         else:
-            # Limpa por padrão
-            keys_to_delete = [k for k in self.cache.keys() if pattern in k]
-            for key in keys_to_delete:
-                del self.cache[key]
-                del self.access_times[key]
-            self.invalidations += len(keys_to_delete)
-    
-    def get_stats(self) -> dict:
-        """Retorna estatísticas do cache"""
-        total_requests = self.hits + self.misses
-        hit_rate = (self.hits / total_requests * 100) if total_requests > 0 else 0
-        
+            self.invalidate_tags([pattern])
+
+    def invalidate_tags(self, tags: Iterable[str]):
+        """Remove as entradas que dependem de qualquer uma das tags"""
+        self._check_fork()
+        self._count('invalidations', self.backend.invalidate_tags(tags))
+        self._maybe_publish_stats()
+
+    def _local_stats(self) -> dict:
         return {
             'hits': self.hits,
+            'stale': self.stale,
             'misses': self.misses,
-            'hit_rate': f"{hit_rate:.2f}%",
+            'refreshes': self.refreshes,
+            'waits': self.waits,
             'invalidations': self.invalidations,
-            'size': len(self.cache),
-            'max_size': self.max_size
+            'evictions': self.evictions,
+            'compressed': self.compressed,
+            'oversized': self.oversized
         }
-    
+
+    def get_stats(self) -> dict:
+        """Retorna estatísticas do cache (somadas entre workers no backend compartilhado)"""
+        self._check_fork()
+        workers = []
+        totals = self._local_stats()
+
+        if self.backend.shared:
+            self._last_publish = 0.0
+            self._maybe_publish_stats()
+            workers = self.backend.collect_stats()
+            if workers:
+                totals = {
+                    field: sum(worker.get(field, 0) for worker in workers)
+                    for field in totals
+                }
+
+        memory = self.backend.memory_usage()
+        served = totals['hits'] + totals['stale']
+        total_requests = served + totals['misses']
+        hit_rate = (served / total_requests * 100) if total_requests > 0 else 0
+
+        stats = {
+            'hits': totals['hits'],
+            'stale': totals['stale'],
+            'misses': totals['misses'],
+            'hit_rate': f"{hit_rate:.2f}%",
+            'refreshes': totals['refreshes'],
+            'waits': totals['waits'],
+            'in_flight': len(self.flights),
+            'invalidations': totals['invalidations'],
+            'evictions': totals['evictions'],
+            'compressed': totals['compressed'],
+            'oversized': totals['oversized'],
+            'size': self.backend.size(),
+            'max_size': self.max_size,
+            'bytes': sum(usage['bytes'] for usage in memory.values()),
+            'max_bytes': self.max_bytes,
+            'memory': memory,
+            'backend': self.backend.name
+        }
+        if workers:
+            stats['workers'] = workers
+        return stats
+
     def clear(self):
         """Limpa todo o cache"""
         self.invalidate()
 
 
 # Instância global
-advanced_cache = AdvancedCache(max_size=1000, default_ttl=300)
+advanced_cache = AdvancedCache(
+    max_size=1000,
+    default_ttl=300,
+    backend=create_backend(),
+    max_bytes=int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    compress_min_bytes=int(os.getenv("CACHE_COMPRESS_MIN_BYTES", str(32 * 1024)))
+)
 
 
-def cached(ttl: int = 300, key_prefix: str = ""):
+# =============================
+# RESPOSTAS FLASK NO CACHE
+# =============================
+def _to_cacheable(result):
+    """
+    Converte o retorno da view em algo serializável
+
+    Respostas Flask viram (corpo, status, mimetype). Retorna None para
+    o que não deve ser cacheado (erros, tuplas com status).
+    """
+    try:
+        from flask import Response
+    except ImportError:
+        return result
+
+    if isinstance(result, tuple):
+        return None
+    if isinstance(result, Response):
+        if result.status_code != 200 or result.direct_passthrough:
+            return None
+        return {'__response__': True, 'body': result.get_data(), 'mimetype': result.mimetype}
+    return result
+
+
+def _from_cacheable(value):
+    if isinstance(value, dict) and value.get('__response__'):
+        from flask import Response
+        return Response(value['body'], status=200, mimetype=value['mimetype'])
+    return value
+
+
+# =============================
+# CHAVES POR USUÁRIO
+# =============================
+def principal_key(shared_roles: Optional[Dict[str, str]] = None, include_query: bool = True,
+                  version: Optional[Callable[[], str]] = None) -> Callable:
+    """
+    Key-builder que inclui quem faz a requisição na chave do cache
+
+    O resultado das rotas depende de session["role"]/session["user_id"];
+    sem isso na chave, um vendedor poderia receber a listagem cacheada
+    de um admin.
+
+    Args:
+        shared_roles: Perfis cujo resultado é idêntico entre usuários,
+            mapeados para o nome do grupo que compartilha a entrada
+            (ex.: {"admin": "todos", "gestor": "todos"}). Os demais
+            perfis ganham uma entrada por usuário.
+        include_query: Inclui a query string (parâmetros ordenados)
+        version: Função sem argumentos cujo resultado entra na chave (ex.:
+            versões de dados): escrita feita por qualquer caminho gera
+            chave nova, sem depender de invalidação
+
+    Usage:
+        @cached(ttl=30, key_prefix="leads",
+                key_builder=principal_key({"admin": "todos", "gestor": "todos"}))
+    """
+    shared_roles = shared_roles or {}
+
+    def build(*args, **kwargs) -> str:
+        from flask import has_request_context, request, session
+
+        if not has_request_context():
+            return advanced_cache._generate_key(*args, **kwargs)
+
+        role = session.get("role")
+        if role in shared_roles:
+            principal = f"grupo:{shared_roles[role]}"
+        elif session.get("user_id") is not None:
+            principal = f"user:{session['user_id']}"
+        else:
+            principal = "anonimo"
+
+        query = sorted(request.args.items(multi=True)) if include_query else []
+        if version is not None:
+            principal = f"{principal}:{version()}"
+        return f"{principal}:{advanced_cache._generate_key(query, *args, **kwargs)}"
+
+    return build
+
+
+def _in_background(func: Callable):
+    """
+    Executa func numa thread, levando junto o contexto da requisição
+
+    A atualização em segundo plano roda a mesma view, que lê session e
+    request.args.
+    """
+    try:
+        from flask import copy_current_request_context, has_request_context
+        if has_request_context():
+            func = copy_current_request_context(func)
+    except ImportError:
+        pass
+    threading.Thread(target=func, daemon=True).start()
+
+
+def cached(ttl: int = 300, key_prefix: str = "", tags: Optional[Any] = None,
+           key_builder: Optional[Callable[..., str]] = None, hard_ttl: Optional[int] = None):
     """
     Decorator para cachear resultados de funções
-    
+
+    Numa expiração só uma requisição por chave recalcula (as demais
+    esperam o resultado). Com hard_ttl > ttl, o valor vencido continua
+    sendo servido até hard_ttl enquanto uma única atualização roda em
+    segundo plano.
+
     Args:
-        ttl: Tempo de vida em segundos
-        key_prefix: Prefixo para a chave do cache
-    
+        ttl: Tempo de vida em segundos (TTL suave)
+        key_prefix: Prefixo para a chave do cache (também vira tag)
+        tags: Tags de dependência: lista fixa ou função que recebe os
+            mesmos argumentos da view e devolve a lista
+        key_builder: Função que recebe os argumentos da view e devolve a
+            parte variável da chave (padrão: hash dos argumentos). Para
+            rotas que dependem do usuário logado, use principal_key()
+        hard_ttl: Idade máxima do valor servido (padrão: igual ao ttl)
+
     Usage:
         @cached(ttl=60, key_prefix="leads")
         def get_leads():
             return db.get_all_leads()
+
+        @cached(ttl=60, key_prefix="lead", tags=lambda lead_id: [f"lead:{lead_id}"])
+        def get_lead(lead_id):
+            ...
     """
+    build_key = key_builder or advanced_cache._generate_key
+
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapper(*args, **kwargs):
             # Gera chave única
-            cache_key = f"{key_prefix}:{func.__name__}:{advanced_cache._generate_key(*args, **kwargs)}"
-            
+            cache_key = f"{key_prefix}:{func.__name__}:{build_key(*args, **kwargs)}"
+
+            def compute():
+                # Executa função e cacheia resultado
+                result = func(*args, **kwargs)
+                cacheable = _to_cacheable(result)
+                if cacheable is not None:
+                    entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+                    advanced_cache.set(cache_key, cacheable, ttl, tags=entry_tags, hard_ttl=hard_ttl)
+                return result
+
+            def refresh():
+                try:
+                    compute()
+                except Exception as e:
+                    print(f"⚠️ Erro ao atualizar cache {cache_key}: {e}")
+                finally:
+                    advanced_cache.flights.end(cache_key)
+
             # Tenta buscar do cache
-            cached_value = advanced_cache.get(cache_key)
+            cached_value, is_stale = advanced_cache.lookup(cache_key)
             if cached_value is not None:
-                return cached_value
-            
-            # Executa função e cacheia resultado
-            result = func(*args, **kwargs)
-            advanced_cache.set(cache_key, result, ttl)
-            
-            return result
-        
+                # Vencido: serve o valor antigo e dispara uma única atualização
+                if is_stale and advanced_cache.flights.begin(cache_key) is None:
+                    advanced_cache._count('refreshes')
+                    _in_background(refresh)
+                return _from_cacheable(cached_value)
+
+            # Ausente: só o primeiro recalcula; os demais esperam o resultado
+            in_flight = advanced_cache.flights.begin(cache_key)
+            if in_flight is None:
+                try:
+                    return compute()
+                finally:
+                    advanced_cache.flights.end(cache_key)
+
+            advanced_cache._count('waits')
+            in_flight.wait(advanced_cache.FLIGHT_WAIT_TIMEOUT)
+            cached_value, _ = advanced_cache.lookup(cache_key, record=False)
+            if cached_value is not None:
+                return _from_cacheable(cached_value)
+            # Resultado não cacheável (erro) ou demorou demais: calcula por conta própria
+            return compute()
+
         return wrapper
     return decorator
 
 
-def invalidate_cache(pattern: str = None):
+def invalidate_cache(pattern: str = None, tags: Optional[Iterable[str]] = None):
     """
-    Invalida cache por padrão
-    
+    Invalida cache por tag
+
     Usage:
         invalidate_cache("leads")  # Invalida todos os caches de leads
+        invalidate_cache(tags=["lead:42", "vendedor:7", "metrics"])
     """
-    advanced_cache.invalidate(pattern)
+    if tags is not None:
+        advanced_cache.invalidate_tags(tags)
+    else:
+        advanced_cache.invalidate(pattern)
 
 
 def get_cache_stats() -> dict:
     """Retorna estatísticas do cache"""
-    return advanced_cache.get_stats()
\ No newline at end of file
+    return advanced_cache.get_stats()
@@ -7,6 +7,9 @@ from datetime import datetime, timedelta
 from typing import List, Dict, Any
 import json
 
+from data_versions import install_version_triggers
+from change_feed import install_change_triggers
+
 
 class AlertSystem:
     """Sistema profissional de alertas e monitoramento"""
@@ -75,6 +78,10 @@ class AlertSystem:
             ON system_alerts(vendedor_id, resolved)
         ''')
         
+        # ETags e feed de mudanças: triggers das tabelas recém-criadas
+        install_version_triggers(conn)
+        install_change_triggers(conn)
+        
         conn.commit()
         conn.close()
     
@@ -104,11 +111,7 @@ class AlertSystem:
             LEFT JOIN users u ON l.assigned_to = u.id
             WHERE l.status = 'novo'
             AND l.assigned_to IS NOT NULL
-            AND NOT EXISTS (
-                SELECT 1 FROM messages m 
-                WHERE m.lead_id = l.id 
-                AND m.sender_type = 'vendedor'
-            )
+            AND l.first_vendedor_reply_at IS NULL
         ''')
         
         leads = [dict(row) for row in c.fetchall()]
@@ -209,15 +212,13 @@ class AlertSystem:
             SELECT 
                 l.*,
                 u.name as vendedor_name,
-                MAX(m.timestamp) as last_interaction
+                l.last_message_at as last_interaction
             FROM leads l
             LEFT JOIN users u ON l.assigned_to = u.id
-            LEFT JOIN messages m ON l.id = m.lead_id
             WHERE l.status NOT IN ('ganho', 'perdido')
             AND l.assigned_to IS NOT NULL
-            GROUP BY l.id
-            HAVING last_interaction < datetime('now', '-24 hours')
-            OR last_interaction IS NULL
+            AND (l.last_message_at < datetime('now', '-24 hours')
+                 OR l.last_message_at IS NULL)
         ''')
         
         leads = [dict(row) for row in c.fetchall()]
@@ -263,11 +264,7 @@ class AlertSystem:
                 u.name,
                 COUNT(DISTINCT l.id) as total_leads,
                 COUNT(DISTINCT CASE 
-                    WHEN EXISTS (
-                        SELECT 1 FROM messages m 
-                        WHERE m.lead_id = l.id 
-                        AND m.sender_type = 'vendedor'
-                    ) THEN l.id 
+                    WHEN l.first_vendedor_reply_at IS NOT NULL THEN l.id 
                 END) as leads_respondidos
             FROM users u
             LEFT JOIN leads l ON u.id = l.assigned_to
@@ -1,33 +1,53 @@
+import os
+
+from dotenv import load_dotenv
+
+# Carregar variáveis de ambiente
+load_dotenv()
+
+# Modo do servidor Socket.IO (SOCKETIO_ASYNC_MODE): "threading" (padrão) ou
+# "eventlet", que mantém milhares de websockets ociosos sem uma thread por
+# conexão (gunicorn -k eventlet -w 1). O monkey patch precisa vir antes de
+# qualquer outro import.
+SOCKETIO_ASYNC_MODE = os.getenv("SOCKETIO_ASYNC_MODE", "threading")
+if SOCKETIO_ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+
 from flask import Flask, request, jsonify, session, send_file
 from flask_socketio import SocketIO
 from flask_cors import CORS
-from notification_service import NotificationService
+from notification_service import NotificationService, lead_rooms, MANAGER_ROOM
 from database import Database
 from whatsapp_service import WhatsAppService
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from middlewares import (
-    rate_limit, validate_request, handle_errors,
+    rate_limit, etag, validate_request, handle_errors,
     InputValidator, add_security_headers, AuditLogger
 )
-from utils import Paginator, MessageSearcher, LeadSearcher, PerformanceCache
+from utils import Paginator, KeysetPaginator, MessageSearcher, LeadSearcher, PerformanceCache, normalize_phone
 import asyncio
 from functools import wraps
 from database_tags_sla import extend_database_with_tags_sla
 from database_ia import extend_database_with_ia
 from ia_assistant import IAAssistant
 from datetime import datetime
-from advanced_cache import cached, invalidate_cache, get_cache_stats
+from advanced_cache import cached, principal_key, invalidate_cache, get_cache_stats
 from alert_system import AlertSystem
 from alert_monitoring_service import AlertMonitoringService, check_alerts_once
 from gestor_whatsapp_notifier import GestorWhatsAppNotifier
 from export_service_premium import ExportServicePremium
+from metrics_rollup import MetricsRollup
+from data_versions import DataVersions
+from change_feed import ChangeFeed
+from emit_buffer import EmitBuffer
+from webhook_outbox import WebhookOutbox
+from inbound_dedup import dedup_key
+from outbound_queue import OutboundQueue, PRIORITY_IA, PRIORITY_VENDEDOR
+from campaigns import CampaignService, FILTER_KEYS
 
-import os
 import io
-from dotenv import load_dotenv
-
-# Carregar variáveis de ambiente
-load_dotenv()
+import json
 
 # =======================
 # CONFIGURAÇÃO PRINCIPAL
@@ -42,22 +62,44 @@ CORS(app, supports_credentials=True, origins=cors_origins)
 
 socketio = SocketIO(
     app,
-    cors_allowed_origins="*",
-    async_mode='threading',
+    cors_allowed_origins=cors_origins,
+    async_mode=SOCKETIO_ASYNC_MODE,
     ping_timeout=60,
     ping_interval=25,
     logger=False,
     engineio_logger=False
 )
 
+# Emissões agrupadas: requisições só enfileiram, uma tarefa envia em lotes
+socket_emitter = EmitBuffer(socketio)
+socket_emitter.start()
+
 # Inicializar serviço de notificações
-notification_service = NotificationService(socketio)
+notification_service = NotificationService(socket_emitter)
 
 # Inicialização dos serviços
 db = Database()
 extend_database_with_tags_sla(db)
 extend_database_with_ia(db)
-whatsapp = WhatsAppService(db, socketio)
+whatsapp = WhatsAppService(db, socket_emitter)
+
+# 📤 Fila de saída: quem envia só enfileira; o dispatcher entrega no ritmo do WhatsApp
+outbound_queue = OutboundQueue(
+    db,
+    deliver=whatsapp.deliver,
+    on_status=whatsapp.delivery_status,
+    is_available=whatsapp.bridge_available
+)
+whatsapp.outbound = outbound_queue
+outbound_queue.start()
+
+# 📣 Campanhas: distribuem pela faixa de campanhas da fila de saída
+campaign_service = CampaignService(db, outbound_queue, socket_emitter)
+outbound_queue.add_status_listener(campaign_service.delivery_status)
+campaign_service.resume_pending()
+
+# 🩺 Monitor da ponte: mantém is_ready e o circuit breaker sem bloquear envios e /health
+whatsapp.start_health_monitor()
 export_service = ExportServicePremium(db)
 validator = InputValidator()
 audit_logger = AuditLogger(db)
@@ -72,6 +114,8 @@ if os.getenv("IA_HABILITADA", "True") == "True":
         print(f"⚠️ IA Assistant desabilitado: {e}")
 
 # Utilitários
+metrics_rollup = MetricsRollup(db)
+data_versions = DataVersions(db)
 message_searcher = MessageSearcher(db)
 lead_searcher = LeadSearcher(db)
 cache = PerformanceCache(ttl_seconds=300)
@@ -81,7 +125,7 @@ print("🚀 CRM WhatsApp iniciado com todas as melhorias!")
 # 🚨 Inicializar sistema de alertas
 alert_monitoring = AlertMonitoringService(
     db=db,
-    socketio=socketio,
+    socketio=socket_emitter,
     notification_service=notification_service,
     whatsapp_service=whatsapp,
     check_interval=300
@@ -90,6 +134,10 @@ alert_monitoring = AlertMonitoringService(
 # Iniciar monitoramento em background
 alert_monitoring.start()
 
+# 📡 Feed de mudanças: emite os deltas gravados em change_log via Socket.IO
+change_feed = ChangeFeed(db, socketio)
+change_feed.start()
+
 # =======================
 # MIDDLEWARE GLOBAL
 # =======================
@@ -146,6 +194,44 @@ if os.getenv('GOOGLE_SHEETS_ENABLED') == 'True':
         sheets_service = None
 
 
+# =======================
+# HELPER: TAGS EM LOTE
+# =======================
+def attach_tags(leads):
+    """Preenche lead['tags'] de uma lista de leads com uma única consulta"""
+    tags_by_lead = db.get_tags_for_leads([lead['id'] for lead in leads])
+    for lead in leads:
+        lead['tags'] = tags_by_lead.get(lead['id'], [])
+    return leads
+
+
+# =======================
+# HELPER: PAGINAÇÃO POR CURSOR
+# =======================
+def cursor_page_requested():
+    """
+    Paginação por cursor é opcional: ?cursor= (vazio = primeira página)
+
+    Sem o parâmetro, as rotas devolvem a lista completa como antes.
+    """
+    return 'cursor' in request.args
+
+
+def keyset_paginator(key_fields):
+    """KeysetPaginator a partir de ?cursor= e ?limit= (ValueError se o cursor for inválido)"""
+    return KeysetPaginator(
+        request.args.get('cursor'),
+        request.args.get('limit', 50, type=int),
+        key_fields
+    )
+
+
+def total_requested(paginator):
+    """?with_total=1 pede o total aproximado (calculado só na primeira página)"""
+    with_total = request.args.get('with_total', '').lower() in ('1', 'true')
+    return with_total and paginator.after is None
+
+
 # =======================
 # HELPER: SINCRONIZAR COM SHEETS
 # =======================
@@ -157,7 +243,7 @@ def sync_lead_to_sheets(lead_id):
     try:
         lead = db.get_lead(lead_id)
         if lead:
-            lead['tags'] = db.get_lead_tags(lead_id)
+            attach_tags([lead])
             sheets_service.sync_lead(lead)
             print(f"📊 Lead {lead_id} sincronizado com Sheets")
     except Exception as e:
@@ -301,12 +387,53 @@ def change_password(user_id):
 # =======================
 # LEADS
 # =======================
+# Escopos de que as listagens de leads dependem (ETag e chave do cache)
+LEADS_SCOPES = ("leads", "tags", "users")
+
+# Admin e gestor enxergam os mesmos leads: uma única entrada de cache para todos.
+# A versão dos dados entra na chave, então a resposta cacheada nunca é mais
+# antiga que a ETag (inclusive após escritas do webhook)
+LEADS_CACHE_KEY = principal_key(
+    shared_roles={"admin": "todos", "gestor": "todos"},
+    version=lambda: data_versions.token(*LEADS_SCOPES)
+)
+
+
 @app.route("/api/leads", methods=["GET"])
 @rate_limit('per_minute')
 @login_required
-@cached(ttl=30, key_prefix="leads")
+@etag(data_versions, *LEADS_SCOPES)
+@cached(ttl=30, hard_ttl=90, key_prefix="leads", key_builder=LEADS_CACHE_KEY)
+@handle_errors
 def get_leads():
-    """Retorna leads com base no perfil do usuário"""
+    """
+    Retorna leads com base no perfil do usuário
+
+    Com ?cursor= devolve uma página ({items, pagination}) ordenada por
+    (updated_at, id); sem o parâmetro, a lista completa.
+    """
+    if not cursor_page_requested():
+        return list_all_leads()
+
+    role = session["role"]
+    if role in ["admin", "gestor"]:
+        assigned_to = None
+    elif role == "vendedor":
+        assigned_to = session["user_id"]
+    else:
+        return jsonify({"items": [], "pagination": {"limit": 0, "next_cursor": None, "has_more": False}})
+
+    paginator = keyset_paginator(('updated_at', 'id'))
+    leads = db.get_leads_page(assigned_to=assigned_to, after=paginator.after, limit=paginator.fetch_limit)
+    total = db.count_leads(assigned_to) if total_requested(paginator) else None
+
+    page = paginator.to_dict(leads, total)
+    attach_tags(page["items"])
+    return jsonify(page)
+
+
+def list_all_leads():
+    """Lista completa de leads do usuário (formato legado, sem paginação)"""
     role = session["role"]
     uid = session["user_id"]
     
@@ -345,8 +472,7 @@ def get_leads():
         conn.close()
         
         # Adicionar tags a cada lead
-        for lead in leads:
-            lead['tags'] = db.get_lead_tags(lead['id'])
+        attach_tags(leads)
         
         return jsonify(leads)
         
@@ -388,8 +514,7 @@ def get_leads_queue():
         conn.close()
         
         # Adicionar tags
-        for lead in leads:
-            lead['tags'] = db.get_lead_tags(lead['id'])
+        attach_tags(leads)
         
         print(f"📋 Fila: {len(leads)} leads não atribuídos")  # ✅ Debug
         
@@ -434,7 +559,8 @@ def assign_lead(lead_id):
     sync_lead_to_sheets(lead_id)
     invalidate_cache("leads")
     
-    socketio.emit("lead_assigned", {"lead_id": lead_id, "vendedor_id": uid}, room="gestores")
+    socket_emitter.emit("lead_assigned", {"lead_id": lead_id, "vendedor_id": uid},
+                        room=lead_rooms(lead), key=("lead", lead_id))
     return jsonify({"success": True})
 
 
@@ -464,7 +590,8 @@ def update_lead_status(lead_id):
     invalidate_cache("leads")
     invalidate_cache("metrics")
    
-    socketio.emit("lead_status_changed", {"lead_id": lead_id, "status": status}, room="gestores")
+    socket_emitter.emit("lead_status_changed", {"lead_id": lead_id, "status": status},
+                        room=lead_rooms(lead_atualizado), key=("lead", lead_id))
     return jsonify({"success": True})
 
 
@@ -479,13 +606,17 @@ def transfer_lead(lead_id):
     vendedor_id = data["vendedor_id"]
     uname = session["name"]
     
+    lead_antes = db.get_lead(lead_id)
     db.transfer_lead(lead_id, vendedor_id)
     db.add_lead_log(lead_id, "lead_transferido", uname, f"Lead transferido")
     audit_logger.log_action(session["user_id"], "lead_transferred", "lead", lead_id, f"Para vendedor {vendedor_id}")
     
     sync_lead_to_sheets(lead_id)
+    invalidate_cache("leads")
     
-    socketio.emit("lead_transferred", {"lead_id": lead_id, "vendedor_id": vendedor_id}, room="gestores")
+    # Dono anterior também fica sabendo que o lead saiu da carteira dele
+    socket_emitter.emit("lead_transferred", {"lead_id": lead_id, "vendedor_id": vendedor_id},
+                        room=lead_rooms(lead_antes, vendedor_id), key=("lead", lead_id))
     return jsonify({"success": True})
 
 
@@ -496,6 +627,8 @@ def transfer_lead(lead_id):
 @app.route("/api/leads/kanban", methods=["GET"])
 @rate_limit('per_minute')
 @login_required
+@etag(data_versions, *LEADS_SCOPES)
+@cached(ttl=30, hard_ttl=90, key_prefix="leads", key_builder=LEADS_CACHE_KEY)
 def get_leads_kanban():
     """
     Retorna leads organizados por status (para Kanban)
@@ -541,8 +674,7 @@ def get_leads_kanban():
         all_leads = [dict(row) for row in c.fetchall()]
         
         # Adicionar tags
-        for lead in all_leads:
-            lead['tags'] = db.get_lead_tags(lead['id'])
+        attach_tags(all_leads)
         
         # Organizar por status
         kanban_data = {
@@ -641,8 +773,25 @@ def get_vendedores():
 @login_required
 @handle_errors
 def get_messages(lead_id):
-    messages = db.get_messages_by_lead(lead_id)
-    return jsonify(messages)
+    """
+    Mensagens do lead
+
+    Com ?cursor= devolve as mensagens mais recentes primeiro, em páginas;
+    next_cursor aponta para as mais antigas. Dentro da página os itens
+    ficam em ordem cronológica (prontos para exibir).
+    """
+    if not cursor_page_requested():
+        messages = db.get_messages_by_lead(lead_id)
+        return jsonify(messages)
+
+    paginator = keyset_paginator(('id',))
+    before_id = paginator.after[0] if paginator.after else None
+    messages = db.get_messages_page(lead_id, before_id=before_id, limit=paginator.fetch_limit)
+    total = db.count_messages_by_lead(lead_id) if total_requested(paginator) else None
+
+    page = paginator.to_dict(messages, total)
+    page["items"].reverse()
+    return jsonify(page)
 
 
 @app.route("/api/leads/<int:lead_id>/messages", methods=["POST"])
@@ -666,13 +815,14 @@ def send_message(lead_id):
     if not lead:
         return jsonify({"error": "Lead não encontrado"}), 404
 
-    success = whatsapp.send_message(lead["phone"], content, uid)
+    handle = whatsapp.queue_message(lead["phone"], content, PRIORITY_VENDEDOR, vendedor_id=uid, lead=lead)
+    success = handle is not None and handle["status"] != "failed"
     if success:
         db.add_lead_log(lead_id, "mensagem_enviada", uname, content[:80])
         audit_logger.log_action(uid, "message_sent", "message", lead_id, f"Mensagem enviada para lead {lead_id}")
         
         sync_message_to_sheets({
-            'id': db.get_connection().cursor().lastrowid,
+            'id': handle["message_id"],
             'lead_id': lead_id,
             'lead_nome': lead['name'],
             'is_from_me': True,
@@ -683,7 +833,96 @@ def send_message(lead_id):
         
         sync_lead_to_sheets(lead_id)
     
-    return jsonify({"success": success})
+    return jsonify({"success": success, "message": handle})
+
+
+@app.route("/api/messages/outbound/<int:outbound_id>", methods=["GET"])
+@rate_limit('per_minute')
+@login_required
+def get_outbound_message(outbound_id):
+    """Situação de uma mensagem na fila de saída (handle devolvido no envio)"""
+    item = outbound_queue.get(outbound_id)
+    if not item:
+        return jsonify({"error": "Mensagem não encontrada"}), 404
+    return jsonify(item)
+
+# =======================
+# CAMPANHAS
+# =======================
+@app.route("/api/campaigns", methods=["POST"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@validate_request('name', 'template')
+@handle_errors
+def create_campaign():
+    """
+    Envia um template para um segmento de leads
+
+    Body: {"name", "template" ({nome}, {interesse}), "filters": {tag_id | tag,
+    status, classification, vendedor_id}, "dry_run": bool}
+    """
+    data = request.json
+
+    valid, template = validator.validate_text(data.get("template"), max_length=4096, field_name="Template")
+    if not valid:
+        return jsonify({"error": template}), 400
+    template = validator.sanitize_html(template)
+
+    raw_filters = data.get("filters") or {}
+    filters = {key: raw_filters[key] for key in FILTER_KEYS if raw_filters.get(key) not in (None, "", [])}
+
+    try:
+        if data.get("dry_run"):
+            return jsonify(campaign_service.preview(template, filters))
+
+        campaign = campaign_service.create(
+            str(data["name"]).strip()[:100],
+            template,
+            filters,
+            {"id": session["user_id"], "name": session["name"]}
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    audit_logger.log_action(
+        session["user_id"], "campaign_created", "campaign", campaign["id"],
+        f"Campanha '{campaign['name']}' para {campaign['total']} leads"
+    )
+    return jsonify({"success": True, "campaign": campaign_service.progress(campaign)}), 202
+
+
+@app.route("/api/campaigns", methods=["GET"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+def list_campaigns():
+    return jsonify(campaign_service.list(limit=request.args.get("limit", 50, type=int)))
+
+
+@app.route("/api/campaigns/<int:campaign_id>", methods=["GET"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+def get_campaign(campaign_id):
+    """Progresso da campanha (também enviado em tempo real como "campaign_progress")"""
+    campaign = campaign_service.get(campaign_id)
+    if not campaign:
+        return jsonify({"error": "Campanha não encontrada"}), 404
+    return jsonify({
+        **campaign_service.progress(campaign),
+        "template": campaign["template"],
+        "filters": json.loads(campaign["filters"])
+    })
+
+
+@app.route("/api/campaigns/<int:campaign_id>/cancel", methods=["POST"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@handle_errors
+def cancel_campaign(campaign_id):
+    campaign = campaign_service.cancel(campaign_id)
+    if not campaign:
+        return jsonify({"error": "Campanha não encontrada"}), 404
+    audit_logger.log_action(session["user_id"], "campaign_cancelled", "campaign", campaign_id, campaign["name"])
+    return jsonify({"success": True, "campaign": campaign_service.progress(campaign)})
 
 # =======================
 # NOTAS INTERNAS
@@ -717,7 +956,8 @@ def add_note(lead_id):
     
     audit_logger.log_action(uid, "note_added", "note", lead_id, "Nota interna adicionada")
 
-    socketio.emit("new_note", {"lead_id": lead_id, "note": note, "user_name": uname}, room="gestores")
+    socket_emitter.emit("new_note", {"lead_id": lead_id, "note": note, "user_name": uname},
+                        room=lead_rooms(db.get_lead(lead_id)))
     return jsonify({"success": True})
 
 # =======================
@@ -728,9 +968,16 @@ def add_note(lead_id):
 @login_required
 @handle_errors
 def get_lead_logs(lead_id):
-    """Retorna histórico do lead"""
-    logs = db.get_lead_logs(lead_id)
-    return jsonify(logs)
+    """Retorna histórico do lead (com ?cursor=, paginado do mais recente ao mais antigo)"""
+    if not cursor_page_requested():
+        logs = db.get_lead_logs(lead_id)
+        return jsonify(logs)
+
+    paginator = keyset_paginator(('id',))
+    before_id = paginator.after[0] if paginator.after else None
+    logs = db.get_lead_logs_page(lead_id, before_id=before_id, limit=paginator.fetch_limit)
+    total = db.count_lead_logs(lead_id) if total_requested(paginator) else None
+    return jsonify(paginator.to_dict(logs, total))
 
 # ========================================
 # 📊 ENDPOINT DE MÉTRICAS AVANÇADAS
@@ -742,9 +989,11 @@ from collections import defaultdict
 @app.route('/api/metrics', methods=['GET'])
 @login_required
 def get_metrics():
-    """Retorna métricas avançadas do CRM"""
+    """Retorna métricas avançadas do CRM (lidas dos rollups, ver metrics_rollup.py)"""
     period = request.args.get('period', 'month')
-    vendedor_id = request.args.get('vendedor_id', None)
+    vendedor_id = request.args.get('vendedor_id', type=int)
+    if vendedor_id is None and request.args.get('vendedor_id'):
+        return jsonify({"error": "vendedor_id inválido"}), 400
 
     now = datetime.now()
     if period == 'day':
@@ -754,147 +1003,7 @@ def get_metrics():
     else:
         start_date = now - timedelta(days=30)
 
-    conn = db.get_connection()
-    c = conn.cursor()
-
-    where_base = "WHERE l.created_at >= ?"
-    params = [start_date.strftime('%Y-%m-%d %H:%M:%S')]
-    if vendedor_id:
-        where_base += " AND l.assigned_to = ?"
-        params.append(vendedor_id)
-
-    c.execute(f'''
-        SELECT 
-            COUNT(*) as total_leads,
-            SUM(CASE WHEN status = 'ganho' THEN 1 ELSE 0 END) as leads_ganhos,
-            SUM(CASE WHEN status = 'novo' THEN 1 ELSE 0 END) as leads_novo,
-            SUM(CASE WHEN status = 'em_atendimento' THEN 1 ELSE 0 END) as leads_atendimento,
-            SUM(CASE WHEN status = 'qualificado' THEN 1 ELSE 0 END) as leads_qualificado,
-            SUM(CASE WHEN status = 'perdido' THEN 1 ELSE 0 END) as leads_perdido
-        FROM leads l
-        {where_base}
-    ''', params)
-    metrics = dict(c.fetchone() or {})
-
-    metrics.setdefault('total_leads', 0)
-    metrics.setdefault('leads_ganhos', 0)
-
-    metrics['taxa_conversao'] = (
-        round((metrics['leads_ganhos'] / metrics['total_leads']) * 100, 1)
-        if metrics['total_leads'] > 0 else 0
-    )
-
-    query_tempo = f'''
-        SELECT AVG(
-            (julianday(m.timestamp) - julianday(l.created_at)) * 24 * 60
-        ) as tempo_medio
-        FROM messages m
-        INNER JOIN leads l ON m.lead_id = l.id
-        WHERE m.sender_type = 'vendedor'
-        AND m.id = (
-            SELECT MIN(id)
-            FROM messages
-            WHERE lead_id = l.id AND sender_type = 'vendedor'
-        )
-        AND l.created_at >= ?
-    '''
-    params_tempo = [start_date.strftime('%Y-%m-%d %H:%M:%S')]
-    if vendedor_id:
-        query_tempo += " AND l.assigned_to = ?"
-        params_tempo.append(vendedor_id)
-
-    c.execute(query_tempo, params_tempo)
-    tempo = c.fetchone()
-    metrics['tempo_resposta'] = round(tempo['tempo_medio'] or 0, 1)
-
-    meta_sla = 15
-    query_sla = f'''
-        SELECT 
-            COUNT(*) as total,
-            SUM(CASE 
-                WHEN (julianday(m.timestamp) - julianday(l.created_at)) * 24 * 60 <= {meta_sla}
-                THEN 1 ELSE 0 
-            END) as dentro_sla
-        FROM messages m
-        INNER JOIN leads l ON m.lead_id = l.id
-        WHERE m.sender_type = 'vendedor'
-        AND m.id = (
-            SELECT MIN(id)
-            FROM messages
-            WHERE lead_id = l.id AND sender_type = 'vendedor'
-        )
-        AND l.created_at >= ?
-    '''
-    params_sla = [start_date.strftime('%Y-%m-%d %H:%M:%S')]
-    if vendedor_id:
-        query_sla += " AND l.assigned_to = ?"
-        params_sla.append(vendedor_id)
-
-    c.execute(query_sla, params_sla)
-    sla = dict(c.fetchone() or {'total': 0, 'dentro_sla': 0})
-    if sla['total'] > 0:
-        sla['dentro_sla'] = round((sla['dentro_sla'] / sla['total']) * 100, 1)
-        sla['fora_sla'] = round(100 - sla['dentro_sla'], 1)
-    else:
-        sla['dentro_sla'] = 0
-        sla['fora_sla'] = 0
-    sla['meta_minutos'] = meta_sla
-    metrics['sla_compliance'] = sla
-
-    c.execute(f'''
-        SELECT 
-            COALESCE(u.name, 'Sem atribuir') as vendedor,
-            COUNT(*) as leads
-        FROM leads l
-        LEFT JOIN users u ON l.assigned_to = u.id
-        {where_base}
-        GROUP BY u.id, u.name
-        ORDER BY leads DESC
-    ''', params)
-    carga = []
-    for row in c.fetchall():
-        total_leads = metrics['total_leads'] or 1
-        carga.append({
-            'vendedor': row['vendedor'],
-            'leads': row['leads'],
-            'percent': round((row['leads'] / total_leads) * 100, 1)
-        })
-    metrics['distribuicao_carga'] = carga
-
-    c.execute(f'''
-        SELECT 
-            u.name,
-            COUNT(*) as total_leads,
-            SUM(CASE WHEN l.status = 'ganho' THEN 1 ELSE 0 END) as ganhos,
-            ROUND(
-                (SUM(CASE WHEN l.status = 'ganho' THEN 1.0 ELSE 0 END) / COUNT(*)) * 100, 
-                1
-            ) as taxa
-        FROM leads l
-        INNER JOIN users u ON l.assigned_to = u.id
-        {where_base}
-        GROUP BY u.id, u.name
-        ORDER BY ganhos DESC, taxa DESC
-        LIMIT 5
-    ''', params)
-    ranking = []
-    for row in c.fetchall():
-        ranking.append({
-            'name': row['name'],
-            'ganhos': row['ganhos'],
-            'taxa': row['taxa'] or 0
-        })
-    metrics['ranking'] = ranking
-
-    metrics['funil'] = {
-        'novo': metrics.get('leads_novo', 0),
-        'em_atendimento': metrics.get('leads_atendimento', 0),
-        'qualificado': metrics.get('leads_qualificado', 0),
-        'ganho': metrics.get('leads_ganhos', 0),
-        'perdido': metrics.get('leads_perdido', 0)
-    }
-
-    conn.close()
+    metrics = metrics_rollup.get_metrics(start_date, vendedor_id)
     return jsonify(metrics)
 
 
@@ -906,10 +1015,17 @@ def get_metrics():
 @role_required("admin", "gestor")
 @handle_errors
 def get_audit_log():
-    """Retorna logs de auditoria"""
-    limit = request.args.get('limit', 100, type=int)
-    logs = db.get_audit_logs(limit)
-    return jsonify(logs)
+    """Retorna logs de auditoria (com ?cursor=, paginado do mais recente ao mais antigo)"""
+    if not cursor_page_requested():
+        limit = request.args.get('limit', 100, type=int)
+        logs = db.get_audit_logs(limit)
+        return jsonify(logs)
+
+    paginator = keyset_paginator(('id',))
+    before_id = paginator.after[0] if paginator.after else None
+    logs = db.get_audit_logs_page(before_id=before_id, limit=paginator.fetch_limit)
+    total = db.estimate_audit_log_count() if total_requested(paginator) else None
+    return jsonify(paginator.to_dict(logs, total))
 
 # =======================
 # TAGS (Sistema de Tags)
@@ -983,6 +1099,7 @@ def add_tag_to_lead(lead_id):
         audit_logger.log_action(session["user_id"], "tag_added_to_lead", "lead", lead_id, f"Tag {tag_id}")
         
         sync_lead_to_sheets(lead_id)
+        invalidate_cache("leads")
         
         return jsonify({"success": True})
     except:
@@ -1006,6 +1123,7 @@ def remove_tag_from_lead(lead_id, tag_id):
         audit_logger.log_action(session["user_id"], "tag_removed_from_lead", "lead", lead_id, f"Tag {tag_id}")
         
         sync_lead_to_sheets(lead_id)
+        invalidate_cache("leads")
         
         return jsonify({"success": True})
     except:
@@ -1033,6 +1151,7 @@ def get_lead_sla(lead_id):
 @app.route("/api/sla/metrics", methods=["GET"])
 @rate_limit('per_minute')
 @role_required("admin", "gestor")
+@etag(data_versions, "leads", "messages", "sla", window=60)
 def get_sla_metrics():
     """Retorna métricas de SLA"""
     try:
@@ -1056,6 +1175,7 @@ def get_sla_metrics():
 @app.route("/api/sla/alerts", methods=["GET"])
 @rate_limit('per_minute')
 @role_required("admin", "gestor")
+@etag(data_versions, "leads", "messages", "sla", window=60)
 def get_sla_alerts():
     """Retorna alertas de SLA próximos do limite"""
     threshold = request.args.get('threshold', 5, type=int)
@@ -1079,115 +1199,134 @@ def get_sla_alerts():
 # =======================
 # WEBHOOK DO WHATSAPP - ✅ SEM DUPLICAÇÃO
 # =======================
+def process_inbound_event(event):
+    """
+    Processa um evento da fila de webhooks (chamado pelos workers)
+
+    Exceção = nova tentativa (e, esgotadas, dead letter); a IA continua
+    não bloqueante. O evento só sai da fila depois de tudo abaixo: se uma
+    tentativa falhar depois de gravar a mensagem, a próxima não grava de
+    novo (message_id vem da fila) mas refaz notificações, Sheets e IA.
+    """
+    phone = event["phone"]
+    name = event["name"]
+    content = event["content"]
+    timestamp = event["timestamp"]
+    message_id = event.get("message_id")
+
+    if message_id:
+        print(f"♻️ Mensagem {message_id} já registrada, retomando o processamento")
+        lead = db.create_or_get_lead(phone, name)
+    else:
+        # Lead + mensagem + log numa única transação
+        lead, message_id = db.record_inbound_message(
+            phone, name, content, dedup_key=event.get("dedup_key"), outbox_id=event.get("outbox_id")
+        )
+
+    if not lead:
+        raise RuntimeError(f"Erro ao criar/buscar lead para {phone}")
+
+    notification_service.notify_new_lead(lead, room='gestores')
+    sync_lead_to_sheets(lead["id"])
+
+    notification_service.notify_new_message(lead, content, room='gestores')
+
+    sync_message_to_sheets({
+        'id': message_id,
+        'lead_id': lead["id"],
+        'lead_nome': name,
+        'is_from_me': False,
+        'mensagem': content,
+        'timestamp': timestamp,
+        'status': 'recebida'
+    })
+
+    # 🤖 RESPOSTA AUTOMÁTICA DA IA
+    resposta_ia_enviada = False
+    if ia_assistant:
+        try:
+            resposta_ia = ia_assistant.processar_mensagem(lead["id"], content)
+
+            if resposta_ia:
+                handle = whatsapp.queue_message(phone, resposta_ia, PRIORITY_IA, lead=lead)
+
+                if handle and handle["status"] != "failed":
+                    resposta_ia_enviada = True
+                    print(f"🤖 IA respondeu ao lead {lead['id']} (envio {handle['status']})")
+                    
+                    socket_emitter.emit("new_message", {
+                        "lead_id": lead["id"],
+                        "phone": phone,
+                        "name": "Assistente IA",
+                        "content": resposta_ia,
+                        "timestamp": datetime.now().isoformat(),
+                        "sender_type": "ia"
+                    }, room=lead_rooms(lead))
+                else:
+                    print(f"⚠️ IA processou mas a resposta não pôde ser enviada")
+
+        except Exception as e_ia:
+            print(f"⚠️ Erro na IA (não bloqueante): {e_ia}")
+
+    if not resposta_ia_enviada:
+        socket_emitter.emit("new_message", {
+            "lead_id": lead["id"],
+            "phone": phone,
+            "name": name,
+            "content": content,
+            "timestamp": timestamp,
+            "sender_type": "lead"
+        }, room=lead_rooms(lead), key=("message", message_id))
+
+    print(f"✅ Mensagem processada: lead {lead['id']} ({name}, {phone})")
+
+
+webhook_outbox = WebhookOutbox(db, handler=process_inbound_event)
+webhook_outbox.start()
+
+
 @app.route("/api/webhook/message", methods=["POST"])
 @rate_limit('per_hour')
 @handle_errors
 def webhook_message():
+    """Valida, grava o evento na fila durável e responde (processamento nos workers)"""
     data = request.get_json(force=True)
     print(f"📩 Webhook recebido: {data}")
 
-    try:
-        phone_raw = data.get("from") or data.get("phone", "")
-        content = data.get("body") or data.get("content", "")
-        name = data.get("notifyName") or data.get("name", "Lead")
-        
-        phone = str(phone_raw).strip().replace("+", "").replace(" ", "").replace("-", "").replace("@c.us", "").replace("@s.whatsapp.net", "")
-        content = str(content).strip()
-        name = str(name).strip()
-        timestamp = datetime.now().isoformat()
-
-        print(f"📞 Telefone limpo: {phone}")
-        print(f"💬 Conteúdo: {content[:50]}...")
-        print(f"👤 Nome: {name}")
-
-        if not phone.isdigit():
-            print(f"⚠️ Telefone inválido recebido: {phone_raw} -> {phone}")
-            return jsonify({"error": "Telefone inválido"}), 400
+    phone_raw = data.get("from") or data.get("phone", "")
+    content = data.get("body") or data.get("content", "")
+    name = data.get("notifyName") or data.get("name", "Lead")
+    
+    phone = normalize_phone(phone_raw) or ""
+    content = str(content).strip()
+    name = str(name).strip()
 
-        if not content:
-            print("⚠️ Webhook ignorado (sem conteúdo).")
-            return jsonify({"error": "Sem conteúdo"}), 400
+    if not phone.isdigit():
+        print(f"⚠️ Telefone inválido recebido: {phone_raw} -> {phone}")
+        return jsonify({"error": "Telefone inválido"}), 400
 
-        lead = db.create_or_get_lead(phone, name)
-        
-        if not lead:
-            print(f"❌ Erro ao criar/buscar lead para {phone}")
-            return jsonify({"error": "Erro ao processar lead"}), 500
-        
-        notification_service.notify_new_lead(lead, room='gestores')
-        sync_lead_to_sheets(lead["id"])
+    if not content:
+        print("⚠️ Webhook ignorado (sem conteúdo).")
+        return jsonify({"error": "Sem conteúdo"}), 400
+
+    # Reenvio da ponte: responde sucesso sem banco, fila nem IA
+    key = dedup_key(data, phone, content)
+    if key is None:
+        print(f"⚠️ Webhook de {phone} sem id nem timestamp do provedor, sem deduplicação")
+    event_id = webhook_outbox.enqueue(phone, {
+        "phone": phone,
+        "name": name,
+        "content": content,
+        "timestamp": datetime.now().isoformat(),
+        "dedup_key": key,
+        "raw": data
+    }, dedup_key=key)
 
-        db.add_message(lead["id"], "lead", name, content)
-        notification_service.notify_new_message(lead, content, room='gestores')
-        
-        sync_message_to_sheets({
-            'id': db.get_connection().cursor().lastrowid,
-            'lead_id': lead["id"],
-            'lead_nome': name,
-            'is_from_me': False,
-            'mensagem': content,
-            'timestamp': timestamp,
-            'status': 'recebida'
-        })
+    if event_id is None:
+        print(f"♻️ Webhook duplicado ignorado ({key})")
+        return jsonify({"success": True, "duplicate": True}), 200
 
-        db.add_lead_log(lead["id"], "mensagem_recebida", name, content[:100])
-
-        # 🤖 RESPOSTA AUTOMÁTICA DA IA
-        resposta_ia_enviada = False
-        if ia_assistant:
-            try:
-                resposta_ia = ia_assistant.processar_mensagem(lead["id"], content)
-
-                if resposta_ia:
-                    success = whatsapp.send_message(
-                        phone=phone, 
-                        content=resposta_ia, 
-                        vendedor_id=0,
-                        bypass_lead_check=True
-                    )
-
-                    if success:
-                        resposta_ia_enviada = True
-                        print(f"🤖 IA respondeu ao lead {lead['id']} via WhatsApp")
-                        
-                        socketio.emit("new_message", {
-                            "lead_id": lead["id"],
-                            "phone": phone,
-                            "name": "Assistente IA",
-                            "content": resposta_ia,
-                            "timestamp": datetime.now().isoformat(),
-                            "sender_type": "ia"
-                        }, room="gestores")
-                    else:
-                        print(f"⚠️ IA processou mas WhatsApp offline")
-
-            except Exception as e_ia:
-                print(f"⚠️ Erro na IA (não bloqueante): {e_ia}")
-
-        if not resposta_ia_enviada:
-            socketio.emit("new_message", {
-                "lead_id": lead["id"],
-                "phone": phone,
-                "name": name,
-                "content": content,
-                "timestamp": timestamp,
-                "sender_type": "lead"
-            }, room="gestores")
-
-        print(f"✅ Mensagem processada com sucesso!")
-        print(f"   Lead ID: {lead['id']}")
-        print(f"   Nome: {name}")
-        print(f"   Telefone: {phone}")
-        print(f"   📊 Sincronizado com Google Sheets")
-        print("")
-        
-        return jsonify({"success": True, "lead_id": lead["id"]}), 200
-    
-    except Exception as e:
-        print(f"❌ Erro no webhook: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+    return jsonify({"success": True, "queued": True, "event_id": event_id}), 202
 
 # =======================
 # SIMULADOR (Modo Desenvolvimento)
@@ -1217,12 +1356,52 @@ def simulate_message():
 def whatsapp_status():
     return jsonify(whatsapp.get_status())
 
+# =======================
+# FEED DE MUDANÇAS
+# =======================
+@app.route("/api/changes", methods=["GET"])
+@rate_limit('per_minute')
+@login_required
+@handle_errors
+def get_changes():
+    """
+    Deltas a partir de uma versão (?since=, ?limit=)
+
+    Alternativa REST ao evento "changes" do Socket.IO e retomada depois de
+    reconectar. Com reset=true a versão pedida já expirou: recarregar tudo.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', 500, type=int)
+    return jsonify(change_feed.changes_since(since, session["role"], session["user_id"], limit))
+
+
 # =======================
 # SOCKET.IO EVENTS
 # =======================
+def socket_rooms():
+    """
+    Salas a que o usuário da sessão tem direito
+
+    user_<id> e role_<role> sempre; "gestores" só para admin/gestor.
+    """
+    if "user_id" not in session:
+        return set()
+    rooms = {f"user_{session['user_id']}", f"role_{session['role']}"}
+    if session["role"] in ["admin", "gestor"]:
+        rooms.add(MANAGER_ROOM)
+    return rooms
+
+
 @socketio.on("connect")
 def on_connect():
-    print("🔌 Cliente conectado")
+    # Salas vêm da sessão, nunca do cliente
+    rooms = socket_rooms()
+    if not rooms:
+        print("🚫 Conexão Socket.IO sem sessão recusada")
+        return False
+    for room in rooms:
+        join_room(room)
+    print(f"🔌 Cliente conectado: {session.get('username', session['user_id'])} → {sorted(rooms)}")
 
 @socketio.on("disconnect")
 def on_disconnect():
@@ -1230,16 +1409,32 @@ def on_disconnect():
 
 @socketio.on("join_room")
 def on_join(data):
-    room = data.get("room")
+    # Compatibilidade com o frontend: as salas já foram atribuídas no connect,
+    # aqui só se aceita (re)entrar numa sala permitida
+    room = (data or {}).get("room")
+    if room not in socket_rooms():
+        print(f"🚫 Sala não permitida: {room}")
+        return
     join_room(room)
     print(f"📍 Entrou na sala: {room}")
 
 @socketio.on("leave_room")
 def on_leave(data):
-    room = data.get("room")
+    room = (data or {}).get("room")
     leave_room(room)
     print(f"📍 Saiu da sala: {room}")
 
+@socketio.on("changes_since")
+def on_changes_since(data):
+    """Retomada após reconectar: devolve (ack) os deltas perdidos"""
+    if "user_id" not in session:
+        return {"error": "Não autenticado"}
+    try:
+        since = int((data or {}).get("since") or 0)
+    except (TypeError, ValueError, AttributeError):
+        return {"error": "since inválido"}
+    return change_feed.changes_since(since, session["role"], session["user_id"])
+
 # =======================
 # HEALTH CHECK
 # =======================
@@ -1256,7 +1451,10 @@ def health_check():
             "database": "ok",
             "whatsapp": "connected" if whatsapp_status else "disconnected",
             "google_sheets": "connected" if sheets_status else "disconnected"
-        }
+        },
+        "socket_emits": socket_emitter.get_stats(),
+        "webhook_queue": webhook_outbox.get_stats(),
+        "outbound_queue": outbound_queue.get_stats()
     })
 
 # =======================
@@ -1275,6 +1473,7 @@ def cache_stats_endpoint():
 @app.route("/api/alerts", methods=["GET"])
 @rate_limit('per_minute')
 @role_required("admin", "gestor")
+@etag(data_versions, "alerts")
 @handle_errors
 def get_alerts():
     """Retorna alertas ativos"""
@@ -1325,7 +1524,7 @@ def get_alerts_dashboard():
 @handle_errors
 def check_alerts_now():
     """Força verificação de alertas (apenas admin)"""
-    new_alerts = check_alerts_once(db, socketio, notification_service, whatsapp)
+    new_alerts = check_alerts_once(db, socket_emitter, notification_service, whatsapp)
     
     return jsonify({
         "success": True,
@@ -1684,5 +1883,8 @@ if __name__ == "__main__":
         print(f"📊 Google Sheets: {sheets_service.get_spreadsheet_url()}")
     print("=" * 60)
 
-    socketio.run(app, debug=False, host="0.0.0.0", port=5000, 
-                 allow_unsafe_werkzeug=True)
\ No newline at end of file
+    if SOCKETIO_ASYNC_MODE == "threading":
+        socketio.run(app, debug=False, host="0.0.0.0", port=5000,
+                     allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, debug=False, host="0.0.0.0", port=5000)
\ No newline at end of file
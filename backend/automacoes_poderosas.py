@@ -12,6 +12,8 @@ from typing import Dict, List, Optional
 from threading import Thread
 import time
 
+from outbound_queue import PRIORITY_CAMPAIGN
+
 
 class AutomacoesPoderosas:
     """
@@ -109,13 +111,18 @@ class AutomacoesPoderosas:
         # Enviar mensagem
         try:
             if self.whatsapp_service:
-                self.whatsapp_service.send_message(
+                # Faixa de campanhas da fila de saída (não bloqueia esperando a ponte)
+                handle = self.whatsapp_service.queue_message(
                     tarefa['phone'],
-                    tarefa['mensagem']
+                    tarefa['mensagem'],
+                    priority=PRIORITY_CAMPAIGN
                 )
-                tarefa['status'] = 'enviado'
+                if handle is None or handle['status'] == 'failed':
+                    raise RuntimeError("mensagem recusada pela fila de saída")
+                tarefa['status'] = 'enviado' if handle['status'] == 'sent' else 'enfileirado'
+                tarefa['outbound_id'] = handle['id']
                 tarefa['enviado_em'] = datetime.now().isoformat()
-                print(f"✅ Recuperação enviada para {tarefa['phone']}")
+                print(f"✅ Recuperação enfileirada para {tarefa['phone']}")
             else:
                 print(f"⚠️ WhatsApp service não configurado")
                 tarefa['status'] = 'erro'
@@ -0,0 +1,422 @@
+"""
+Campanhas: um template enviado para um segmento de leads
+
+- Segmento por tag, status (coluna do Kanban), classificação e vendedor
+- Template com {nome} e {interesse}, como nas automações de recuperação
+- Os destinatários saem do SQL em lotes (keyset por id, CAMPAIGN_BATCH_SIZE);
+  cada lote grava mensagens, logs e a fila de saída em poucos INSERTs numa
+  única transação
+- A distribuição é retomável: um lote só grava leads que ainda não são
+  destinatários, e no início do app resume_pending() continua as
+  campanhas que ficaram no meio (reinício durante a distribuição)
+- O envio é o da fila de saída (faixa de campanhas, abaixo de IA, vendedores
+  e alertas, dentro do limite de taxa); o status de entrega atualiza o
+  progresso da campanha e o front recebe "campaign_progress"
+"""
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from outbound_queue import PRIORITY_CAMPAIGN
+from notification_service import MANAGER_ROOM
+
+
+CAMPAIGN_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS campaigns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        template TEXT NOT NULL,
+        filters TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_by INTEGER,
+        created_by_name TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        queued INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0,
+        fanout_done INTEGER NOT NULL DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME,
+        FOREIGN KEY (created_by) REFERENCES users(id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS campaign_recipients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        campaign_id INTEGER NOT NULL,
+        lead_id INTEGER NOT NULL,
+        message_id INTEGER,
+        outbound_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'queued',
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (campaign_id, lead_id),
+        FOREIGN KEY (campaign_id) REFERENCES campaigns(id),
+        FOREIGN KEY (lead_id) REFERENCES leads(id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_campaign_recipients_campaign_status ON campaign_recipients(campaign_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_campaign_recipients_message ON campaign_recipients(message_id)",
+]
+
+FILTER_KEYS = ("tag_id", "tag", "status", "classification", "vendedor_id")
+
+
+def render_template(template: str, lead: Dict) -> str:
+    """Substitui {nome} e {interesse} (mesmos padrões das automações)"""
+    mensagem = template.replace('{nome}', lead.get('name') or 'Cliente')
+    mensagem = mensagem.replace('{interesse}', lead.get('interesse') or 'nossos produtos')
+    return mensagem
+
+
+def segment_query(filters: Dict) -> Tuple[str, List]:
+    """
+    WHERE do segmento (sobre leads l) e seus parâmetros
+
+    filters: tag_id | tag (nome), status, classification, vendedor_id;
+    status e classification aceitam lista. Exige ao menos um filtro.
+    """
+    if not any(filters.get(key) not in (None, "", []) for key in FILTER_KEYS):
+        raise ValueError("Informe ao menos um filtro (tag, status, classification ou vendedor_id)")
+
+    clauses = ["l.phone IS NOT NULL", "l.phone <> ''"]
+    params = []
+
+    def _in(column, value):
+        values = value if isinstance(value, list) else [value]
+        clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+        params.extend(values)
+
+    if filters.get("tag_id"):
+        clauses.append("EXISTS (SELECT 1 FROM lead_tags lt WHERE lt.lead_id = l.id AND lt.tag_id = ?)")
+        params.append(int(filters["tag_id"]))
+    elif filters.get("tag"):
+        clauses.append("""EXISTS (
+            SELECT 1 FROM lead_tags lt JOIN tags t ON t.id = lt.tag_id
+            WHERE lt.lead_id = l.id AND t.name = ?
+        )""")
+        params.append(filters["tag"])
+    if filters.get("status"):
+        _in("l.status", filters["status"])
+    if filters.get("classification"):
+        _in("l.classification", filters["classification"])
+    if filters.get("vendedor_id"):
+        clauses.append("l.assigned_to = ?")
+        params.append(int(filters["vendedor_id"]))
+
+    return " AND ".join(clauses), params
+
+
+class CampaignService:
+    """
+    Criação, disparo e acompanhamento de campanhas
+
+    Usage:
+        campaigns = CampaignService(db, outbound_queue, socket_emitter)
+        outbound_queue.add_status_listener(campaigns.delivery_status)
+        campaign = campaigns.create("Reativação", "Oi {nome}!", {"classification": "cold"}, user)
+    """
+
+    def __init__(self, database, outbound, socketio):
+        self.db = database
+        self.outbound = outbound
+        self.socketio = socketio
+        self.batch_size = int(os.getenv("CAMPAIGN_BATCH_SIZE", "200"))
+
+    # =============================
+    # SEGMENTO
+    # =============================
+    def preview(self, template: str, filters: Dict, limit: int = 5) -> Dict:
+        """Quantos leads o segmento tem e como ficam as primeiras mensagens"""
+        where, params = segment_query(filters)
+        conn = self.db.get_connection()
+        try:
+            total = conn.execute(f"SELECT COUNT(*) FROM leads l WHERE {where}", params).fetchone()[0]
+            sample = conn.execute(
+                f"SELECT l.id, l.name, l.interesse FROM leads l WHERE {where} ORDER BY l.id LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        finally:
+            conn.close()
+
+        return {
+            "total": total,
+            "sample": [
+                {"lead_id": row["id"], "name": row["name"], "content": render_template(template, dict(row))}
+                for row in sample
+            ]
+        }
+
+    # =============================
+    # DISPARO
+    # =============================
+    def create(self, name: str, template: str, filters: Dict, user: Dict) -> Dict:
+        """Registra a campanha e dispara a distribuição em segundo plano"""
+        if not template or not template.strip():
+            raise ValueError("Template vazio")
+        if len(template) > 4096:
+            raise ValueError("Template muito grande (max 4096 caracteres)")
+
+        where, params = segment_query(filters)
+        conn = self.db.get_connection()
+        try:
+            total = conn.execute(f"SELECT COUNT(*) FROM leads l WHERE {where}", params).fetchone()[0]
+            cursor = conn.execute("""
+                INSERT INTO campaigns (name, template, filters, created_by, created_by_name, total)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (name, template, json.dumps(filters, ensure_ascii=False), user.get("id"), user.get("name"), total))
+            conn.commit()
+            campaign_id = cursor.lastrowid
+        finally:
+            conn.close()
+
+        print(f"📣 Campanha {campaign_id} '{name}' criada para {total} leads")
+        threading.Thread(target=self._fan_out, args=(campaign_id,), daemon=True).start()
+        return self.get(campaign_id)
+
+    def resume_pending(self) -> List[int]:
+        """
+        Retoma as distribuições interrompidas (status 'running', fanout_done 0)
+
+        Continua depois do maior lead já gravado; como os lotes ignoram quem
+        já é destinatário, dois processos retomando juntos não duplicam envios.
+        """
+        conn = self.db.get_connection()
+        try:
+            rows = conn.execute("""
+                SELECT c.id, COALESCE(MAX(r.lead_id), 0) AS last_lead_id
+                FROM campaigns c
+                LEFT JOIN campaign_recipients r ON r.campaign_id = c.id
+                WHERE c.status = 'running' AND c.fanout_done = 0
+                GROUP BY c.id
+            """).fetchall()
+        finally:
+            conn.close()
+
+        for row in rows:
+            print(f"📣 Retomando distribuição da campanha {row['id']} (após o lead {row['last_lead_id']})")
+            threading.Thread(target=self._fan_out, args=(row["id"], row["last_lead_id"]), daemon=True).start()
+        return [row["id"] for row in rows]
+
+    def _fan_out(self, campaign_id: int, last_id: int = 0):
+        campaign = self.get(campaign_id)
+        where, params = segment_query(json.loads(campaign["filters"]))
+
+        try:
+            while True:
+                if self.get(campaign_id)["status"] != "running":
+                    print(f"⏹️ Campanha {campaign_id} interrompida")
+                    return
+
+                conn = self.db.get_connection()
+                try:
+                    leads = conn.execute(f"""
+                        SELECT l.id, l.name, l.phone, l.interesse
+                        FROM leads l
+                        WHERE {where} AND l.id > ?
+                        ORDER BY l.id
+                        LIMIT ?
+                    """, params + [last_id, self.batch_size]).fetchall()
+                finally:
+                    conn.close()
+
+                if not leads:
+                    break
+                if not self._write_batch(campaign, [dict(row) for row in leads]):
+                    print(f"⏹️ Campanha {campaign_id} interrompida")
+                    return
+                last_id = leads[-1]["id"]
+                self._emit_progress(self.get(campaign_id))
+
+            conn = self.db.get_connection()
+            try:
+                conn.execute("""
+                    UPDATE campaigns
+                    SET fanout_done = 1, total = queued,
+                        status = CASE WHEN queued = 0 THEN 'completed' ELSE status END,
+                        finished_at = CASE WHEN queued = 0 THEN CURRENT_TIMESTAMP ELSE finished_at END
+                    WHERE id = ?
+                """, (campaign_id,))
+                conn.commit()
+            finally:
+                conn.close()
+
+            campaign = self.get(campaign_id)
+            print(f"📣 Campanha {campaign_id}: {campaign['queued']} mensagens na fila de envio")
+            self._emit_progress(campaign)
+
+        except Exception as e:
+            print(f"❌ Erro na distribuição da campanha {campaign_id}: {e}")
+            conn = self.db.get_connection()
+            try:
+                conn.execute(
+                    "UPDATE campaigns SET status = 'failed', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (campaign_id,)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _write_batch(self, campaign: Dict, leads: List[Dict]) -> bool:
+        """
+        Mensagens + logs + fila de saída + destinatários do lote numa transação
+
+        Returns:
+            False se a campanha já não está rodando (cancelada): nada é gravado
+        """
+        with self.db.transaction() as conn:
+            # Leads que já são destinatários (distribuição retomada) ficam de fora
+            known = {row[0] for row in conn.execute("""
+                SELECT lead_id FROM campaign_recipients
+                WHERE campaign_id = ? AND lead_id IN (SELECT value FROM json_each(?))
+            """, (campaign["id"], json.dumps([lead["id"] for lead in leads])))}
+            items = [
+                {"lead_id": lead["id"], "phone": lead["phone"], "content": render_template(campaign["template"], lead)}
+                for lead in leads if lead["id"] not in known
+            ]
+
+            # Primeira escrita condicionada ao status: com o BEGIN IMMEDIATE,
+            # um cancel() fica antes (lote descartado) ou depois (e vê o lote)
+            cursor = conn.execute("""
+                UPDATE campaigns SET queued = queued + ? WHERE id = ? AND status = 'running'
+            """, (len(items), campaign["id"]))
+            if cursor.rowcount == 0:
+                return False
+            if not items:
+                return True
+
+            rows = conn.execute("""
+                INSERT INTO messages (lead_id, sender_type, sender_name, content, delivery_status)
+                SELECT json_extract(value, '$.lead_id'), 'campanha', ?, json_extract(value, '$.content'), 'queued'
+                FROM json_each(?)
+                RETURNING id, lead_id
+            """, (campaign["name"], json.dumps(items, ensure_ascii=False))).fetchall()
+            message_ids = {row["lead_id"]: row["id"] for row in rows}
+            for item in items:
+                item["message_id"] = message_ids[item["lead_id"]]
+
+            conn.execute("""
+                INSERT INTO lead_logs (lead_id, action, user_name, details)
+                SELECT json_extract(value, '$.lead_id'), 'campanha_enviada', ?, ?
+                FROM json_each(?)
+            """, (campaign["created_by_name"] or "Campanha", f"Campanha: {campaign['name']}"[:100],
+                  json.dumps([{"lead_id": item["lead_id"]} for item in items])))
+
+            outbound_ids = self.outbound.enqueue_batch(conn, items, PRIORITY_CAMPAIGN)
+
+            conn.execute("""
+                INSERT OR IGNORE INTO campaign_recipients (campaign_id, lead_id, message_id, outbound_id)
+                SELECT ?, json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]')
+                FROM json_each(?)
+            """, (campaign["id"], json.dumps([
+                [item["lead_id"], item["message_id"], outbound_ids.get(item["message_id"])] for item in items
+            ])))
+        return True
+
+    # =============================
+    # PROGRESSO
+    # =============================
+    def delivery_status(self, item: Dict):
+        """Listener da fila de saída: conta enviados/falhos da campanha"""
+        if item.get("priority") != PRIORITY_CAMPAIGN or not item.get("message_id"):
+            return
+        # 'unknown' (sem confirmação da ponte) conta como não entregue
+        column = "sent" if item["status"] == "sent" else "failed"
+
+        with self.db.transaction() as conn:
+            row = conn.execute("""
+                UPDATE campaign_recipients SET status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE message_id = ? AND status = 'queued'
+                RETURNING campaign_id
+            """, (item["status"], item["message_id"])).fetchone()
+            if not row:
+                return
+
+            conn.execute(f"UPDATE campaigns SET {column} = {column} + 1 WHERE id = ?", (row["campaign_id"],))
+            conn.execute("""
+                UPDATE campaigns SET status = 'completed', finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running' AND fanout_done = 1 AND sent + failed >= queued
+            """, (row["campaign_id"],))
+
+        self._emit_progress(self.get(row["campaign_id"]))
+
+    def _emit_progress(self, campaign: Optional[Dict]):
+        if campaign:
+            self.socketio.emit("campaign_progress", self.progress(campaign),
+                               room=MANAGER_ROOM, key=("campaign", campaign["id"]))
+
+    @staticmethod
+    def progress(campaign: Dict) -> Dict:
+        done = campaign["sent"] + campaign["failed"]
+        total = campaign["total"] or campaign["queued"]
+        return {
+            "id": campaign["id"],
+            "name": campaign["name"],
+            "status": campaign["status"],
+            "total": total,
+            "queued": campaign["queued"],
+            "sent": campaign["sent"],
+            "failed": campaign["failed"],
+            "cancelled": campaign["cancelled"],
+            "pending": campaign["queued"] - done - campaign["cancelled"],
+            "percent": round(100 * done / total, 1) if total else 100.0,
+            "created_by": campaign["created_by_name"],
+            "created_at": campaign["created_at"],
+            "finished_at": campaign["finished_at"]
+        }
+
+    # =============================
+    # CONSULTA / CANCELAMENTO
+    # =============================
+    def get(self, campaign_id: int) -> Optional[Dict]:
+        conn = self.db.get_connection()
+        try:
+            row = conn.execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+    def list(self, limit: int = 50) -> List[Dict]:
+        conn = self.db.get_connection()
+        try:
+            rows = conn.execute("SELECT * FROM campaigns ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        finally:
+            conn.close()
+        return [self.progress(dict(row)) for row in rows]
+
+    def cancel(self, campaign_id: int) -> Optional[Dict]:
+        """Interrompe a distribuição e tira da fila o que ainda não saiu"""
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute("""
+                UPDATE campaigns SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running'
+            """, (campaign_id,))
+            conn.commit()
+            if cursor.rowcount == 0:
+                return self.get(campaign_id)
+
+            message_ids = [row["message_id"] for row in conn.execute("""
+                SELECT message_id FROM campaign_recipients
+                WHERE campaign_id = ? AND status = 'queued' AND message_id IS NOT NULL
+            """, (campaign_id,)).fetchall()]
+        finally:
+            conn.close()
+
+        cancelled = self.outbound.cancel_messages(message_ids)
+
+        with self.db.transaction() as conn:
+            payload = json.dumps(cancelled)
+            conn.execute("""
+                UPDATE campaign_recipients SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                WHERE campaign_id = ? AND status = 'queued'
+                  AND message_id IN (SELECT value FROM json_each(?))
+            """, (campaign_id, payload))
+            conn.execute("""
+                UPDATE messages SET delivery_status = 'cancelled'
+                WHERE delivery_status = 'queued' AND id IN (SELECT value FROM json_each(?))
+            """, (payload,))
+            conn.execute("UPDATE campaigns SET cancelled = ? WHERE id = ?", (len(cancelled), campaign_id))
+
+        print(f"⏹️ Campanha {campaign_id} cancelada ({len(cancelled)} mensagens retiradas da fila)")
+        campaign = self.get(campaign_id)
+        self._emit_progress(campaign)
+        return campaign
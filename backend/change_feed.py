@@ -0,0 +1,322 @@
+"""
+Feed de mudanças versionado (Socket.IO + GET /api/changes?since=)
+
+Triggers gravam em change_log um delta compacto de cada escrita em leads,
+mensagens, tags de lead e alertas: entidade, id, operação e só os campos
+que mudaram. O id da linha é a versão (AUTOINCREMENT: nunca reutilizada).
+
+Cada worker acompanha a tabela em segundo plano e emite os deltas novos
+para os seus clientes, então escritas feitas por qualquer caminho
+(rotas, webhook, IA) e em qualquer worker chegam a todos. Depois de
+reconectar, o cliente pede o que perdeu a partir da última versão que viu.
+"""
+import os
+import json
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+
+# Campos de leads acompanhados no feed (os que existirem na tabela)
+LEAD_FEED_FIELDS = (
+    "name", "phone", "email", "status", "assigned_to", "priority", "lead_score",
+    "ai_qualified", "qualification_score", "classification", "prioridade", "sentimento",
+    "interesse", "orcamento", "prazo", "updated_at",
+    "last_message_at", "last_inbound_at", "last_outbound_at", "message_count",
+)
+
+# Entidades visíveis só para admin/gestor
+MANAGER_ONLY_ENTITIES = ("alert",)
+
+_INSERT_CHANGE = """
+    INSERT INTO change_log (entity, entity_id, op, lead_id, assigned_to, prev_assigned_to, fields)
+    VALUES ({values})
+"""
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _changed_fields_json(columns):
+    """JSON só com as colunas cujo valor mudou no UPDATE"""
+    selects = " UNION ALL ".join(
+        f"SELECT '{col}' AS k, new.{col} AS v WHERE new.{col} IS NOT old.{col}" for col in columns
+    )
+    return f"(SELECT json_group_object(k, v) FROM ({selects}))"
+
+
+def _all_fields_json(columns, alias="new"):
+    return "json_object(" + ", ".join(f"'{col}', {alias}.{col}" for col in columns) + ")"
+
+
+def _lead_triggers(conn):
+    columns = [col for col in LEAD_FEED_FIELDS if col in set(_columns(conn, "leads"))]
+    changed = " OR ".join(f"old.{col} IS NOT new.{col}" for col in columns)
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS leads_feed_ai AFTER INSERT ON leads BEGIN
+            {_INSERT_CHANGE.format(values=f"'lead', new.id, 'insert', new.id, new.assigned_to, NULL, {_all_fields_json(columns)}")};
+        END""",
+        # WHEN: o upsert do webhook "atualiza" o lead sem mudar nada
+        f"""CREATE TRIGGER IF NOT EXISTS leads_feed_au AFTER UPDATE ON leads WHEN {changed} BEGIN
+            {_INSERT_CHANGE.format(values=f"'lead', new.id, 'update', new.id, new.assigned_to, "
+                                          f"CASE WHEN old.assigned_to IS NOT new.assigned_to THEN old.assigned_to END, "
+                                          f"{_changed_fields_json(columns)}")};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS leads_feed_ad AFTER DELETE ON leads BEGIN
+            {_INSERT_CHANGE.format(values="'lead', old.id, 'delete', old.id, old.assigned_to, NULL, NULL")};
+        END""",
+    ]
+
+
+def _message_triggers(conn):
+    lead_owner = "(SELECT assigned_to FROM leads WHERE id = {alias}.lead_id)"
+    fields = _all_fields_json(["lead_id", "sender_type", "sender_name", "content", "timestamp"])
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS messages_feed_ai AFTER INSERT ON messages BEGIN
+            {_INSERT_CHANGE.format(values=f"'message', new.id, 'insert', new.lead_id, "
+                                          f"{lead_owner.format(alias='new')}, NULL, {fields}")};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS messages_feed_ad AFTER DELETE ON messages BEGIN
+            {_INSERT_CHANGE.format(values=f"'message', old.id, 'delete', old.lead_id, "
+                                          f"{lead_owner.format(alias='old')}, NULL, NULL")};
+        END""",
+    ]
+
+
+def _lead_tag_triggers(conn):
+    lead_owner = "(SELECT assigned_to FROM leads WHERE id = {alias}.lead_id)"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS lead_tags_feed_ai AFTER INSERT ON lead_tags BEGIN
+            {_INSERT_CHANGE.format(values=f"'lead_tag', new.tag_id, 'insert', new.lead_id, "
+                                          f"{lead_owner.format(alias='new')}, NULL, json_object('tag_id', new.tag_id)")};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS lead_tags_feed_ad AFTER DELETE ON lead_tags BEGIN
+            {_INSERT_CHANGE.format(values=f"'lead_tag', old.tag_id, 'delete', old.lead_id, "
+                                          f"{lead_owner.format(alias='old')}, NULL, json_object('tag_id', old.tag_id)")};
+        END""",
+    ]
+
+
+def _alert_triggers(conn):
+    fields = ["alert_type", "severity", "lead_id", "vendedor_id", "title", "resolved"]
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS system_alerts_feed_ai AFTER INSERT ON system_alerts BEGIN
+            {_INSERT_CHANGE.format(values=f"'alert', new.id, 'insert', new.lead_id, new.vendedor_id, NULL, "
+                                          f"{_all_fields_json(fields)}")};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS system_alerts_feed_au AFTER UPDATE OF resolved ON system_alerts
+        WHEN old.resolved IS NOT new.resolved BEGIN
+            {_INSERT_CHANGE.format(values="'alert', new.id, 'update', new.lead_id, new.vendedor_id, NULL, "
+                                          "json_object('resolved', new.resolved, 'resolved_at', new.resolved_at)")};
+        END""",
+    ]
+
+
+FEED_TRIGGERS = {
+    'leads': _lead_triggers,
+    'messages': _message_triggers,
+    'lead_tags': _lead_tag_triggers,
+    'system_alerts': _alert_triggers,
+}
+
+
+def install_change_triggers(conn):
+    """
+    Cria change_log e os triggers das tabelas acompanhadas que já existem
+
+    Idempotente: os módulos que criam tabelas acompanhadas (tags,
+    alertas) chamam de novo depois de criá-las.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER,
+            op TEXT NOT NULL,
+            lead_id INTEGER,
+            assigned_to INTEGER,
+            prev_assigned_to INTEGER,
+            fields TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_created ON change_log(created_at)")
+
+    existing = {
+        row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    }
+    for table, build in FEED_TRIGGERS.items():
+        if table in existing:
+            for statement in build(conn):
+                conn.execute(statement)
+
+
+class ChangeFeed:
+    """
+    Leitura e distribuição do change_log
+
+    - changes_since(): deltas a partir de uma versão, filtrados pelo perfil
+    - start(): tarefa em segundo plano que emite os deltas novos via Socket.IO
+      (evento "changes": {"version", "changes": [...]}) para a sala
+      "gestores" e para a sala do vendedor dono do lead (user_<id>)
+    """
+
+    def __init__(self, database, socketio=None, poll_interval=None, retention_hours=None):
+        self.db = database
+        self.socketio = socketio
+        self.poll_interval = (
+            poll_interval if poll_interval is not None
+            else float(os.getenv("CHANGE_FEED_POLL_INTERVAL", "0.5"))
+        )
+        self.retention_hours = (
+            retention_hours if retention_hours is not None
+            else int(os.getenv("CHANGE_FEED_RETENTION_HOURS", "24"))
+        )
+        self.running = False
+        self._last_version = None
+        self._last_prune = 0.0
+
+    # =============================
+    # LEITURA
+    # =============================
+    @staticmethod
+    def _to_delta(row) -> Dict:
+        return {
+            "version": row["version"],
+            "entity": row["entity"],
+            "id": row["entity_id"],
+            "op": row["op"],
+            "lead_id": row["lead_id"],
+            "fields": json.loads(row["fields"]) if row["fields"] else {},
+            "at": row["created_at"]
+        }
+
+    def latest_version(self, conn=None) -> int:
+        """Última versão gravada (inclusive as já removidas pela retenção)"""
+        own = conn is None
+        conn = conn or self.db.get_connection()
+        try:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+            return row[0] if row else 0
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            if own:
+                conn.close()
+
+    def changes_since(self, since: int, role: str, user_id: Optional[int], limit: int = 500) -> Dict:
+        """
+        Deltas com versão > since visíveis para o usuário
+
+        Returns:
+            {"version", "changes", "has_more", "reset"}: reset=True quando a
+            versão pedida já saiu da retenção (o cliente deve recarregar tudo)
+        """
+        limit = max(1, min(limit, 1000))
+        where = ["version > ?"]
+        params: List = [since]
+        if role not in ("admin", "gestor"):
+            placeholders = ",".join("?" * len(MANAGER_ONLY_ENTITIES))
+            where.append(f"entity NOT IN ({placeholders})")
+            where.append("(assigned_to = ? OR prev_assigned_to = ?)")
+            params.extend(MANAGER_ONLY_ENTITIES)
+            params.extend([user_id, user_id])
+
+        conn = self.db.get_connection()
+        try:
+            latest = self.latest_version(conn)
+            oldest = conn.execute("SELECT MIN(version) FROM change_log").fetchone()[0]
+            reset = since < latest and (oldest is None or since < oldest - 1)
+
+            rows = conn.execute(f"""
+                SELECT * FROM change_log
+                WHERE {' AND '.join(where)}
+                ORDER BY version
+                LIMIT ?
+            """, params + [limit + 1]).fetchall()
+        finally:
+            conn.close()
+
+        has_more = len(rows) > limit
+        changes = [self._to_delta(row) for row in rows[:limit]]
+        # Sem mais páginas, o cliente pode pular direto para a última versão
+        version = changes[-1]["version"] if has_more else max(latest, since)
+        return {"version": version, "changes": changes, "has_more": has_more, "reset": reset}
+
+    # =============================
+    # DISTRIBUIÇÃO (SOCKET.IO)
+    # =============================
+    @staticmethod
+    def rooms_for(row) -> List[str]:
+        """Salas que devem receber o delta"""
+        rooms = ["gestores"]
+        if row["entity"] not in MANAGER_ONLY_ENTITIES:
+            for owner in (row["assigned_to"], row["prev_assigned_to"]):
+                if owner is not None and f"user_{owner}" not in rooms:
+                    rooms.append(f"user_{owner}")
+        return rooms
+
+    def poll_once(self) -> int:
+        """Emite os deltas gravados desde a última chamada; retorna quantos"""
+        if self._last_version is None:
+            # Começa do presente: histórico fica para o changes_since()
+            self._last_version = self.latest_version()
+            return 0
+
+        conn = self.db.get_connection()
+        try:
+            rows = conn.execute(
+                "SELECT * FROM change_log WHERE version > ? ORDER BY version LIMIT 1000",
+                (self._last_version,)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return 0
+
+        by_room: Dict[str, List[Dict]] = {}
+        for row in rows:
+            delta = self._to_delta(row)
+            for room in self.rooms_for(row):
+                by_room.setdefault(room, []).append(delta)
+
+        self._last_version = rows[-1]["version"]
+        for room, changes in by_room.items():
+            self.socketio.emit("changes", {"version": self._last_version, "changes": changes}, room=room)
+        return len(rows)
+
+    def prune(self) -> int:
+        """Remove deltas mais antigos que a retenção"""
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute(
+                "DELETE FROM change_log WHERE created_at < datetime('now', ?)",
+                (f"-{self.retention_hours} hours",)
+            )
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def _loop(self):
+        while self.running:
+            try:
+                self.poll_once()
+                if time.time() - self._last_prune > 600:
+                    self._last_prune = time.time()
+                    self.prune()
+            except Exception as e:
+                print(f"❌ Erro no feed de mudanças: {e}")
+            self.socketio.sleep(self.poll_interval)
+
+    def start(self):
+        """Inicia a emissão em segundo plano (uma por worker)"""
+        if self.running or self.socketio is None:
+            return
+        self.running = True
+        self.socketio.start_background_task(self._loop)
+        print(f"📡 Feed de mudanças ativo (intervalo: {self.poll_interval}s)")
+
+    def stop(self):
+        self.running = False
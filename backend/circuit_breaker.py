@@ -0,0 +1,91 @@
+"""
+Circuit breaker (closed / open / half-open)
+
+- closed: chamadas liberadas; `failure_threshold` falhas seguidas abrem o circuito
+- open: chamadas recusadas na hora (sem esperar timeout) por `reset_timeout` s
+- half-open: depois da espera, uma chamada de teste; sucesso fecha, falha reabre
+"""
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.changed_at = time.time()
+        self.transitions = Counter()
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        self.transitions[f"{self.state}->{state}"] += 1
+        print(f"🔌 Circuito {self.name}: {self.state} → {state}")
+        self.state = state
+        self.changed_at = time.time()
+        if state == self.OPEN:
+            self.opened_at = self.changed_at
+        self._trial_in_flight = False
+
+    def _retry_due(self) -> bool:
+        return self.opened_at is not None and time.time() - self.opened_at >= self.reset_timeout
+
+    def is_open(self) -> bool:
+        """Recusaria uma chamada agora? (não consome a chamada de teste)"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return not self._retry_due()
+            return self.state == self.HALF_OPEN and self._trial_in_flight
+
+    def allow(self) -> bool:
+        """Libera (ou não) uma chamada; no half-open só uma de teste por vez"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if not self._retry_due():
+                    return False
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._transition(self.OPEN)
+                # Reaberto: a espera recomeça
+                self.opened_at = time.time()
+
+    def get_status(self) -> Dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "since": self.changed_at,
+                "retry_in": (
+                    round(max(0, self.opened_at + self.reset_timeout - time.time()), 1)
+                    if self.state == self.OPEN else 0
+                ),
+                "transitions": dict(self.transitions)
+            }
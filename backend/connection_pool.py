@@ -0,0 +1,358 @@
+"""
+Pool de conexões SQLite
+Mantém conexões abertas entre chamadas, com PRAGMAs aplicados uma única vez
+
+Cada get_connection() empresta uma conexão para uso exclusivo da thread;
+o close() a devolve ao pool. Cada thread volta a receber, sempre que
+possível, a mesma conexão que usou por último.
+"""
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Conexão SQLite devolvida ao pool no close()
+
+    O código existente segue o padrão get_connection() → ... → close().
+    Aqui o close() apenas libera a conexão para o pool; o fechamento real
+    fica a cargo do próprio pool (_close_real).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self._created_at = time.monotonic()
+        self._last_used = self._created_at
+
+    def close(self):
+        if self._pool is None:
+            self._close_real()
+        else:
+            self._pool.release(self)
+
+    def _close_real(self):
+        super().close()
+
+
+class TransactionConnection:
+    """
+    Conexão devolvida por get_connection() dentro de uma transaction()
+
+    Compartilha a conexão da transação externa. commit()/rollback()/close()
+    atuam sobre um SAVEPOINT próprio, então os métodos existentes
+    (get_connection → commit → close) continuam corretos e só a transação
+    externa faz o COMMIT de verdade (um único fsync).
+    """
+
+    def __init__(self, conn, savepoint):
+        self._conn = conn
+        self._savepoint = savepoint
+        self._active = False
+        self._begin()
+
+    def _begin(self):
+        self._conn.execute(f"SAVEPOINT {self._savepoint}")
+        self._active = True
+
+    def commit(self):
+        if self._active:
+            self._conn.execute(f"RELEASE {self._savepoint}")
+            # Quem commitou pode continuar usando a conexão
+            self._begin()
+
+    def rollback(self):
+        if self._active:
+            self._conn.execute(f"ROLLBACK TO {self._savepoint}")
+
+    def close(self):
+        # Mesma semântica do close() original: o que não foi commitado é descartado
+        if self._active:
+            self._conn.execute(f"ROLLBACK TO {self._savepoint}")
+            self._conn.execute(f"RELEASE {self._savepoint}")
+            self._active = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class ConnectionPool:
+    """
+    Pool de conexões SQLite com afinidade por thread
+
+    - PRAGMAs (WAL, synchronous, busy_timeout, cache) aplicados na abertura
+    - pool_size: máximo de conexões ociosas mantidas abertas
+    - recycle_seconds: conexões ociosas há mais tempo que isso são fechadas
+    """
+
+    def __init__(self, db_name, pool_size=None, recycle_seconds=None,
+                 busy_timeout_ms=None, cache_size_kb=None, mmap_size=None):
+        self.db_name = db_name
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv("DB_POOL_SIZE", "8"))
+        self.recycle_seconds = (
+            recycle_seconds if recycle_seconds is not None
+            else int(os.getenv("DB_POOL_RECYCLE_SECONDS", "300"))
+        )
+        self.busy_timeout_ms = (
+            busy_timeout_ms if busy_timeout_ms is not None
+            else int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+        )
+        self.cache_size_kb = (
+            cache_size_kb if cache_size_kb is not None
+            else int(os.getenv("DB_CACHE_SIZE_KB", "20000"))
+        )
+        self.mmap_size = mmap_size if mmap_size is not None else int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+
+        self._idle = deque()
+        # Conexões emprestadas não são referenciadas pelo pool: se alguém
+        # esquecer o close(), o GC fecha a conexão (e faz rollback) como antes
+        self._in_use = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+        # Estatísticas
+        self.opened = 0
+        self.closed = 0
+        self.reused = 0
+        self.recycled = 0
+
+    # =============================
+    # ABERTURA / FECHAMENTO
+    # =============================
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            factory=PooledConnection
+        )
+        conn.row_factory = sqlite3.Row  # ← permite acessar colunas por nome
+
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+        conn._pool = self
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn._close_real()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self.closed += 1
+
+    def _check_fork(self):
+        """
+        Conexões SQLite não podem atravessar um fork (gunicorn --preload)
+
+        O processo filho esquece as conexões herdadas (sem fechá-las: o
+        pai continua dono delas) e abre as suas.
+        """
+        if os.getpid() == self._pid:
+            return
+        with self._lock:
+            if os.getpid() == self._pid:
+                return
+            self._pid = os.getpid()
+            for conn in self._idle:
+                conn._pool = None
+            self._idle = deque()
+            self._in_use = weakref.WeakSet()
+        self._local = threading.local()
+
+    def _is_stale(self, conn, now):
+        return self.recycle_seconds > 0 and now - conn._last_used > self.recycle_seconds
+
+    # =============================
+    # AQUISIÇÃO / LIBERAÇÃO
+    # =============================
+    def acquire(self):
+        """
+        Retira uma conexão do pool para uso exclusivo da thread
+
+        Preferência pela última conexão que a própria thread devolveu
+        (cache de páginas já aquecido); depois a ociosa mais recente.
+        Dentro de transaction(), devolve a conexão da transação.
+        """
+        self._check_fork()
+
+        tx_conn = getattr(self._local, "tx_conn", None)
+        if tx_conn is not None:
+            return TransactionConnection(tx_conn, self._next_savepoint())
+
+        now = time.monotonic()
+        preferred_ref = getattr(self._local, "last_conn", None)
+        preferred = preferred_ref() if preferred_ref is not None else None
+        stale = []
+        conn = None
+
+        with self._lock:
+            if preferred is not None and preferred in self._idle:
+                self._idle.remove(preferred)
+                if self._is_stale(preferred, now):
+                    stale.append(preferred)
+                else:
+                    conn = preferred
+
+            while conn is None and self._idle:
+                candidate = self._idle.pop()  # LIFO: a conexão mais "quente" primeiro
+                if self._is_stale(candidate, now):
+                    stale.append(candidate)
+                    continue
+                conn = candidate
+
+            if conn is not None:
+                self.reused += 1
+            self.recycled += len(stale)
+
+        for old in stale:
+            self._discard(old)
+
+        if conn is None:
+            conn = self._open()
+
+        with self._lock:
+            self._in_use.add(conn)
+        self._local.last_conn = weakref.ref(conn)
+        return conn
+
+    def release(self, conn):
+        """Chamado pelo close() da conexão"""
+        with self._lock:
+            if conn not in self._in_use:
+                # close() duplicado: a conexão já está no pool
+                return
+            self._in_use.discard(conn)
+
+        # Mesma semântica do close() original: o que não foi commitado é descartado
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        conn._last_used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def _next_savepoint(self):
+        self._local.savepoints = getattr(self._local, "savepoints", 0) + 1
+        return f"sp_{self._local.savepoints}"
+
+    # =============================
+    # UNIDADE DE TRABALHO
+    # =============================
+    @contextmanager
+    def transaction(self):
+        """
+        Agrupa todas as escritas da thread numa única transação
+
+        Toda chamada a get_connection() feita dentro do bloco (na mesma
+        thread) usa esta transação. COMMIT no fim do bloco; ROLLBACK se
+        sair com exceção. Transações aninhadas viram SAVEPOINTs.
+
+        Usage:
+            with db.transaction():
+                lead = db.create_or_get_lead(phone, name)
+                db.add_message(lead["id"], "lead", name, content)
+        """
+        if getattr(self._local, "tx_conn", None) is not None:
+            nested = self.acquire()
+            try:
+                yield nested
+            except BaseException:
+                nested.rollback()
+                raise
+            else:
+                nested.commit()
+            finally:
+                nested.close()
+            return
+
+        conn = self.acquire()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.tx_conn = conn
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        finally:
+            self._local.tx_conn = None
+            self._local.savepoints = 0
+            conn.close()
+
+    def close_all(self):
+        """Fecha todas as conexões ociosas"""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+    def get_stats(self):
+        """Retorna estatísticas do pool"""
+        with self._lock:
+            return {
+                "db_name": self.db_name,
+                "pool_size": self.pool_size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "opened": self.opened,
+                "closed": self.closed,
+                "reused": self.reused,
+                "recycled": self.recycled,
+                "recycle_seconds": self.recycle_seconds
+            }
+
+
+# =============================
+# REGISTRO GLOBAL (um pool por arquivo de banco)
+# =============================
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_name, **kwargs):
+    """
+    Retorna o pool do arquivo de banco, criando se necessário
+
+    Várias instâncias de Database() apontando para o mesmo arquivo
+    compartilham o mesmo pool.
+    """
+    key = os.path.abspath(db_name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_name, **kwargs)
+            _pools[key] = pool
+        return pool
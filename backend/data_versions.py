@@ -0,0 +1,113 @@
+"""
+Versões de dados por escopo (leads, messages, tags, alerts, sla, users)
+
+Cada escrita numa tabela do escopo incrementa o contador do escopo por
+trigger, então qualquer caminho de escrita (rotas, webhook, IA, serviços
+em segundo plano) e qualquer worker enxergam a mesma versão. As ETags das
+rotas de leitura são derivadas desses contadores.
+"""
+import sqlite3
+from typing import Dict, Iterable
+
+
+# Tabela → escopo cuja versão muda quando a tabela é escrita
+VERSIONED_TABLES = {
+    'leads': 'leads',
+    'messages': 'messages',
+    'tags': 'tags',
+    'lead_tags': 'tags',
+    'system_alerts': 'alerts',
+    'lead_sla': 'sla',
+    'users': 'users',
+}
+
+SCOPES = sorted(set(VERSIONED_TABLES.values()))
+
+
+def install_version_triggers(conn):
+    """
+    Cria a tabela de versões e os triggers das tabelas versionadas que já existem
+
+    Idempotente: os módulos que criam tabelas versionadas (tags/SLA,
+    alertas) chamam de novo depois de criá-las, e migrações que adicionam
+    colunas a essas tabelas também (ver _install_update_trigger).
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    conn.executemany(
+        "INSERT OR IGNORE INTO data_versions (scope, version) VALUES (?, 0)",
+        [(scope,) for scope in SCOPES]
+    )
+
+    existing = {
+        row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    }
+    for table, scope in VERSIONED_TABLES.items():
+        if table not in existing:
+            continue
+        for suffix, event in (("ai", "INSERT"), ("ad", "DELETE")):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{suffix} AFTER {event} ON {table} BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE scope = '{scope}';
+                END
+            """)
+        _install_update_trigger(conn, table, scope)
+
+
+def _install_update_trigger(conn, table, scope):
+    """
+    UPDATE só conta quando alguma coluna mudou de fato (o upsert do webhook
+    "atualiza" o lead sem mudar nada)
+
+    O WHEN lista as colunas atuais da tabela: se a tabela ganhou colunas
+    desde a criação do trigger, ele é recriado.
+    """
+    name = f"{table}_version_au"
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    changed = " OR ".join(f"old.{col} IS NOT new.{col}" for col in columns)
+    sql = (
+        f"CREATE TRIGGER {name} AFTER UPDATE ON {table} WHEN {changed} BEGIN "
+        f"UPDATE data_versions SET version = version + 1 WHERE scope = '{scope}'; END"
+    )
+    current = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)
+    ).fetchone()
+    if current is not None and current[0] == sql:
+        return
+    conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    conn.execute(sql)
+
+
+class DataVersions:
+    """Leitura dos contadores de versão por escopo"""
+
+    def __init__(self, database):
+        self.db = database
+
+    def get(self, scopes: Iterable[str]) -> Dict[str, int]:
+        """Versão atual de cada escopo (0 se ainda não houve escrita)"""
+        scopes = list(scopes)
+        conn = self.db.get_connection()
+        try:
+            placeholders = ",".join("?" * len(scopes))
+            rows = conn.execute(
+                f"SELECT scope, version FROM data_versions WHERE scope IN ({placeholders})", scopes
+            ).fetchall()
+        except sqlite3.OperationalError:
+            # Banco ainda sem a migração
+            rows = []
+        finally:
+            conn.close()
+
+        versions = {scope: 0 for scope in scopes}
+        versions.update({row['scope']: row['version'] for row in rows})
+        return versions
+
+    def token(self, *scopes: str) -> str:
+        """Versões dos escopos numa string curta ("leads=12.tags=3")"""
+        versions = self.get(scopes)
+        return ".".join(f"{scope}={versions[scope]}" for scope in sorted(versions))
@@ -1,17 +1,38 @@
 import sqlite3
 import bcrypt
+import json
 import hashlib  # Manter temporariamente para migração de hashes antigos
+import threading
+from connection_pool import get_pool
+from migrations import apply_migrations
+from utils import normalize_phone
 
 class Database:
     def __init__(self, db_name="../crm.db"):
 
         self.db_name = db_name
+        self.pool = get_pool(db_name)
+        # Diretório de usuários em memória (ver get_user)
+        self._user_directory = None
+        self._user_directory_version = None
+        self._user_directory_lock = threading.Lock()
         self.init_db()
 
     def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row  # ← permite acessar colunas por nome
-        return conn
+        """Conexão do pool (close() devolve ao pool em vez de fechar)"""
+        return self.pool.acquire()
+
+    def transaction(self):
+        """
+        Unidade de trabalho: todas as escritas feitas pelos métodos do
+        Database dentro do bloco viram uma única transação (um commit)
+
+        Usage:
+            with db.transaction():
+                db.add_message(...)
+                db.add_lead_log(...)
+        """
+        return self.pool.transaction()
 
     # =======================
     # INICIALIZAÇÃO
@@ -142,6 +163,9 @@ class Database:
 
         conn.commit()
 
+        # Índices e ajustes versionados (ver migrations.py)
+        apply_migrations(self)
+
         # Usuário admin padrão
         c.execute("SELECT * FROM users WHERE username = 'admin'")
         if not c.fetchone():
@@ -214,6 +238,7 @@ class Database:
             conn.commit()
             uid = c.lastrowid
             conn.close()
+            self.invalidate_user_directory()
             return uid
         except sqlite3.IntegrityError:
             return None
@@ -232,6 +257,7 @@ class Database:
         c.execute("UPDATE users SET name = ?, role = ?, active = ? WHERE id = ?", (name, role, active, user_id))
         conn.commit()
         conn.close()
+        self.invalidate_user_directory()
 
     def delete_user(self, user_id):
         conn = self.get_connection()
@@ -239,6 +265,39 @@ class Database:
         c.execute("UPDATE users SET active = 0 WHERE id = ?", (user_id,))
         conn.commit()
         conn.close()
+        self.invalidate_user_directory()
+
+    def _users_version(self, conn):
+        try:
+            row = conn.execute("SELECT version FROM data_versions WHERE scope = 'users'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row["version"] if row else None
+
+    def get_user(self, user_id):
+        """
+        Usuário por id (sem senha), pelo diretório em memória
+
+        O diretório é recarregado quando create_user/update_user/delete_user
+        o invalidam ou quando a versão 'users' (data_versions) muda, o que
+        cobre escritas de outros processos.
+        """
+        conn = self.get_connection()
+        try:
+            version = self._users_version(conn)
+            with self._user_directory_lock:
+                if self._user_directory is None or version != self._user_directory_version:
+                    rows = conn.execute("SELECT id, username, name, role, active FROM users").fetchall()
+                    self._user_directory = {row["id"]: dict(row) for row in rows}
+                    self._user_directory_version = version
+                user = self._user_directory.get(user_id)
+        finally:
+            conn.close()
+        return dict(user) if user else None
+
+    def invalidate_user_directory(self):
+        with self._user_directory_lock:
+            self._user_directory = None
 
     def change_user_password(self, user_id, new_password):
         conn = self.get_connection()
@@ -251,32 +310,41 @@ class Database:
     # LEADS
     # =======================
     def create_or_get_lead(self, phone, name="Lead Desconhecido"):
-        """Cria lead se não existir, ou retorna existente"""
+        """
+        Cria lead se não existir, ou retorna existente
+
+        Lead conhecido (o caso comum no webhook): só um SELECT pelo índice
+        UNIQUE de leads.phone, sem escrita. Senão INSERT ... ON CONFLICT DO
+        NOTHING RETURNING; se outro webhook do mesmo número inseriu antes,
+        o RETURNING vem vazio e o lead é lido de novo. Nunca gera leads
+        duplicados nem consome ids do AUTOINCREMENT à toa.
+        """
+        conn = None
         try:
+            phone = normalize_phone(phone)
+            if not phone:
+                print("⚠️ Telefone vazio, lead não criado")
+                return None
+
             conn = self.get_connection()
             c = conn.cursor()
-            phone = str(phone).replace("+", "").replace(" ", "").replace("-", "").replace("@c.us", "")
-
-            # Verifica se já existe
             c.execute("SELECT * FROM leads WHERE phone = ?", (phone,))
             lead = c.fetchone()
             if lead:
-                print(f"ℹ️ Lead existente encontrado: {lead['name']} ({phone})")
-                conn.close()
                 return dict(lead)
 
-            # Cria novo lead
             c.execute("""
                 INSERT INTO leads (name, phone, status, created_at)
                 VALUES (?, ?, 'novo', datetime('now'))
+                ON CONFLICT(phone) DO NOTHING
+                RETURNING *
             """, (name, phone))
+            lead = c.fetchone()
             conn.commit()
-
-            c.execute("SELECT * FROM leads WHERE phone = ?", (phone,))
-            new_lead = c.fetchone()
-            conn.close()
-            print(f"🆕 Lead criado: {name} ({phone})")
-            return dict(new_lead)
+            if lead is None:
+                c.execute("SELECT * FROM leads WHERE phone = ?", (phone,))
+                lead = c.fetchone()
+            return dict(lead)
 
         except Exception as e:
             print(f"❌ Erro ao criar/obter lead: {e}")
@@ -284,6 +352,11 @@ class Database:
             traceback.print_exc()
             return None
 
+        finally:
+            # Dentro de transaction(): desfaz e libera o SAVEPOINT mesmo com erro
+            if conn is not None:
+                conn.close()
+
     def get_lead(self, lead_id):
         conn = self.get_connection()
         c = conn.cursor()
@@ -296,7 +369,7 @@ class Database:
         """Busca lead por número de telefone"""
         try:
             # Normaliza o telefone
-            phone_clean = str(phone).replace("+", "").replace(" ", "").replace("-", "").replace("@c.us", "")
+            phone_clean = normalize_phone(phone)
             
             conn = self.get_connection()
             c = conn.cursor()
@@ -324,6 +397,57 @@ class Database:
         conn.close()
         return leads
 
+    def get_leads_page(self, assigned_to=None, after=None, limit=50):
+        """
+        Página de leads por keyset em (updated_at, id), mais recentes primeiro
+
+        Args:
+            assigned_to: só leads do vendedor (None = todos)
+            after: (updated_at, id) do último lead da página anterior
+            limit: quantidade de linhas
+        """
+        where = []
+        params = []
+
+        if assigned_to is not None:
+            where.append("l.assigned_to = ?")
+            params.append(assigned_to)
+
+        if after is not None:
+            where.append("(l.updated_at, l.id) < (?, ?)")
+            params.extend(after)
+
+        where_clause = f"WHERE {' AND '.join(where)}" if where else ""
+
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT 
+                l.*,
+                u.name as assigned_to_name,
+                u.username as assigned_to_username
+            FROM leads l
+            LEFT JOIN users u ON l.assigned_to = u.id
+            {where_clause}
+            ORDER BY l.updated_at DESC, l.id DESC
+            LIMIT ?
+        """, params + [limit])
+        leads = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return leads
+
+    def count_leads(self, assigned_to=None):
+        """Total de leads (do vendedor, se informado)"""
+        conn = self.get_connection()
+        c = conn.cursor()
+        if assigned_to is not None:
+            c.execute("SELECT COUNT(*) FROM leads WHERE assigned_to = ?", (assigned_to,))
+        else:
+            c.execute("SELECT COUNT(*) FROM leads")
+        total = c.fetchone()[0]
+        conn.close()
+        return total
+
     def get_leads_by_vendedor(self, user_id):
         """Retorna leads atribuídos a um vendedor específico"""
         conn = self.get_connection()
@@ -379,13 +503,54 @@ class Database:
     # =======================
     # MENSAGENS / LOGS / NOTAS
     # =======================
-    def add_message(self, lead_id, sender_type, sender_name, content):
+    def add_message(self, lead_id, sender_type, sender_name, content, delivery_status=None):
         conn = self.get_connection()
         c = conn.cursor()
         c.execute("""
-            INSERT INTO messages (lead_id, sender_type, sender_name, content)
-            VALUES (?, ?, ?, ?)
-        """, (lead_id, sender_type, sender_name, content))
+            INSERT INTO messages (lead_id, sender_type, sender_name, content, delivery_status)
+            VALUES (?, ?, ?, ?, ?)
+        """, (lead_id, sender_type, sender_name, content, delivery_status))
+        conn.commit()
+        message_id = c.lastrowid
+        conn.close()
+        return message_id
+
+    def record_inbound_message(self, phone, name, content, dedup_key=None, outbox_id=None):
+        """
+        Registra mensagem recebida de um lead numa única transação:
+        upsert do lead + mensagem + log na timeline
+
+        dedup_key: chave do evento do webhook; a mensagem gravada fica
+        associada a ela
+        outbox_id: evento da fila de webhooks; guarda o message_id para que
+        uma nova tentativa não grave a mensagem de novo
+
+        Returns:
+            (lead, message_id) ou (None, None) se o lead não pôde ser criado
+        """
+        with self.transaction() as conn:
+            lead = self.create_or_get_lead(phone, name)
+            if not lead:
+                return None, None
+
+            message_id = self.add_message(lead["id"], "lead", name, content)
+            self.add_lead_log(lead["id"], "mensagem_recebida", name, content[:100])
+
+            if dedup_key is not None:
+                conn.execute(
+                    "UPDATE webhook_dedup_keys SET message_id = ? WHERE dedup_key = ?",
+                    (message_id, dedup_key)
+                )
+            if outbox_id is not None:
+                conn.execute("UPDATE webhook_outbox SET message_id = ? WHERE id = ?", (message_id, outbox_id))
+
+        return lead, message_id
+
+    def set_delivery_status(self, message_id, status):
+        """Status de entrega de uma mensagem enviada (queued, sent, failed)"""
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute("UPDATE messages SET delivery_status = ? WHERE id = ?", (status, message_id))
         conn.commit()
         conn.close()
 
@@ -397,6 +562,35 @@ class Database:
         conn.close()
         return msgs
 
+    def get_messages_page(self, lead_id, before_id=None, limit=50):
+        """
+        Página de mensagens do lead por keyset em id, mais recentes primeiro
+
+        before_id: id da mensagem mais antiga já entregue (None = últimas)
+        """
+        conn = self.get_connection()
+        c = conn.cursor()
+        if before_id is not None:
+            c.execute("""
+                SELECT * FROM messages
+                WHERE lead_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (lead_id, before_id, limit))
+        else:
+            c.execute("SELECT * FROM messages WHERE lead_id = ? ORDER BY id DESC LIMIT ?", (lead_id, limit))
+        msgs = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return msgs
+
+    def count_messages_by_lead(self, lead_id):
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM messages WHERE lead_id = ?", (lead_id,))
+        total = c.fetchone()[0]
+        conn.close()
+        return total
+
     def add_internal_note(self, lead_id, user_id, note):
         conn = self.get_connection()
         c = conn.cursor()
@@ -437,6 +631,31 @@ class Database:
         conn.close()
         return logs
 
+    def get_lead_logs_page(self, lead_id, before_id=None, limit=50):
+        """Página do histórico do lead por keyset em id, mais recentes primeiro"""
+        conn = self.get_connection()
+        c = conn.cursor()
+        if before_id is not None:
+            c.execute("""
+                SELECT * FROM lead_logs
+                WHERE lead_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (lead_id, before_id, limit))
+        else:
+            c.execute("SELECT * FROM lead_logs WHERE lead_id = ? ORDER BY id DESC LIMIT ?", (lead_id, limit))
+        logs = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return logs
+
+    def count_lead_logs(self, lead_id):
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM lead_logs WHERE lead_id = ?", (lead_id,))
+        total = c.fetchone()[0]
+        conn.close()
+        return total
+
     # =======================
     # LOGS DE AUDITORIA
     # =======================
@@ -466,6 +685,36 @@ class Database:
         conn.close()
         return logs
 
+    def get_audit_logs_page(self, before_id=None, limit=50):
+        """Página dos logs de auditoria por keyset em id, mais recentes primeiro"""
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT a.*, u.name as user_name
+            FROM audit_log a
+            LEFT JOIN users u ON a.user_id = u.id
+            {"WHERE a.id < ?" if before_id is not None else ""}
+            ORDER BY a.id DESC
+            LIMIT ?
+        """, ([before_id] if before_id is not None else []) + [limit])
+        logs = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return logs
+
+    def estimate_audit_log_count(self):
+        """
+        Estimativa do total de logs de auditoria
+
+        audit_log só recebe INSERTs, então o maior id (busca direta na
+        B-tree) é uma boa aproximação sem varrer a tabela.
+        """
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute("SELECT MAX(id) FROM audit_log")
+        total = c.fetchone()[0] or 0
+        conn.close()
+        return total
+
     # =======================
     # TAGS (para extensão)
     # =======================
@@ -486,6 +735,30 @@ class Database:
             # Tabela de tags ainda não existe
             return []
 
+    def get_tags_for_leads(self, lead_ids):
+        """Retorna {lead_id: [tags]} de vários leads numa única consulta"""
+        lead_ids = list({int(lead_id) for lead_id in lead_ids})
+        tags_by_lead = {lead_id: [] for lead_id in lead_ids}
+        if not lead_ids:
+            return tags_by_lead
+
+        try:
+            conn = self.get_connection()
+            c = conn.cursor()
+            c.execute("""
+                SELECT lt.lead_id AS _lead_id, t.* FROM tags t
+                INNER JOIN lead_tags lt ON t.id = lt.tag_id
+                WHERE lt.lead_id IN (SELECT value FROM json_each(?))
+            """, (json.dumps(lead_ids),))
+            for row in c.fetchall():
+                tag = dict(row)
+                tags_by_lead[tag.pop('_lead_id')].append(tag)
+            conn.close()
+        except sqlite3.OperationalError:
+            # Tabela de tags ainda não existe
+            pass
+        return tags_by_lead
+
     # =======================
     # ✨ MÉTODOS DA IA v2.0
     # =======================
@@ -584,16 +857,14 @@ class Database:
     # MÉTRICAS
     # =======================
     def get_metrics_summary(self):
-        conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM leads")
-        total = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM leads WHERE status = 'ganho'")
-        ganhos = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM leads WHERE status = 'perdido'")
-        perdidos = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM leads WHERE status = 'em_atendimento'")
-        ativos = c.fetchone()[0]
+        from metrics_rollup import MetricsRollup
+
+        # Totais por status lidos dos rollups (sem varrer leads)
+        totals = MetricsRollup(self).get_status_totals()
+        total = sum(totals.values())
+        ganhos = totals.get("ganho", 0)
+        perdidos = totals.get("perdido", 0)
+        ativos = totals.get("em_atendimento", 0)
 
         funil = {
             "novo": total - ganhos - perdidos - ativos,
@@ -602,7 +873,6 @@ class Database:
             "perdido": perdidos
         }
 
-        conn.close()
         return {
             "total_leads": total,
             "leads_ganhos": ganhos,
@@ -8,22 +8,31 @@ import sqlite3
 from datetime import datetime, timedelta
 import json
 
+from connection_pool import get_pool
+from data_versions import install_version_triggers
+from change_feed import install_change_triggers
+
 
 class DatabaseTagsSLA:
     """
     Extensão para adicionar Tags e SLA Tracking ao banco existente
     """
     
-    def __init__(self, db_name="crm_whatsapp.db"):
+    def __init__(self, db_name="crm_whatsapp.db", pool=None):
         self.db_name = db_name
+        self.pool = pool or get_pool(db_name)
         self.init_tags_sla_tables()
     
+    def get_connection(self):
+        """Conexão do pool compartilhado com o Database"""
+        return self.pool.acquire()
+    
     # =============================
     # INICIALIZAÇÃO DAS TABELAS
     # =============================
     def init_tags_sla_tables(self):
         """Cria tabelas de Tags e SLA"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         # Tabela de Tags disponíveis
@@ -78,6 +87,10 @@ class DatabaseTagsSLA:
         # Inserir tags padrão se não existirem
         self._insert_default_tags(cursor)
         
+        # ETags e feed de mudanças: triggers das tabelas recém-criadas
+        install_version_triggers(conn)
+        install_change_triggers(conn)
+        
         conn.commit()
         conn.close()
         
@@ -112,8 +125,7 @@ class DatabaseTagsSLA:
     # =============================
     def get_all_tags(self):
         """Retorna todas as tags disponíveis"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -130,7 +142,7 @@ class DatabaseTagsSLA:
     
     def create_tag(self, name, color, icon="", description=""):
         """Cria uma nova tag"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         try:
@@ -148,8 +160,7 @@ class DatabaseTagsSLA:
     
     def get_lead_tags(self, lead_id):
         """Retorna todas as tags de um lead"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -165,9 +176,41 @@ class DatabaseTagsSLA:
         conn.close()
         return tags
     
+    def get_tags_for_leads(self, lead_ids):
+        """
+        Retorna as tags de vários leads numa única consulta
+
+        Returns:
+            Dict[int, List[dict]]: lead_id → tags (todo lead_id pedido tem uma lista)
+        """
+        lead_ids = list({int(lead_id) for lead_id in lead_ids})
+        tags_by_lead = {lead_id: [] for lead_id in lead_ids}
+        if not lead_ids:
+            return tags_by_lead
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        # json_each: um único parâmetro, sem limite de variáveis do SQLite
+        cursor.execute("""
+            SELECT lt.lead_id AS _lead_id, t.*, lt.added_at, u.name as added_by_name
+            FROM lead_tags lt
+            JOIN tags t ON t.id = lt.tag_id
+            LEFT JOIN users u ON lt.added_by = u.id
+            WHERE lt.lead_id IN (SELECT value FROM json_each(?))
+            ORDER BY lt.lead_id, lt.added_at DESC
+        """, (json.dumps(lead_ids),))
+
+        for row in cursor.fetchall():
+            tag = dict(row)
+            tags_by_lead[tag.pop('_lead_id')].append(tag)
+
+        conn.close()
+        return tags_by_lead
+    
     def add_tag_to_lead(self, lead_id, tag_id, user_id=None):
         """Adiciona uma tag a um lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         try:
@@ -184,7 +227,7 @@ class DatabaseTagsSLA:
     
     def remove_tag_from_lead(self, lead_id, tag_id):
         """Remove uma tag de um lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -198,8 +241,7 @@ class DatabaseTagsSLA:
     
     def get_leads_by_tag(self, tag_id):
         """Retorna todos os leads com uma tag específica"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -219,7 +261,7 @@ class DatabaseTagsSLA:
     # =============================
     def init_lead_sla(self, lead_id):
         """Inicializa SLA para um novo lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         now = datetime.now().isoformat()
@@ -235,7 +277,7 @@ class DatabaseTagsSLA:
     
     def record_first_response(self, lead_id):
         """Registra a primeira resposta ao lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         now = datetime.now()
@@ -272,7 +314,7 @@ class DatabaseTagsSLA:
     
     def update_lead_interaction(self, lead_id, response_time_seconds=None):
         """Atualiza métricas de interação do lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         now = datetime.now().isoformat()
@@ -300,8 +342,7 @@ class DatabaseTagsSLA:
     
     def get_lead_sla(self, lead_id):
         """Retorna métricas de SLA de um lead"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -316,8 +357,7 @@ class DatabaseTagsSLA:
     
     def get_sla_metrics(self):
         """Retorna métricas gerais de SLA"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -348,8 +388,7 @@ class DatabaseTagsSLA:
     
     def get_leads_with_sla_alert(self, threshold_minutes=5):
         """Retorna leads que estouraram o SLA"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         threshold_seconds = threshold_minutes * 60
@@ -400,12 +439,13 @@ def extend_database_with_tags_sla(database_instance):
         extend_database_with_tags_sla(db)
         # Agora db tem todos os métodos de tags e SLA
     """
-    tags_sla = DatabaseTagsSLA(database_instance.db_name)
+    tags_sla = DatabaseTagsSLA(database_instance.db_name, pool=database_instance.pool)
     
     # Adiciona métodos ao objeto database
     database_instance.get_all_tags = tags_sla.get_all_tags
     database_instance.create_tag = tags_sla.create_tag
     database_instance.get_lead_tags = tags_sla.get_lead_tags
+    database_instance.get_tags_for_leads = tags_sla.get_tags_for_leads
     database_instance.add_tag_to_lead = tags_sla.add_tag_to_lead
     database_instance.remove_tag_from_lead = tags_sla.remove_tag_from_lead
     database_instance.get_leads_by_tag = tags_sla.get_leads_by_tag
@@ -0,0 +1,130 @@
+"""
+Buffer de emissões Socket.IO
+
+As threads das requisições só enfileiram; uma tarefa em segundo plano
+junta os eventos de cada destino (sala ou lista de salas) durante uma
+janela curta (EMIT_BUFFER_WINDOW_MS, padrão 75 ms) e envia um único frame
+"batch" por destino:
+
+    {"events": [{"event": "notification", "data": {...}}, ...]}
+
+Destino com um só evento recebe o evento normal, sem "batch". Eventos com
+a mesma chave (entidade, id) no mesmo destino e janela são deduplicados:
+fica o último, na posição do primeiro.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class EmitBuffer:
+    """
+    Mesma interface de socketio.emit(event, data, room=...), mais key=
+
+    Usage:
+        emitter = EmitBuffer(socketio)
+        emitter.start()
+        emitter.emit("lead_status_changed", {...}, room=["gestores", "user_7"], key=("lead", 42))
+    """
+
+    def __init__(self, socketio, window_ms: Optional[int] = None):
+        self.socketio = socketio
+        self.window = (
+            window_ms if window_ms is not None
+            else int(os.getenv("EMIT_BUFFER_WINDOW_MS", "75"))
+        ) / 1000
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # destino → OrderedDict(chave → (evento, dados))
+        self._pending: Dict[Any, OrderedDict] = {}
+        self._seq = 0
+        self.running = False
+
+        # Estatísticas
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.frames = 0
+
+    @staticmethod
+    def _destination(room):
+        if isinstance(room, (list, tuple, set)):
+            return tuple(sorted(room))
+        return room
+
+    def emit(self, event: str, data: Any, room=None, key: Optional[Hashable] = None):
+        """Enfileira o evento (não bloqueia a requisição)"""
+        if not self.running or self.window <= 0:
+            self.socketio.emit(event, data, room=room)
+            with self._lock:
+                self.enqueued += 1
+                self.frames += 1
+            return
+
+        destination = self._destination(room)
+        with self._lock:
+            pending = self._pending.setdefault(destination, OrderedDict())
+            if key is None:
+                self._seq += 1
+                slot = ("_seq", self._seq)
+            else:
+                slot = (event, key)
+                if slot in pending:
+                    self.deduplicated += 1
+            pending[slot] = (event, data)
+            self.enqueued += 1
+        self._wake.set()
+
+    def flush(self) -> int:
+        """Envia tudo o que está pendente; retorna quantos frames"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._wake.clear()
+
+        for destination, events in pending.items():
+            room = list(destination) if isinstance(destination, tuple) else destination
+            items = list(events.values())
+            if len(items) == 1:
+                event, data = items[0]
+                self.socketio.emit(event, data, room=room)
+            else:
+                self.socketio.emit("batch", {
+                    "events": [{"event": event, "data": data} for event, data in items]
+                }, room=room)
+
+        with self._lock:
+            self.frames += len(pending)
+        return len(pending)
+
+    def _loop(self):
+        while self.running:
+            if not self._wake.wait(timeout=1):
+                continue
+            # Janela de agrupamento: o que chegar até aqui sai no mesmo frame
+            self.socketio.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Erro ao enviar eventos Socket.IO: {e}")
+
+    def start(self):
+        """Inicia a tarefa de envio (uma por worker)"""
+        if self.running or self.window <= 0:
+            return
+        self.running = True
+        self.socketio.start_background_task(self._loop)
+        print(f"📦 Buffer de eventos Socket.IO ativo (janela: {int(self.window * 1000)} ms)")
+
+    def stop(self):
+        self.running = False
+        self.flush()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "deduplicated": self.deduplicated,
+                "frames": self.frames,
+                "pending": sum(len(events) for events in self._pending.values()),
+                "window_ms": int(self.window * 1000)
+            }
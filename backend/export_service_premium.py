@@ -17,12 +17,15 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment
 
+from metrics_rollup import MetricsRollup
+
 
 class ExportServicePremium:
     """Serviço de exportação com gráficos visuais"""
     
     def __init__(self, database):
         self.db = database
+        self.rollup = MetricsRollup(database)
         self.colors = {
             'primary': '#00a884',
             'secondary': '#667eea',
@@ -264,9 +267,7 @@ class ExportServicePremium:
         return buffer
     
     def _get_metrics_data(self, period, vendedor_id):
-        """Busca métricas do banco"""
-        conn = self.db.get_connection()
-        c = conn.cursor()
+        """Busca métricas dos rollups (metrics_rollup.py)"""
         now = datetime.now()
         if period == 'day':
             start_date = now - timedelta(days=1)
@@ -274,21 +275,17 @@ class ExportServicePremium:
             start_date = now - timedelta(days=7)
         else:
             start_date = now - timedelta(days=30)
-        where = 'WHERE l.created_at >= ?'
-        params = [start_date.strftime('%Y-%m-%d')]
-        if vendedor_id:
-            where += ' AND l.assigned_to = ?'
-            params.append(vendedor_id)
-        c.execute(f'SELECT COUNT(*) as total FROM leads l {where}', params)
-        total_leads = c.fetchone()['total']
-        c.execute(f"SELECT SUM(CASE WHEN status = 'novo' THEN 1 ELSE 0 END) as novo, SUM(CASE WHEN status = 'em_atendimento' THEN 1 ELSE 0 END) as em_atendimento, SUM(CASE WHEN status = 'qualificado' THEN 1 ELSE 0 END) as qualificado, SUM(CASE WHEN status = 'ganho' THEN 1 ELSE 0 END) as ganho, SUM(CASE WHEN status = 'perdido' THEN 1 ELSE 0 END) as perdido FROM leads l {where}", params)
-        funil = dict(c.fetchone())
-        leads_ganhos = funil['ganho']
-        taxa_conversao = round((leads_ganhos / total_leads * 100) if total_leads > 0 else 0, 1)
-        c.execute(f"SELECT u.name, COUNT(l.id) as total, SUM(CASE WHEN l.status='ganho' THEN 1 ELSE 0 END) as ganhos, ROUND(SUM(CASE WHEN l.status='ganho' THEN 1.0 ELSE 0 END) / COUNT(l.id) * 100, 1) as taxa FROM leads l INNER JOIN users u ON l.assigned_to = u.id {where} GROUP BY u.id ORDER BY ganhos DESC LIMIT 5", params)
-        ranking = [dict(row) for row in c.fetchall()]
-        conn.close()
-        return {'total_leads': total_leads, 'leads_ganhos': leads_ganhos, 'taxa_conversao': taxa_conversao, 'tempo_resposta': 12, 'funil': funil, 'ranking': ranking}
+        # Relatórios contam a partir do início do dia
+        start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        metrics = self.rollup.get_metrics(start_date, vendedor_id)
+        funil = {
+            'novo': metrics['leads_novo'],
+            'em_atendimento': metrics['leads_atendimento'],
+            'qualificado': metrics['leads_qualificado'],
+            'ganho': metrics['leads_ganhos'],
+            'perdido': metrics['leads_perdido']
+        }
+        return {'total_leads': metrics['total_leads'], 'leads_ganhos': metrics['leads_ganhos'], 'taxa_conversao': metrics['taxa_conversao'], 'tempo_resposta': metrics['tempo_resposta'], 'funil': funil, 'ranking': metrics['ranking']}
     
     def _get_period_label(self, period):
         labels = {'day': 'Hoje', 'week': 'Ultimos 7 dias', 'month': 'Ultimos 30 dias'}
@@ -6,6 +6,8 @@ Envia alertas automáticos via WhatsApp quando detecta problemas críticos
 from datetime import datetime
 from typing import List, Dict, Any
 
+from outbound_queue import PRIORITY_ALERT
+
 
 class GestorWhatsAppNotifier:
     """
@@ -166,25 +168,27 @@ class GestorWhatsAppNotifier:
         
         message = self._build_alert_message(alert)
         
+        # Enfileira (faixa de alertas): o envio acontece no dispatcher da fila de saída
         results = []
         for gestor in gestores:
             try:
-                success = self.whatsapp.send_message(
-                    phone=gestor['phone'],
-                    content=message,
-                    vendedor_id=gestor['user_id'],
-                    bypass_lead_check=True
+                handle = self.whatsapp.queue_message(
+                    gestor['phone'],
+                    message,
+                    priority=PRIORITY_ALERT
                 )
+                success = handle is not None and handle['status'] != 'failed'
                 
                 results.append({
                     'gestor_id': gestor['user_id'],
                     'gestor_name': gestor['gestor_name'],
                     'phone': gestor['phone'],
-                    'success': success
+                    'success': success,
+                    'outbound_id': handle['id'] if handle else None
                 })
                 
                 if success:
-                    print(f"✅ Alerta enviado para {gestor['gestor_name']} ({gestor['phone']})")
+                    print(f"✅ Alerta enfileirado para {gestor['gestor_name']} ({gestor['phone']})")
                 else:
                     print(f"❌ Falha ao enviar para {gestor['gestor_name']}")
             
@@ -167,9 +167,10 @@ class IAAssistant:
                 resposta = self._gerar_resposta_fallback(lead_id, mensagem_lead)
             
             if resposta:
-                self.db.add_message(lead_id, 'ia', 'Assistente IA', resposta)
-                self.db.add_lead_log(lead_id, 'ia_respondeu', 'IA Assistant', 
-                    f'Resposta: {resposta[:50]}...')
+                with self.db.transaction():
+                    self.db.add_message(lead_id, 'ia', 'Assistente IA', resposta)
+                    self.db.add_lead_log(lead_id, 'ia_respondeu', 'IA Assistant', 
+                        f'Resposta: {resposta[:50]}...')
                 print(f"✅ Enviado: {resposta[:80]}...\n")
             
             return resposta
@@ -338,63 +339,68 @@ class IAAssistant:
         """
         Extrai informações SEM interromper a conversa
         Lead não percebe que estamos salvando
+        Todas as escritas da mensagem vão numa única transação
         """
         try:
-            respostas_existentes = self.db.get_lead_qualificacao_respostas(lead_id)
-            ids_respondidas = [r['pergunta_id'] for r in respostas_existentes]
-            
-            msg_lower = mensagem.lower()
-            
-            # 🔍 NOME
-            if 'nome' not in ids_respondidas:
-                nome = self._extrair_nome(mensagem, msg_lower, historico)
-                if nome:
-                    self._salvar_silenciosamente(lead_id, 'nome', nome, 'name', 20)
-            
-            # 🔍 INTERESSE
-            if 'interesse' not in ids_respondidas:
-                interesse = self._extrair_interesse(mensagem, msg_lower)
-                if interesse:
-                    score = 25 if len(interesse) > 30 else 15
-                    self._salvar_silenciosamente(lead_id, 'interesse', interesse, 'interesse', score)
-            
-            # 🔍 ORÇAMENTO
-            if 'orcamento' not in ids_respondidas:
-                orcamento = self._extrair_orcamento(mensagem, msg_lower)
-                if orcamento:
-                    score = self._calcular_score_orcamento(orcamento)
-                    self._salvar_silenciosamente(lead_id, 'orcamento', orcamento, 'orcamento', score)
-            
-            # 🔍 PRAZO
-            if 'prazo' not in ids_respondidas:
-                prazo = self._extrair_prazo(mensagem, msg_lower)
-                if prazo:
-                    score = self._calcular_score_prazo(msg_lower)
-                    self._salvar_silenciosamente(lead_id, 'prazo', prazo, 'prazo', score)
-            
-            # 🔍 CONTATO
-            if 'contato' not in ids_respondidas:
-                contato = self._extrair_preferencia_contato(mensagem, msg_lower)
-                if contato:
-                    self._salvar_silenciosamente(lead_id, 'contato', contato, 'preferencia_contato', 15)
-            
-            # 🔍 TIPO CLIENTE
-            if 'empresa' not in ids_respondidas:
-                tipo = self._extrair_tipo_cliente(mensagem, msg_lower)
-                if tipo:
-                    score = 20 if 'empresa' in tipo.lower() else 10
-                    self._salvar_silenciosamente(lead_id, 'empresa', tipo, 'tipo_cliente', score)
-            
-            # 🔍 TAMANHO
-            if 'tamanho_empresa' not in ids_respondidas:
-                tamanho = self._extrair_tamanho(mensagem, msg_lower)
-                if tamanho:
-                    score = self._calcular_score_tamanho(tamanho)
-                    self._salvar_silenciosamente(lead_id, 'tamanho_empresa', tamanho, 'tamanho_empresa', score)
-            
+            with self.db.transaction():
+                self._extrair_e_salvar(lead_id, mensagem, historico)
         except Exception as e:
             print(f"⚠️ Erro na extração: {e}")
 
+    def _extrair_e_salvar(self, lead_id, mensagem, historico):
+        """Roda os extratores e salva o que encontrar"""
+        respostas_existentes = self.db.get_lead_qualificacao_respostas(lead_id)
+        ids_respondidas = [r['pergunta_id'] for r in respostas_existentes]
+        
+        msg_lower = mensagem.lower()
+        
+        # 🔍 NOME
+        if 'nome' not in ids_respondidas:
+            nome = self._extrair_nome(mensagem, msg_lower, historico)
+            if nome:
+                self._salvar_silenciosamente(lead_id, 'nome', nome, 'name', 20)
+        
+        # 🔍 INTERESSE
+        if 'interesse' not in ids_respondidas:
+            interesse = self._extrair_interesse(mensagem, msg_lower)
+            if interesse:
+                score = 25 if len(interesse) > 30 else 15
+                self._salvar_silenciosamente(lead_id, 'interesse', interesse, 'interesse', score)
+        
+        # 🔍 ORÇAMENTO
+        if 'orcamento' not in ids_respondidas:
+            orcamento = self._extrair_orcamento(mensagem, msg_lower)
+            if orcamento:
+                score = self._calcular_score_orcamento(orcamento)
+                self._salvar_silenciosamente(lead_id, 'orcamento', orcamento, 'orcamento', score)
+        
+        # 🔍 PRAZO
+        if 'prazo' not in ids_respondidas:
+            prazo = self._extrair_prazo(mensagem, msg_lower)
+            if prazo:
+                score = self._calcular_score_prazo(msg_lower)
+                self._salvar_silenciosamente(lead_id, 'prazo', prazo, 'prazo', score)
+        
+        # 🔍 CONTATO
+        if 'contato' not in ids_respondidas:
+            contato = self._extrair_preferencia_contato(mensagem, msg_lower)
+            if contato:
+                self._salvar_silenciosamente(lead_id, 'contato', contato, 'preferencia_contato', 15)
+        
+        # 🔍 TIPO CLIENTE
+        if 'empresa' not in ids_respondidas:
+            tipo = self._extrair_tipo_cliente(mensagem, msg_lower)
+            if tipo:
+                score = 20 if 'empresa' in tipo.lower() else 10
+                self._salvar_silenciosamente(lead_id, 'empresa', tipo, 'tipo_cliente', score)
+        
+        # 🔍 TAMANHO
+        if 'tamanho_empresa' not in ids_respondidas:
+            tamanho = self._extrair_tamanho(mensagem, msg_lower)
+            if tamanho:
+                score = self._calcular_score_tamanho(tamanho)
+                self._salvar_silenciosamente(lead_id, 'tamanho_empresa', tamanho, 'tamanho_empresa', score)
+
     def _salvar_silenciosamente(self, lead_id, tipo, valor, campo_lead, score):
         """Salva informação sem fazer alarde"""
         try:
@@ -654,9 +660,6 @@ class IAAssistant:
                     'qualificado': True
                 }
             
-            # Atualizar banco
-            self._atualizar_lead_qualificado(lead_id, respostas_dict, score_data)
-            
             # Mensagem final PERSONALIZADA
             nome = respostas_dict.get('nome', lead.get('name', 'amigo'))
             
@@ -678,7 +681,10 @@ class IAAssistant:
                     "Vamos encontrar algo que funcione para você!")
                 msg_final = f"Legal, {nome}! 😊\n\n{msg_base}\n\nVou conectar você com a equipe. Um momento..."
             
-            self.db.add_message(lead_id, 'ia', 'Assistente IA', msg_final)
+            # Atualizar banco (lead qualificado + mensagem final numa transação)
+            with self.db.transaction():
+                self._atualizar_lead_qualificado(lead_id, respostas_dict, score_data)
+                self.db.add_message(lead_id, 'ia', 'Assistente IA', msg_final)
             
             # Automações
             if self.automacoes:
@@ -740,18 +746,21 @@ class IAAssistant:
     def _incrementar_score(self, lead_id, pontos):
         """Incrementa score do lead"""
         try:
-            lead = self.db.get_lead(lead_id)
-            score_atual = lead.get('qualification_score', 0)
-            novo_score = min(175, score_atual + pontos)
-            
+            # Leitura e escrita num único UPDATE (sem corrida entre get_lead e UPDATE)
             conn = self.db.get_connection()
             c = conn.cursor()
-            c.execute("UPDATE leads SET qualification_score = ? WHERE id = ?", 
-                     (novo_score, lead_id))
+            c.execute("""
+                UPDATE leads
+                SET qualification_score = MIN(175, COALESCE(qualification_score, 0) + ?)
+                WHERE id = ?
+                RETURNING qualification_score
+            """, (pontos, lead_id))
+            row = c.fetchone()
             conn.commit()
             conn.close()
             
-            print(f"📊 Score: {score_atual} → {novo_score}")
+            if row:
+                print(f"📊 Score: +{pontos} → {row[0]}")
         except Exception as e:
             print(f"❌ Erro ao incrementar score: {e}")
 
@@ -0,0 +1,94 @@
+"""
+Deduplicação das mensagens recebidas pelo webhook
+
+A ponte (Baileys/Venom) reenvia o webhook quando estoura o timeout, então a
+mesma mensagem pode chegar mais de uma vez. Cada evento ganha uma chave:
+
+- id:<id do provedor>  quando a ponte manda o id da mensagem
+- h:<sha1>             senão, hash de telefone + timestamp do provedor + conteúdo
+- None                 sem id nem timestamp: o evento não é deduplicado
+                       (um horário nosso descartaria duas mensagens iguais
+                       legítimas no mesmo intervalo)
+
+A chave é checada primeiro num LRU em memória (sem tocar no banco) e depois
+no índice único de webhook_dedup_keys, que vale entre processos e reinícios.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+DEDUP_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS webhook_dedup_keys (
+        dedup_key TEXT PRIMARY KEY,
+        message_id INTEGER,
+        received_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_webhook_dedup_keys_received ON webhook_dedup_keys(received_at)",
+]
+
+
+def provider_message_id(data: Dict) -> Optional[str]:
+    """Id da mensagem no WhatsApp, nos formatos que as pontes enviam"""
+    key = data.get("key")
+    candidates = (
+        data.get("message_id"),
+        data.get("messageId"),
+        data.get("id"),
+        key.get("id") if isinstance(key, dict) else None,
+    )
+    for candidate in candidates:
+        if candidate:
+            return str(candidate)
+    return None
+
+
+def dedup_key(data: Dict, phone: str, content: str) -> Optional[str]:
+    """Chave de idempotência do evento, ou None se não há como identificá-lo (ver docstring do módulo)"""
+    message_id = provider_message_id(data)
+    if message_id:
+        return f"id:{message_id}"
+
+    timestamp = data.get("timestamp")
+    if not timestamp:
+        return None
+    digest = hashlib.sha1(f"{phone}|{timestamp}|{content}".encode("utf-8")).hexdigest()
+    return f"h:{digest}"
+
+
+class RecentKeys:
+    """
+    LRU limitado das chaves vistas por este processo
+
+    Só responde "já vi"; quem não está aqui ainda passa pelo índice único.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = (
+            max_size if max_size is not None
+            else int(os.getenv("WEBHOOK_DEDUP_CACHE_SIZE", "10000"))
+        )
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.hits += 1
+                return True
+            return False
+
+    def add(self, key: str):
+        with self._lock:
+            self._keys[key] = time.time()
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -0,0 +1,365 @@
+"""
+Rollups de métricas (por hora e por dia)
+
+metrics_hourly / metrics_daily guardam, para cada período de criação do
+lead × vendedor × status, quantos leads existem, quantos já tiveram a
+primeira resposta do vendedor, a soma dos minutos até essa resposta e
+quantos responderam dentro do SLA.
+
+Triggers em leads mantêm os rollups atualizados quando um lead é criado,
+muda de status, é atribuído ou recebe a primeira resposta (a contribuição
+antiga sai, a nova entra). /api/metrics, ExportServicePremium e
+get_metrics_summary leem os rollups em vez de varrer leads/messages.
+
+Execute: python metrics_rollup.py --days 30            (verifica os últimos 30 dias)
+         python metrics_rollup.py --days 30 --rebuild  (verifica e reconstrói)
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+# Meta de primeira resposta (minutos) usada em /api/metrics
+SLA_FIRST_REPLY_MINUTES = 15
+
+ROLLUP_TABLES = {
+    "metrics_hourly": "%Y-%m-%d %H:00:00",
+    "metrics_daily": "%Y-%m-%d",
+}
+
+_STATUSES = ('novo', 'em_atendimento', 'qualificado', 'ganho', 'perdido')
+
+
+def _contribution(ref):
+    """Colunas (bucket omitido) com a contribuição de um lead (ref = new/old/l)"""
+    replied = f"{ref}.first_vendedor_reply_at IS NOT NULL"
+    minutes = f"(julianday({ref}.first_vendedor_reply_at) - julianday({ref}.created_at)) * 24 * 60"
+    return {
+        "vendedor_id": f"COALESCE({ref}.assigned_to, 0)",
+        "status": f"COALESCE({ref}.status, 'novo')",
+        "leads": "1",
+        "replied": f"CASE WHEN {replied} THEN 1 ELSE 0 END",
+        "reply_minutes": f"CASE WHEN {replied} THEN {minutes} ELSE 0 END",
+        "within_sla": f"CASE WHEN {replied} AND {minutes} <= {SLA_FIRST_REPLY_MINUTES} THEN 1 ELSE 0 END",
+    }
+
+
+def _upsert(table, bucket_format, ref, sign):
+    """INSERT ... ON CONFLICT que soma (sign=1) ou subtrai (sign=-1) um lead"""
+    values = _contribution(ref)
+    measures = ("leads", "replied", "reply_minutes", "within_sla")
+    select = ", ".join(
+        [f"strftime('{bucket_format}', {ref}.created_at)", values["vendedor_id"], values["status"]]
+        + [f"{sign} * ({values[m]})" for m in measures]
+    )
+    updates = ", ".join(f"{m} = {m} + excluded.{m}" for m in measures)
+    return f"""
+        INSERT INTO {table} (bucket, vendedor_id, status, leads, replied, reply_minutes, within_sla)
+        SELECT {select} WHERE {ref}.created_at IS NOT NULL
+        ON CONFLICT(bucket, vendedor_id, status) DO UPDATE SET {updates};
+    """
+
+
+def _trigger_body(add_new=False, sub_old=False):
+    parts = []
+    for table, bucket_format in ROLLUP_TABLES.items():
+        if sub_old:
+            parts.append(_upsert(table, bucket_format, "old", -1))
+        if add_new:
+            parts.append(_upsert(table, bucket_format, "new", 1))
+    return "BEGIN " + "".join(parts) + " END"
+
+
+def rollup_schema_statements():
+    """DDL das tabelas e triggers (usado pela migração)"""
+    statements = []
+    for table in ROLLUP_TABLES:
+        statements.append(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                vendedor_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                leads INTEGER NOT NULL DEFAULT 0,
+                replied INTEGER NOT NULL DEFAULT 0,
+                reply_minutes REAL NOT NULL DEFAULT 0,
+                within_sla INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, vendedor_id, status)
+            )
+        """)
+
+    statements.append(
+        "CREATE TRIGGER IF NOT EXISTS leads_metrics_ai AFTER INSERT ON leads "
+        + _trigger_body(add_new=True)
+    )
+    statements.append(
+        "CREATE TRIGGER IF NOT EXISTS leads_metrics_ad AFTER DELETE ON leads "
+        + _trigger_body(sub_old=True)
+    )
+    # WHEN: o trigger de atividade (messages) atualiza leads a cada mensagem
+    statements.append(
+        "CREATE TRIGGER IF NOT EXISTS leads_metrics_au "
+        "AFTER UPDATE OF status, assigned_to, first_vendedor_reply_at, created_at ON leads "
+        "WHEN old.status IS NOT new.status OR old.assigned_to IS NOT new.assigned_to "
+        "OR old.first_vendedor_reply_at IS NOT new.first_vendedor_reply_at "
+        "OR old.created_at IS NOT new.created_at "
+        + _trigger_body(add_new=True, sub_old=True)
+    )
+    return statements
+
+
+def _raw_aggregate_sql(bucket_format):
+    """Agregação a partir de leads (mesmas colunas do rollup)"""
+    values = _contribution("l")
+    return f"""
+        SELECT
+            strftime('{bucket_format}', l.created_at) AS bucket,
+            {values['vendedor_id']} AS vendedor_id,
+            {values['status']} AS status,
+            COUNT(*) AS leads,
+            SUM({values['replied']}) AS replied,
+            SUM({values['reply_minutes']}) AS reply_minutes,
+            SUM({values['within_sla']}) AS within_sla
+        FROM leads l
+        WHERE l.created_at IS NOT NULL
+        AND l.created_at >= ? AND l.created_at < ?
+        GROUP BY 1, 2, 3
+    """
+
+
+def _day_range(start, end):
+    """Alinha [start, end) a dias inteiros (strings 'YYYY-MM-DD')"""
+    start_day = start.strftime('%Y-%m-%d')
+    end_day = (end + timedelta(days=1)).strftime('%Y-%m-%d') if end.time() != datetime.min.time() \
+        else end.strftime('%Y-%m-%d')
+    return start_day, end_day
+
+
+def rebuild_rollups(conn, start=None, end=None):
+    """
+    Reconstrói os rollups de [start, end) (alinhado a dias) a partir de leads
+
+    Sem start/end reconstrói tudo. Roda na conexão/transação recebida.
+    """
+    start_day, end_day = _day_range(start or datetime(1970, 1, 1), end or datetime(9999, 12, 30))
+
+    for table, bucket_format in ROLLUP_TABLES.items():
+        conn.execute(f"DELETE FROM {table} WHERE bucket >= ? AND bucket < ?", (start_day, end_day))
+        conn.execute(f"""
+            INSERT INTO {table} (bucket, vendedor_id, status, leads, replied, reply_minutes, within_sla)
+            {_raw_aggregate_sql(bucket_format)}
+        """, (start_day, end_day))
+
+
+def check_rollups(conn, start, end):
+    """
+    Compara os rollups de [start, end) (alinhado a dias) com os dados brutos
+
+    Returns:
+        Dict[str, List[tuple]]: tabela → chaves (bucket, vendedor_id, status) divergentes
+    """
+    start_day, end_day = _day_range(start, end)
+    problems = {}
+
+    for table, bucket_format in ROLLUP_TABLES.items():
+        raw = {
+            (row[0], row[1], row[2]): (row[3], row[4], round(row[5], 3), row[6])
+            for row in conn.execute(_raw_aggregate_sql(bucket_format), (start_day, end_day)).fetchall()
+        }
+        stored = {
+            (row[0], row[1], row[2]): (row[3], row[4], round(row[5], 3), row[6])
+            for row in conn.execute(f"""
+                SELECT bucket, vendedor_id, status, leads, replied, reply_minutes, within_sla
+                FROM {table}
+                WHERE bucket >= ? AND bucket < ? AND leads <> 0
+            """, (start_day, end_day)).fetchall()
+        }
+        diff = sorted(key for key in raw.keys() | stored.keys() if raw.get(key) != stored.get(key))
+        if diff:
+            problems[table] = diff
+
+    return problems
+
+
+class MetricsRollup:
+    """Leitura das métricas a partir dos rollups"""
+
+    def __init__(self, database):
+        self.db = database
+
+    def _read(self, c, select, start_date, vendedor_id, where="", tail=""):
+        """
+        Soma hourly (dia parcial de start_date) + daily (dias completos seguintes)
+
+        Resolução de 1 hora no início do período.
+        """
+        hour_start = start_date.strftime('%Y-%m-%d %H:00:00')
+        next_day = (start_date + timedelta(days=1)).strftime('%Y-%m-%d')
+        filter_vendedor = " AND r.vendedor_id = ?" if vendedor_id else ""
+        extra = [int(vendedor_id)] if vendedor_id else []
+
+        c.execute(f"""
+            SELECT {select}
+            FROM (
+                SELECT * FROM metrics_hourly WHERE bucket >= ? AND bucket < ?
+                UNION ALL
+                SELECT * FROM metrics_daily WHERE bucket >= ?
+            ) r
+            LEFT JOIN users u ON u.id = r.vendedor_id
+            WHERE 1=1 {filter_vendedor} {where}
+            {tail}
+        """, [hour_start, next_day, next_day] + extra)
+        return c.fetchall()
+
+    def get_metrics(self, start_date, vendedor_id=None, sla_minutes=SLA_FIRST_REPLY_MINUTES):
+        """Mesmo formato de /api/metrics, para leads criados desde start_date"""
+        conn = self.db.get_connection()
+        c = conn.cursor()
+
+        status_rows = self._read(
+            c, "r.status, SUM(r.leads) AS leads, SUM(r.replied) AS replied, "
+               "SUM(r.reply_minutes) AS reply_minutes, SUM(r.within_sla) AS within_sla",
+            start_date, vendedor_id, tail="GROUP BY r.status"
+        )
+        by_status = {row['status']: row['leads'] or 0 for row in status_rows}
+        replied = sum(row['replied'] or 0 for row in status_rows)
+        reply_minutes = sum(row['reply_minutes'] or 0 for row in status_rows)
+        within_sla = sum(row['within_sla'] or 0 for row in status_rows)
+
+        total_leads = sum(by_status.values())
+        metrics = {
+            'total_leads': total_leads,
+            'leads_ganhos': by_status.get('ganho', 0),
+            'leads_novo': by_status.get('novo', 0),
+            'leads_atendimento': by_status.get('em_atendimento', 0),
+            'leads_qualificado': by_status.get('qualificado', 0),
+            'leads_perdido': by_status.get('perdido', 0),
+        }
+        metrics['taxa_conversao'] = (
+            round((metrics['leads_ganhos'] / total_leads) * 100, 1) if total_leads > 0 else 0
+        )
+        metrics['tempo_resposta'] = round(reply_minutes / replied, 1) if replied else 0
+
+        sla = {'total': replied, 'meta_minutos': sla_minutes}
+        if replied > 0:
+            sla['dentro_sla'] = round((within_sla / replied) * 100, 1)
+            sla['fora_sla'] = round(100 - sla['dentro_sla'], 1)
+        else:
+            sla['dentro_sla'] = 0
+            sla['fora_sla'] = 0
+        metrics['sla_compliance'] = sla
+
+        carga_rows = self._read(
+            c, "COALESCE(u.name, 'Sem atribuir') AS vendedor, SUM(r.leads) AS leads",
+            start_date, vendedor_id,
+            tail="GROUP BY u.id, u.name HAVING SUM(r.leads) > 0 ORDER BY leads DESC"
+        )
+        metrics['distribuicao_carga'] = [
+            {
+                'vendedor': row['vendedor'],
+                'leads': row['leads'],
+                'percent': round((row['leads'] / (total_leads or 1)) * 100, 1)
+            }
+            for row in carga_rows
+        ]
+
+        metrics['ranking'] = self.get_ranking(start_date, vendedor_id, c=c)
+
+        metrics['funil'] = {
+            'novo': metrics['leads_novo'],
+            'em_atendimento': metrics['leads_atendimento'],
+            'qualificado': metrics['leads_qualificado'],
+            'ganho': metrics['leads_ganhos'],
+            'perdido': metrics['leads_perdido']
+        }
+
+        conn.close()
+        return metrics
+
+    def get_ranking(self, start_date, vendedor_id=None, limit=5, c=None):
+        """Top vendedores por leads ganhos (com total e taxa)"""
+        conn = None
+        if c is None:
+            conn = self.db.get_connection()
+            c = conn.cursor()
+
+        rows = self._read(
+            c, """
+                u.name,
+                SUM(r.leads) AS total,
+                SUM(CASE WHEN r.status = 'ganho' THEN r.leads ELSE 0 END) AS ganhos,
+                ROUND(SUM(CASE WHEN r.status = 'ganho' THEN r.leads * 1.0 ELSE 0 END) / SUM(r.leads) * 100, 1) AS taxa
+            """,
+            start_date, vendedor_id,
+            where="AND u.id IS NOT NULL",
+            tail=f"GROUP BY u.id, u.name HAVING SUM(r.leads) > 0 ORDER BY ganhos DESC, taxa DESC LIMIT {int(limit)}"
+        )
+        ranking = [
+            {'name': row['name'], 'total': row['total'], 'ganhos': row['ganhos'], 'taxa': row['taxa'] or 0}
+            for row in rows
+        ]
+
+        if conn is not None:
+            conn.close()
+        return ranking
+
+    def get_status_totals(self, start_date=None, vendedor_id=None):
+        """Leads por status (todo o período se start_date for None)"""
+        conn = self.db.get_connection()
+        c = conn.cursor()
+        rows = self._read(
+            c, "r.status, SUM(r.leads) AS leads",
+            start_date or datetime(1970, 1, 1), vendedor_id, tail="GROUP BY r.status"
+        )
+        conn.close()
+
+        totals = {status: 0 for status in _STATUSES}
+        for row in rows:
+            totals[row['status']] = row['leads'] or 0
+        return totals
+
+    def check(self, start, end, rebuild=False):
+        """Verifica (e opcionalmente reconstrói) os rollups de [start, end)"""
+        if rebuild:
+            with self.db.transaction() as conn:
+                problems = check_rollups(conn, start, end)
+                if problems:
+                    rebuild_rollups(conn, start, end)
+            return problems
+
+        conn = self.db.get_connection()
+        try:
+            return check_rollups(conn, start, end)
+        finally:
+            conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verificador de consistência dos rollups de métricas")
+    parser.add_argument("db_name", nargs="?", help="arquivo do banco (padrão: o do Database)")
+    parser.add_argument("--days", type=int, default=30, help="quantos dias para trás verificar")
+    parser.add_argument("--rebuild", action="store_true", help="reconstrói os dias divergentes a partir de leads")
+    args = parser.parse_args(argv)
+
+    from database import Database
+
+    db = Database(args.db_name) if args.db_name else Database()
+    end = datetime.now()
+    start = end - timedelta(days=args.days)
+
+    problems = MetricsRollup(db).check(start, end, rebuild=args.rebuild)
+    if not problems:
+        print(f"✅ Rollups consistentes nos últimos {args.days} dias")
+        return 0
+
+    for table, keys in problems.items():
+        print(f"❌ {table}: {len(keys)} chave(s) divergente(s)")
+        for key in keys[:20]:
+            print(f"      {key}")
+
+    if args.rebuild:
+        print("🔧 Rollups reconstruídos a partir dos dados brutos")
+        return 0
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
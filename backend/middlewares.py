@@ -1,15 +1,18 @@
 """
 Middlewares de segurança e controle
 - Rate Limiting
+- ETag / 304 por versão de dados
 - Validação de inputs
 - Logs de auditoria
 - Error handling
 """
-from flask import request, jsonify, session
+from flask import request, jsonify, session, make_response
 from functools import wraps
 from datetime import datetime, timedelta
 from collections import defaultdict
+import hashlib
 import re
+import time
 
 # =============================
 # RATE LIMITING
@@ -90,6 +93,59 @@ def rate_limit(limit_type='per_minute'):
     return decorator
 
 
+# =============================
+# ETAG POR VERSÃO DE DADOS
+# =============================
+def etag(versions, *scopes, window=None):
+    """
+    Decorator de GET condicional (ETag / If-None-Match)
+
+    A ETag é derivada das versões dos escopos (DataVersions), do usuário
+    e da URL. Se o cliente já tem essa versão, responde 304 sem executar a
+    rota (nem a consulta). Aplicar depois da autenticação.
+
+    Args:
+        versions: DataVersions
+        scopes: Escopos dos quais a resposta depende ("leads", "tags"...)
+        window: Para respostas que mudam com o tempo (SLA), a ETag também
+            vira a cada `window` segundos
+
+    Usage:
+        @rate_limit('per_minute')
+        @login_required
+        @etag(data_versions, "leads", "tags", "users")
+        def minha_rota():
+            ...
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Versões lidas ANTES da rota: a resposta nunca é mais antiga que a ETag
+            parts = [
+                versions.token(*scopes),
+                str(session.get('role')),
+                str(session.get('user_id')),
+                request.full_path
+            ]
+            if window:
+                parts.append(str(int(time.time() // window)))
+            value = hashlib.md5("|".join(parts).encode()).hexdigest()
+
+            if request.if_none_match.contains_weak(value):
+                response = make_response("", 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(value, weak=True)
+            # Navegador guarda, mas sempre revalida (If-None-Match automático)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
+
 # =============================
 # VALIDAÇÃO DE INPUTS
 # =============================
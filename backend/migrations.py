@@ -0,0 +1,550 @@
+"""
+Migrações versionadas do banco + verificador de planos de consulta
+
+- MIGRATIONS: lista ordenada de migrações (versão, nome, passos)
+- apply_migrations(db): aplica as pendentes, registrando em schema_migrations
+- HOT_QUERIES: consultas críticas que nunca devem fazer full table scan
+- check_hot_queries(db): roda EXPLAIN QUERY PLAN em cada consulta registrada
+
+Execute: python migrations.py   (aplica e verifica; sai com código 1 se houver scan)
+         python migrations.py --backfill-activity   (recalcula as colunas de atividade dos leads)
+"""
+import argparse
+import json
+import sqlite3
+import sys
+
+import metrics_rollup
+from data_versions import install_version_triggers
+from change_feed import install_change_triggers
+from webhook_outbox import OUTBOX_SCHEMA
+from inbound_dedup import DEDUP_SCHEMA
+from outbound_queue import OUTBOUND_SCHEMA
+from campaigns import CAMPAIGN_SCHEMA
+
+
+# =============================
+# PASSOS DE MIGRAÇÃO
+# =============================
+def _existing_tables(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    return {row[0] for row in rows}
+
+
+def _tables_with_lead_id(conn):
+    """Tabelas (exceto leads) que referenciam um lead pela coluna lead_id"""
+    tables = []
+    for table in sorted(_existing_tables(conn)):
+        if table == 'leads' or table.startswith('sqlite_'):
+            continue
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+        if 'lead_id' in columns:
+            tables.append(table)
+    return tables
+
+
+def _merge_leads(conn, keep_id, dup_ids, child_tables):
+    """Move os filhos dos leads duplicados para keep_id e apaga os duplicados"""
+    for dup_id in dup_ids:
+        for table in child_tables:
+            # OR IGNORE: tabelas com UNIQUE(lead_id, ...) já têm a linha no lead mantido
+            conn.execute(f"UPDATE OR IGNORE {table} SET lead_id = ? WHERE lead_id = ?", (keep_id, dup_id))
+            conn.execute(f"DELETE FROM {table} WHERE lead_id = ?", (dup_id,))
+        conn.execute("DELETE FROM leads WHERE id = ?", (dup_id,))
+
+
+def _merge_duplicate_phones(conn):
+    """
+    Une leads com o mesmo telefone antes de criar o índice UNIQUE
+
+    Mantém o lead mais antigo (menor id) e move para ele mensagens, logs,
+    notas, tags etc. dos duplicados.
+    """
+    conn.execute("UPDATE leads SET phone = NULL WHERE phone = ''")
+
+    duplicates = conn.execute("""
+        SELECT MIN(id) AS keep_id, GROUP_CONCAT(id) AS ids
+        FROM leads
+        WHERE phone IS NOT NULL
+        GROUP BY phone
+        HAVING COUNT(*) > 1
+    """).fetchall()
+
+    if not duplicates:
+        return
+
+    child_tables = _tables_with_lead_id(conn)
+    merged = 0
+
+    for keep_id, ids in duplicates:
+        dup_ids = [int(i) for i in ids.split(',') if int(i) != keep_id]
+        _merge_leads(conn, keep_id, dup_ids, child_tables)
+        merged += len(dup_ids)
+
+    print(f"🔀 {merged} leads duplicados unidos por telefone")
+
+
+def _normalize_lead_phones(conn):
+    """
+    Reescreve leads.phone com utils.normalize_phone
+
+    Leads que passam a ter o mesmo telefone brasileiro (ex.: "51999..." e
+    "5551999...") são unidos no mais antigo. Telefones que não dá para
+    classificar como brasileiros nunca são unidos: só são reescritos se o
+    valor normalizado ainda estiver livre.
+    """
+    from utils import normalize_phone, is_brazilian_phone
+
+    groups = {}
+    unclassified = []
+    for lead_id, phone in conn.execute("SELECT id, phone FROM leads WHERE phone IS NOT NULL ORDER BY id"):
+        normalized = normalize_phone(phone)
+        if is_brazilian_phone(normalized):
+            groups.setdefault(normalized, []).append((lead_id, phone))
+        else:
+            unclassified.append((lead_id, phone, normalized))
+
+    child_tables = _tables_with_lead_id(conn)
+    merged = 0
+
+    for normalized, leads in groups.items():
+        keep_id, keep_phone = leads[0]
+        dup_ids = [lead_id for lead_id, _ in leads[1:]]
+        if dup_ids:
+            _merge_leads(conn, keep_id, dup_ids, child_tables)
+            merged += len(dup_ids)
+        if normalized != keep_phone:
+            conn.execute("UPDATE leads SET phone = ? WHERE id = ?", (normalized, keep_id))
+
+    skipped = 0
+    for lead_id, phone, normalized in unclassified:
+        if not normalized or normalized == phone:
+            continue
+        taken = conn.execute("SELECT 1 FROM leads WHERE phone = ?", (normalized,)).fetchone()
+        if taken:
+            skipped += 1
+            continue
+        conn.execute("UPDATE leads SET phone = ? WHERE id = ?", (normalized, lead_id))
+
+    if merged:
+        print(f"🔀 {merged} leads duplicados unidos após normalizar telefones")
+    if skipped:
+        print(f"⚠️ {skipped} telefones não classificados mantidos como estão (valor normalizado já em uso)")
+
+
+def _ensure_lead_email_column(conn):
+    """leads.email é usado pela busca de leads mas nunca foi criado no schema"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(leads)").fetchall()}
+    if 'email' not in columns:
+        conn.execute("ALTER TABLE leads ADD COLUMN email TEXT")
+
+
+# Colunas de atividade do lead (mantidas por triggers em messages)
+LEAD_ACTIVITY_COLUMNS = [
+    ("last_message_at", "DATETIME"),
+    ("last_inbound_at", "DATETIME"),           # última mensagem do lead
+    ("last_outbound_at", "DATETIME"),          # última mensagem para o lead (vendedor, IA, sistema)
+    ("first_vendedor_reply_at", "DATETIME"),
+    ("message_count", "INTEGER DEFAULT 0"),
+]
+
+# Recalcula as colunas de atividade a partir de messages (1 passada agregada)
+_LEAD_ACTIVITY_RECOMPUTE = """
+    UPDATE leads SET
+        last_message_at = agg.last_message_at,
+        last_inbound_at = agg.last_inbound_at,
+        last_outbound_at = agg.last_outbound_at,
+        first_vendedor_reply_at = agg.first_vendedor_reply_at,
+        message_count = agg.message_count
+    FROM (
+        SELECT
+            l.id AS lead_id,
+            MAX(m.timestamp) AS last_message_at,
+            MAX(CASE WHEN m.sender_type = 'lead' THEN m.timestamp END) AS last_inbound_at,
+            MAX(CASE WHEN m.sender_type <> 'lead' THEN m.timestamp END) AS last_outbound_at,
+            MIN(CASE WHEN m.sender_type = 'vendedor' THEN m.timestamp END) AS first_vendedor_reply_at,
+            COUNT(m.id) AS message_count
+        FROM leads l
+        LEFT JOIN messages m ON m.lead_id = l.id
+        WHERE {where}
+        GROUP BY l.id
+    ) AS agg
+    WHERE leads.id = agg.lead_id
+"""
+
+
+def _add_lead_activity_columns(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(leads)").fetchall()}
+    for name, ddl in LEAD_ACTIVITY_COLUMNS:
+        if name not in columns:
+            conn.execute(f"ALTER TABLE leads ADD COLUMN {name} {ddl}")
+
+
+def _add_message_delivery_status(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)").fetchall()}
+    if "delivery_status" not in columns:
+        # NULL = mensagem recebida ou anterior à fila de saída
+        conn.execute("ALTER TABLE messages ADD COLUMN delivery_status TEXT")
+
+
+def _add_outbox_message_id(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(webhook_outbox)").fetchall()}
+    if "message_id" not in columns:
+        # Mensagem já gravada por uma tentativa anterior do evento
+        conn.execute("ALTER TABLE webhook_outbox ADD COLUMN message_id INTEGER")
+
+
+def backfill_lead_activity(conn, lead_ids=None):
+    """
+    Recalcula last_message_at, last_inbound_at, last_outbound_at,
+    first_vendedor_reply_at e message_count a partir da tabela messages
+
+    Args:
+        lead_ids: só esses leads (None = todos)
+
+    Returns:
+        int: leads atualizados
+    """
+    if lead_ids is None:
+        cursor = conn.execute(_LEAD_ACTIVITY_RECOMPUTE.format(where="1 = 1"))
+    else:
+        cursor = conn.execute(
+            _LEAD_ACTIVITY_RECOMPUTE.format(where="l.id IN (SELECT value FROM json_each(?))"),
+            (json.dumps([int(lead_id) for lead_id in lead_ids]),)
+        )
+    return cursor.rowcount
+
+
+# =============================
+# MIGRAÇÕES (nunca altere uma já publicada: crie uma nova versão)
+# =============================
+MIGRATIONS = [
+    (1, "leads_phone_unique", [
+        _merge_duplicate_phones,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_phone_unique ON leads(phone)",
+    ]),
+    (2, "hot_lookup_indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_lead_sender_id ON messages(lead_id, sender_type, id)",
+        "CREATE INDEX IF NOT EXISTS idx_leads_assigned_status_updated ON leads(assigned_to, status, updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_leads_updated_at ON leads(updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_lead_logs_lead_id_id ON lead_logs(lead_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_internal_notes_lead_created ON internal_notes(lead_id, created_at)",
+    ]),
+    (3, "normalize_lead_phones", [
+        _normalize_lead_phones,
+    ]),
+    (4, "keyset_pagination_indexes", [
+        # Keyset em (updated_at, id) não enxerga linhas com updated_at NULL
+        "UPDATE leads SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_leads_assigned_updated ON leads(assigned_to, updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_lead_id_id ON messages(lead_id, id)",
+    ]),
+    (5, "full_text_search", [
+        # Mensagens: palavras sem acento, com prefixo ("orcam"* acha "orçamento")
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+
+        # Leads: trigram para achar pedaços de nome/telefone/email (como o LIKE '%termo%')
+        _ensure_lead_email_column,
+        """CREATE VIRTUAL TABLE IF NOT EXISTS leads_fts USING fts5(
+            name, phone, email, content='leads', content_rowid='id', tokenize='trigram'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS leads_fts_ai AFTER INSERT ON leads BEGIN
+            INSERT INTO leads_fts(rowid, name, phone, email) VALUES (new.id, new.name, new.phone, new.email);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS leads_fts_ad AFTER DELETE ON leads BEGIN
+            INSERT INTO leads_fts(leads_fts, rowid, name, phone, email)
+            VALUES ('delete', old.id, old.name, old.phone, old.email);
+        END""",
+        # WHEN: o upsert do webhook "atualiza" phone a cada mensagem sem mudar nada
+        """CREATE TRIGGER IF NOT EXISTS leads_fts_au AFTER UPDATE OF name, phone, email ON leads
+        WHEN old.name IS NOT new.name OR old.phone IS NOT new.phone OR old.email IS NOT new.email
+        BEGIN
+            INSERT INTO leads_fts(leads_fts, rowid, name, phone, email)
+            VALUES ('delete', old.id, old.name, old.phone, old.email);
+            INSERT INTO leads_fts(rowid, name, phone, email) VALUES (new.id, new.name, new.phone, new.email);
+        END""",
+        "INSERT INTO leads_fts(leads_fts) VALUES ('rebuild')",
+    ]),
+    (6, "lead_activity_columns", [
+        _add_lead_activity_columns,
+        # Caminho quente: cada mensagem nova atualiza só a linha do lead
+        """CREATE TRIGGER IF NOT EXISTS messages_lead_activity_ai AFTER INSERT ON messages BEGIN
+            UPDATE leads SET
+                last_message_at = new.timestamp,
+                last_inbound_at = CASE WHEN new.sender_type = 'lead'
+                    THEN new.timestamp ELSE last_inbound_at END,
+                last_outbound_at = CASE WHEN new.sender_type <> 'lead'
+                    THEN new.timestamp ELSE last_outbound_at END,
+                first_vendedor_reply_at = CASE
+                    WHEN new.sender_type = 'vendedor' AND first_vendedor_reply_at IS NULL
+                    THEN new.timestamp ELSE first_vendedor_reply_at END,
+                message_count = COALESCE(message_count, 0) + 1
+            WHERE id = new.lead_id;
+        END""",
+        # Raros (exclusão, união de leads duplicados): recalcula o(s) lead(s) afetado(s)
+        "CREATE TRIGGER IF NOT EXISTS messages_lead_activity_ad AFTER DELETE ON messages BEGIN "
+        + _LEAD_ACTIVITY_RECOMPUTE.format(where="l.id = old.lead_id") + "; END",
+        "CREATE TRIGGER IF NOT EXISTS messages_lead_activity_au "
+        "AFTER UPDATE OF lead_id, sender_type, timestamp ON messages BEGIN "
+        + _LEAD_ACTIVITY_RECOMPUTE.format(where="l.id IN (old.lead_id, new.lead_id)") + "; END",
+        backfill_lead_activity,
+        "CREATE INDEX IF NOT EXISTS idx_leads_last_message_at ON leads(last_message_at)",
+    ]),
+    (7, "metrics_rollups",
+        metrics_rollup.rollup_schema_statements() + [metrics_rollup.rebuild_rollups]
+    ),
+    (8, "data_versions", [
+        # Tags/SLA e alertas ganham seus triggers quando as tabelas são criadas
+        install_version_triggers,
+    ]),
+    (9, "change_feed", [
+        install_change_triggers,
+    ]),
+    (10, "webhook_outbox", OUTBOX_SCHEMA),
+    (11, "webhook_dedup_keys", DEDUP_SCHEMA),
+    (12, "outbound_queue", OUTBOUND_SCHEMA + [_add_message_delivery_status]),
+    (13, "campaigns", CAMPAIGN_SCHEMA),
+    (14, "webhook_outbox_message_id", [_add_outbox_message_id]),
+    (15, "data_versions_update_guard", [
+        # Triggers de UPDATE com WHEN (só mudanças reais) e com as colunas atuais
+        install_version_triggers,
+    ]),
+]
+
+
+def _ensure_migrations_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+
+def get_schema_version(db):
+    """Retorna a maior versão aplicada (0 se nenhuma)"""
+    conn = db.get_connection()
+    try:
+        _ensure_migrations_table(conn)
+        row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+        return row[0] or 0
+    finally:
+        conn.close()
+
+
+def apply_migrations(db):
+    """
+    Aplica as migrações pendentes, cada uma em sua própria transação
+
+    Vários workers subindo juntos: cada migração roda em BEGIN IMMEDIATE e
+    a versão é conferida de novo já com o lock; quem chegou depois pula.
+
+    Returns:
+        List[int]: versões aplicadas nesta execução
+    """
+    conn = db.get_connection()
+    applied = []
+    try:
+        _ensure_migrations_table(conn)
+        done = {row[0] for row in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+
+        for version, name, steps in MIGRATIONS:
+            if version in done:
+                continue
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute(
+                    "SELECT 1 FROM schema_migrations WHERE version = ?", (version,)
+                ).fetchone():
+                    # Outro worker aplicou enquanto esperávamos o lock
+                    conn.rollback()
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (?, ?)",
+                    (version, name)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                print(f"❌ Falha na migração {version} ({name})")
+                raise
+
+            applied.append(version)
+            print(f"🗄️ Migração {version} aplicada: {name}")
+    finally:
+        conn.close()
+
+    return applied
+
+
+# =============================
+# VERIFICADOR DE PLANOS (EXPLAIN QUERY PLAN)
+# =============================
+HOT_QUERIES = {}
+
+
+def register_hot_query(name, sql, params=()):
+    """
+    Registra uma consulta crítica para o verificador de planos
+
+    Os parâmetros só precisam ter o tipo certo; os valores não importam.
+    """
+    HOT_QUERIES[name] = (sql, tuple(params))
+
+
+register_hot_query("lead_by_phone", "SELECT * FROM leads WHERE phone = ?", ("5551999999999",))
+register_hot_query("messages_by_lead", "SELECT * FROM messages WHERE lead_id = ? ORDER BY id ASC", (1,))
+register_hot_query(
+    "lead_has_vendedor_reply",
+    "SELECT 1 FROM messages m WHERE m.lead_id = ? AND m.sender_type = 'vendedor'",
+    (1,)
+)
+register_hot_query(
+    "first_vendedor_reply",
+    "SELECT MIN(id) FROM messages WHERE lead_id = ? AND sender_type = 'vendedor'",
+    (1,)
+)
+register_hot_query(
+    "leads_by_vendedor",
+    "SELECT * FROM leads WHERE assigned_to = ? ORDER BY updated_at DESC",
+    (1,)
+)
+register_hot_query(
+    "leads_by_vendedor_status",
+    "SELECT * FROM leads WHERE assigned_to = ? AND status = ? ORDER BY updated_at DESC",
+    (1, "novo")
+)
+register_hot_query("leads_recent", "SELECT * FROM leads ORDER BY updated_at DESC LIMIT ?", (50,))
+register_hot_query(
+    "leads_page",
+    "SELECT * FROM leads WHERE (updated_at, id) < (?, ?) ORDER BY updated_at DESC, id DESC LIMIT ?",
+    ("2024-01-01 00:00:00", 1, 50)
+)
+register_hot_query(
+    "leads_page_by_vendedor",
+    "SELECT * FROM leads WHERE assigned_to = ? AND (updated_at, id) < (?, ?) "
+    "ORDER BY updated_at DESC, id DESC LIMIT ?",
+    (1, "2024-01-01 00:00:00", 1, 50)
+)
+register_hot_query(
+    "messages_page",
+    "SELECT * FROM messages WHERE lead_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+    (1, 100, 50)
+)
+register_hot_query(
+    "message_search",
+    "SELECT m.* FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+    "WHERE messages_fts MATCH ? AND m.lead_id = ? ORDER BY bm25(messages_fts) LIMIT 10",
+    ('"ola"*', 1)
+)
+register_hot_query(
+    "lead_search",
+    "SELECT * FROM leads WHERE id IN (SELECT rowid FROM leads_fts WHERE leads_fts MATCH ?)",
+    ('"999"',)
+)
+register_hot_query("lead_logs_by_lead", "SELECT * FROM lead_logs WHERE lead_id = ? ORDER BY id DESC", (1,))
+register_hot_query(
+    "internal_notes_by_lead",
+    "SELECT * FROM internal_notes WHERE lead_id = ? ORDER BY created_at DESC",
+    (1,)
+)
+
+register_hot_query(
+    "tags_for_leads",
+    "SELECT lt.lead_id, t.* FROM lead_tags lt JOIN tags t ON t.id = lt.tag_id "
+    "WHERE lt.lead_id IN (SELECT value FROM json_each(?))",
+    ("[1, 2, 3]",)
+)
+
+
+def _is_full_scan(detail):
+    """'SCAN tabela' sem índice = full table scan (tabelas virtuais, ex. json_each, não contam)"""
+    detail = detail.upper()
+    if not detail.startswith("SCAN ") or "VIRTUAL TABLE" in detail:
+        return False
+    return "USING INDEX" not in detail and "USING COVERING INDEX" not in detail \
+        and "USING INTEGER PRIMARY KEY" not in detail
+
+
+def check_hot_queries(db, queries=None):
+    """
+    Roda EXPLAIN QUERY PLAN em cada consulta registrada
+
+    Returns:
+        Dict[str, List[str]]: consultas que fazem full table scan → linhas do plano
+    """
+    queries = queries if queries is not None else HOT_QUERIES
+    conn = db.get_connection()
+    problems = {}
+    try:
+        for name, (sql, params) in queries.items():
+            try:
+                plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+            except sqlite3.OperationalError as e:
+                # Tabela de módulo opcional (ex.: tags) ainda não criada
+                print(f"⚠️ {name} ignorada: {e}")
+                continue
+            scans = [detail for detail in plan if _is_full_scan(detail)]
+            if scans:
+                problems[name] = plan
+    finally:
+        conn.close()
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrações e verificador de planos de consulta")
+    parser.add_argument("db_name", nargs="?", help="arquivo do banco (padrão: o do Database)")
+    parser.add_argument(
+        "--backfill-activity", action="store_true",
+        help="recalcula last_message_at, message_count etc. de todos os leads"
+    )
+    args = parser.parse_args(argv)
+
+    from database import Database
+
+    db = Database(args.db_name) if args.db_name else Database()
+    print(f"🗄️ Versão do schema: {get_schema_version(db)}")
+
+    if args.backfill_activity:
+        with db.transaction() as conn:
+            updated = backfill_lead_activity(conn)
+        print(f"✅ Atividade recalculada em {updated} leads")
+
+    problems = check_hot_queries(db)
+    if problems:
+        print(f"❌ {len(problems)} consulta(s) crítica(s) com full table scan:")
+        for name, plan in problems.items():
+            print(f"  • {name}")
+            for detail in plan:
+                print(f"      {detail}")
+        return 1
+
+    print(f"✅ {len(HOT_QUERIES)} consultas críticas usando índice")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,8 +11,29 @@ Tipos de notificações:
 """
 
 from datetime import datetime
-from typing import Dict, Any, List
-from flask_socketio import SocketIO
+from typing import Dict, Any, List, Optional
+
+from emit_buffer import EmitBuffer
+
+
+# Sala de admin/gestor; cada socket também entra em user_<id> e role_<role>
+MANAGER_ROOM = 'gestores'
+
+
+def lead_rooms(lead: Optional[Dict[str, Any]], *extra_user_ids) -> List[str]:
+    """
+    Menor conjunto de salas que deve receber eventos de um lead
+
+    Gestores + vendedor dono do lead (+ extra_user_ids, ex.: dono anterior
+    numa transferência). Nunca broadcast: dados do lead não vazam para
+    outros vendedores.
+    """
+    rooms = [MANAGER_ROOM]
+    owners = [lead.get('assigned_to')] if lead else []
+    for user_id in owners + list(extra_user_ids):
+        if user_id and f'user_{user_id}' not in rooms:
+            rooms.append(f'user_{user_id}')
+    return rooms
 
 
 class NotificationService:
@@ -34,12 +55,13 @@ class NotificationService:
     TYPE_LEAD_ASSIGNED = 'lead_atribuido'
     TYPE_LEAD_TRANSFERRED = 'lead_transferido'
     
-    def __init__(self, socketio: SocketIO):
+    def __init__(self, socketio: EmitBuffer):
         """
         Inicializa o serviço de notificações
         
         Args:
-            socketio: Instância do SocketIO
+            socketio: EmitBuffer (emissões agrupadas; notificações do mesmo
+                tipo e lead na mesma janela são deduplicadas)
         """
         self.socketio = socketio
         print("🔔 Serviço de notificações inicializado")
@@ -69,7 +91,7 @@ class NotificationService:
             'sound': 'new_lead'
         }
         
-        self.socketio.emit('notification', notification, room=room)
+        self.socketio.emit('notification', notification, room=room, key=(notification['type'], lead['id']))
         print(f"🔔 Notificação enviada: Novo lead {lead['id']}")
     
     def notify_new_message(self, lead: Dict[str, Any], message: str, room: str = 'gestores'):
@@ -97,7 +119,7 @@ class NotificationService:
             'sound': 'new_message'
         }
         
-        self.socketio.emit('notification', notification, room=room)
+        self.socketio.emit('notification', notification, room=room, key=(notification['type'], lead['id']))
         print(f"🔔 Notificação enviada: Nova mensagem do lead {lead['id']}")
     
     def notify_sla_alert(self, lead: Dict[str, Any], minutes_waiting: int, room: str = 'gestores'):
@@ -125,7 +147,7 @@ class NotificationService:
             'sound': 'sla_alert'
         }
         
-        self.socketio.emit('notification', notification, room=room)
+        self.socketio.emit('notification', notification, room=room, key=(notification['type'], lead['id']))
         print(f"🔔 Notificação enviada: Alerta SLA lead {lead['id']}")
     
     def notify_status_changed(self, lead: Dict[str, Any], old_status: str, new_status: str, room: str = 'gestores'):
@@ -165,7 +187,7 @@ class NotificationService:
             'sound': 'status_changed' if new_status != 'ganho' else 'lead_won'
         }
         
-        self.socketio.emit('notification', notification, room=room)
+        self.socketio.emit('notification', notification, room=room, key=(notification['type'], lead['id']))
         print(f"🔔 Notificação enviada: Status mudou lead {lead['id']}")
     
     def notify_lead_assigned(self, lead: Dict[str, Any], vendedor_name: str, vendedor_id: int, room: str = 'gestores'):
@@ -196,10 +218,10 @@ class NotificationService:
         }
         
         # Envia para gestores
-        self.socketio.emit('notification', notification, room='gestores')
+        self.socketio.emit('notification', notification, room='gestores', key=(notification['type'], lead['id']))
         
         # Envia para o vendedor específico
-        self.socketio.emit('notification', notification, room=f'user_{vendedor_id}')
+        self.socketio.emit('notification', notification, room=f'user_{vendedor_id}', key=(notification['type'], lead['id']))
         
         print(f"🔔 Notificação enviada: Lead {lead['id']} atribuído")
     
@@ -232,10 +254,10 @@ class NotificationService:
         }
         
         # Envia para gestores
-        self.socketio.emit('notification', notification, room='gestores')
+        self.socketio.emit('notification', notification, room='gestores', key=(notification['type'], lead['id']))
         
         # Envia para o novo vendedor
-        self.socketio.emit('notification', notification, room=f'user_{to_vendedor_id}')
+        self.socketio.emit('notification', notification, room=f'user_{to_vendedor_id}', key=(notification['type'], lead['id']))
         
         print(f"🔔 Notificação enviada: Lead {lead['id']} transferido")
     
@@ -0,0 +1,430 @@
+"""
+Fila de saída das mensagens WhatsApp
+
+Quem envia só enfileira (WhatsAppService.queue_message) e recebe um handle;
+o dispatcher entrega para a ponte em segundo plano:
+
+- Token bucket global (WHATSAPP_SEND_RATE msgs/s, rajada WHATSAPP_SEND_BURST)
+  para não sermos limitados pelo WhatsApp
+- FIFO por telefone: uma mensagem só sai depois das anteriores do mesmo número
+- Faixas de prioridade entre telefones: IA > vendedor > alertas > campanhas
+- Falha de entrega volta para a fila com espera exponencial; esgotadas as
+  tentativas fica 'failed'
+- Callbacks de status (queued → sent | failed | unknown): o WhatsAppService atualiza
+  messages.delivery_status e avisa o front
+
+- Ponte indisponível (is_available falso ou DeliveryDeferred na entrega):
+  as mensagens esperam na fila sem gastar tentativas e saem quando voltar
+- Resultado incerto (DeliveryUncertain, ex.: timeout de leitura): a ponte
+  pode ter enviado, então a mensagem não é reenviada e fica 'unknown'
+
+A fila fica no SQLite (sobrevive a reinícios, vale entre processos); o
+limite de taxa é por processo.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+# Faixas de prioridade (menor sai primeiro)
+PRIORITY_IA = 0
+PRIORITY_VENDEDOR = 1
+PRIORITY_ALERT = 2
+PRIORITY_CAMPAIGN = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_IA: 'ia',
+    PRIORITY_VENDEDOR: 'vendedor',
+    PRIORITY_ALERT: 'alerta',
+    PRIORITY_CAMPAIGN: 'campanha',
+}
+
+
+OUTBOUND_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS outbound_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone TEXT NOT NULL,
+        content TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 1,
+        lead_id INTEGER,
+        message_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        locked_by TEXT,
+        locked_at REAL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        sent_at REAL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_outbound_status_priority ON outbound_messages(status, priority, id)",
+    "CREATE INDEX IF NOT EXISTS idx_outbound_phone_status ON outbound_messages(phone, status, id)",
+]
+
+
+class DeliveryDeferred(Exception):
+    """Entrega adiada (ex.: circuito aberto): volta para a fila sem contar tentativa"""
+
+
+class DeliveryUncertain(Exception):
+    """A ponte pode ter enviado (ex.: timeout de leitura): não reenviar"""
+
+
+class TokenBucket:
+    """Limite de taxa: `rate` fichas por segundo, acumulando até `burst`"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Espera até haver uma ficha e a consome"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def refund(self):
+        """Devolve uma ficha consumida sem envio"""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class OutboundQueue:
+    """
+    Fila de saída com dispatcher
+
+    Usage:
+        outbound = OutboundQueue(db, deliver=whatsapp.deliver, on_status=whatsapp.delivery_status,
+                                 is_available=whatsapp.bridge_available)
+        outbound.start()
+        handle = outbound.enqueue("5551999999999", "Olá!", priority=PRIORITY_VENDEDOR)
+    """
+
+    LEASE_SECONDS = 120
+    MAX_BACKOFF_SECONDS = 300
+
+    DEFER_SECONDS = 5
+
+    def __init__(self, database, deliver: Callable[[str, str], None],
+                 on_status: Optional[Callable[[Dict], None]] = None,
+                 is_available: Optional[Callable[[], bool]] = None):
+        self.db = database
+        self.deliver = deliver
+        self.on_status = on_status
+        self.listeners: List[Callable[[Dict], None]] = []
+        self.is_available = is_available
+        self.workers = int(os.getenv("WHATSAPP_SEND_WORKERS", "2"))
+        self.max_attempts = int(os.getenv("WHATSAPP_SEND_MAX_ATTEMPTS", "5"))
+        self.retention = float(os.getenv("WHATSAPP_SEND_RETENTION_HOURS", "24")) * 3600
+        self.bucket = TokenBucket(
+            rate=float(os.getenv("WHATSAPP_SEND_RATE", "1")),
+            burst=int(os.getenv("WHATSAPP_SEND_BURST", "5"))
+        )
+        self.running = False
+        self._threads = []
+        self._wake = threading.Event()
+        self._last_maintenance = 0.0
+        self._lock = threading.Lock()
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.deferred = 0
+        self.unknown = 0
+
+    def _count(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    # =============================
+    # ENFILEIRAMENTO
+    # =============================
+    def enqueue(self, phone: str, content: str, priority: int = PRIORITY_VENDEDOR,
+                lead_id: Optional[int] = None, message_id: Optional[int] = None) -> Dict:
+        """
+        Enfileira uma mensagem
+
+        Returns:
+            handle: {"id", "message_id", "status": "queued", "priority"}
+        """
+        now = time.time()
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute("""
+                INSERT INTO outbound_messages
+                    (phone, content, priority, lead_id, message_id, available_at, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (phone, content, priority, lead_id, message_id, now, now))
+            conn.commit()
+            outbound_id = cursor.lastrowid
+        finally:
+            conn.close()
+
+        self._wake.set()
+
+        return {
+            "id": outbound_id,
+            "message_id": message_id,
+            "status": "queued",
+            "priority": PRIORITY_NAMES.get(priority, priority)
+        }
+
+    def enqueue_batch(self, conn, items: List[Dict], priority: int = PRIORITY_CAMPAIGN) -> Dict[int, int]:
+        """
+        Enfileira várias mensagens num único INSERT, na transação do chamador
+
+        items: [{"phone", "content", "lead_id", "message_id"}, ...]
+
+        Returns:
+            {message_id: id na fila} (itens sem message_id ficam de fora)
+        """
+        if not items:
+            return {}
+        now = time.time()
+        rows = conn.execute("""
+            INSERT INTO outbound_messages
+                (phone, content, priority, lead_id, message_id, available_at, created_at)
+            SELECT
+                json_extract(value, '$.phone'), json_extract(value, '$.content'), ?,
+                json_extract(value, '$.lead_id'), json_extract(value, '$.message_id'), ?, ?
+            FROM json_each(?)
+            RETURNING id, message_id
+        """, (priority, now, now, json.dumps(items, ensure_ascii=False))).fetchall()
+        self._wake.set()
+        return {row["message_id"]: row["id"] for row in rows if row["message_id"] is not None}
+
+    def cancel_messages(self, message_ids: List[int]) -> List[int]:
+        """
+        Tira da fila as mensagens ainda não enviadas (status 'cancelled')
+
+        Returns:
+            message_ids efetivamente cancelados (as que já estavam saindo seguem)
+        """
+        conn = self.db.get_connection()
+        try:
+            rows = conn.execute("""
+                UPDATE outbound_messages
+                SET status = 'cancelled', last_error = 'cancelada'
+                WHERE status = 'queued' AND message_id IN (SELECT value FROM json_each(?))
+                RETURNING message_id
+            """, (json.dumps(list(message_ids)),)).fetchall()
+            conn.commit()
+            return [row["message_id"] for row in rows]
+        finally:
+            conn.close()
+
+    def add_status_listener(self, listener: Callable[[Dict], None]):
+        """Callback extra de status (além de on_status), chamado para toda mensagem"""
+        self.listeners.append(listener)
+
+    def get(self, outbound_id: int) -> Optional[Dict]:
+        """Situação atual de um handle"""
+        conn = self.db.get_connection()
+        try:
+            row = conn.execute("""
+                SELECT id, phone, priority, lead_id, message_id, status, attempts, last_error, created_at, sent_at
+                FROM outbound_messages WHERE id = ?
+            """, (outbound_id,)).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+    # =============================
+    # DISPATCHER
+    # =============================
+    def _worker_id(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    def claim(self) -> Optional[Dict]:
+        """Próxima mensagem: cabeça da fila de cada telefone, por prioridade"""
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute("""
+                UPDATE outbound_messages
+                SET status = 'sending', locked_by = ?, locked_at = ?, attempts = attempts + 1
+                WHERE id = (
+                    SELECT o.id FROM outbound_messages o
+                    WHERE o.status = 'queued' AND o.available_at <= ?
+                      AND NOT EXISTS (
+                          SELECT 1 FROM outbound_messages prev
+                          WHERE prev.phone = o.phone AND prev.status IN ('queued', 'sending')
+                            AND prev.id < o.id
+                      )
+                    ORDER BY o.priority, o.id
+                    LIMIT 1
+                )
+                RETURNING *
+            """, (self._worker_id(), now, now)).fetchone()
+        return dict(row) if row else None
+
+    def _finish(self, item: Dict, status: str, error: Optional[str] = None):
+        now = time.time()
+        conn = self.db.get_connection()
+        try:
+            conn.execute("""
+                UPDATE outbound_messages
+                SET status = ?, last_error = ?, sent_at = ?, locked_by = NULL, locked_at = NULL
+                WHERE id = ?
+            """, (status, error, now if status == 'sent' else None, item["id"]))
+            conn.commit()
+        finally:
+            conn.close()
+
+        item = {**item, "status": status, "last_error": error}
+        for notify in (self.on_status, *self.listeners):
+            if notify is None:
+                continue
+            try:
+                notify(item)
+            except Exception as e:
+                print(f"⚠️ Erro no callback de status da mensagem {item['id']}: {e}")
+
+    def _requeue(self, item: Dict, delay: float, error: str, refund_attempt: bool = False):
+        conn = self.db.get_connection()
+        try:
+            conn.execute("""
+                UPDATE outbound_messages
+                SET status = 'queued', available_at = ?, last_error = ?, locked_by = NULL, locked_at = NULL,
+                    attempts = attempts - ?
+                WHERE id = ?
+            """, (time.time() + delay, error, 1 if refund_attempt else 0, item["id"]))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _retry(self, item: Dict, error: str):
+        delay = min(2 ** item["attempts"], self.MAX_BACKOFF_SECONDS)
+        self._requeue(item, delay, error)
+        print(f"🔁 Envio {item['id']} para {item['phone']} falhou, nova tentativa em {delay}s: {error}")
+
+    def dispatch_one(self) -> bool:
+        """Entrega uma mensagem; retorna False se não havia nada pronto"""
+        if self.is_available is not None and not self.is_available():
+            return False
+
+        # A ficha vem antes da reserva: a espera por ela não corre contra o
+        # LEASE_SECONDS de uma mensagem já marcada como 'sending'
+        self.bucket.acquire()
+        item = self.claim()
+        if item is None:
+            self.bucket.refund()
+            return False
+
+        try:
+            self.deliver(item["phone"], item["content"])
+        except DeliveryDeferred as e:
+            self._count('deferred')
+            self._requeue(item, self.DEFER_SECONDS, str(e), refund_attempt=True)
+        except DeliveryUncertain as e:
+            self._count('unknown')
+            print(f"⚠️ Envio {item['id']} para {item['phone']} sem confirmação, não será reenviado: {e}")
+            self._finish(item, 'unknown', f"{type(e).__name__}: {e}")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if item["attempts"] < self.max_attempts:
+                self._count('retried')
+                self._retry(item, error)
+            else:
+                self._count('failed')
+                print(f"❌ Envio {item['id']} para {item['phone']} desistido após {item['attempts']} tentativas")
+                self._finish(item, 'failed', error)
+        else:
+            self._count('sent')
+            self._finish(item, 'sent')
+        return True
+
+    def maintenance(self):
+        """Devolve envios presos por workers mortos e apaga o histórico antigo"""
+        now = time.time()
+        conn = self.db.get_connection()
+        try:
+            conn.execute("""
+                UPDATE outbound_messages
+                SET status = 'queued', locked_by = NULL, locked_at = NULL
+                WHERE status = 'sending' AND locked_at < ?
+            """, (now - self.LEASE_SECONDS,))
+            conn.execute(
+                "DELETE FROM outbound_messages WHERE status IN ('sent', 'failed', 'unknown', 'cancelled') AND created_at < ?",
+                (now - self.retention,)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _loop(self):
+        while self.running:
+            try:
+                if time.time() - self._last_maintenance > 60:
+                    self._last_maintenance = time.time()
+                    self.maintenance()
+                if self.dispatch_one():
+                    continue
+            except Exception as e:
+                print(f"❌ Erro no dispatcher de mensagens: {e}")
+            self._wake.wait(timeout=1)
+            self._wake.clear()
+
+    def start(self):
+        """Inicia os workers do dispatcher"""
+        if self.running:
+            return
+        self.running = True
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"📤 Fila de envio ativa ({self.workers} workers, {self.bucket.rate} msg/s, rajada {self.bucket.burst})")
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    # =============================
+    # MONITORAMENTO
+    # =============================
+    def get_stats(self) -> Dict:
+        now = time.time()
+        conn = self.db.get_connection()
+        try:
+            rows = conn.execute("""
+                SELECT priority, COUNT(*) AS depth, MIN(created_at) AS oldest
+                FROM outbound_messages
+                WHERE status IN ('queued', 'sending')
+                GROUP BY priority
+            """).fetchall()
+        finally:
+            conn.close()
+
+        oldest = min((row["oldest"] for row in rows), default=None)
+        return {
+            "depth": sum(row["depth"] for row in rows),
+            "by_priority": {PRIORITY_NAMES.get(row["priority"], row["priority"]): row["depth"] for row in rows},
+            "lag_seconds": round(now - oldest, 3) if oldest else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "deferred": self.deferred,
+            "unknown": self.unknown,
+            "paused": self.is_available is not None and not self.is_available(),
+            "rate_per_second": self.bucket.rate,
+            "workers": self.workers if self.running else 0
+        }
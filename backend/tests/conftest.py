@@ -0,0 +1,32 @@
+"""
+Fixtures dos testes: banco SQLite descartável (com todas as migrações) e
+um emissor Socket.IO que só registra os eventos
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+class RecordingEmitter:
+    """Substitui o socketio: guarda (evento, payload, kwargs)"""
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, payload=None, **kwargs):
+        self.events.append((event, payload, kwargs))
+
+
+@pytest.fixture
+def db(tmp_path):
+    return Database(str(tmp_path / "crm.db"))
+
+
+@pytest.fixture
+def emitter():
+    return RecordingEmitter()
@@ -0,0 +1,143 @@
+"""Campanhas: distribuição, progresso, cancelamento x lote e retomada"""
+import pytest
+
+import campaigns as campaigns_module
+from campaigns import CampaignService
+from outbound_queue import OutboundQueue, TokenBucket, PRIORITY_CAMPAIGN
+
+
+class InlineThread:
+    """Roda o alvo na hora (a distribuição fica síncrona no teste)"""
+
+    def __init__(self, target, args=(), daemon=None):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@pytest.fixture(autouse=True)
+def inline_threads(monkeypatch):
+    monkeypatch.setattr(campaigns_module.threading, "Thread", InlineThread)
+
+
+@pytest.fixture
+def queue(db):
+    queue = OutboundQueue(db, deliver=lambda phone, content: None)
+    queue.bucket = TokenBucket(rate=1000, burst=1000)
+    return queue
+
+
+@pytest.fixture
+def service(db, queue, emitter):
+    service = CampaignService(db, queue, emitter)
+    service.batch_size = 2
+    queue.add_status_listener(service.delivery_status)
+    return service
+
+
+@pytest.fixture
+def leads(db):
+    created = [db.create_or_get_lead(f"55519999900{i:02d}", f"Lead {i}") for i in range(5)]
+    conn = db.get_connection()
+    conn.execute("UPDATE leads SET classification = 'cold'")
+    conn.execute("UPDATE leads SET classification = 'hot' WHERE id = ?", (created[-1]["id"],))
+    conn.commit()
+    conn.close()
+    return created
+
+
+USER = {"id": 1, "name": "Gestor"}
+FILTERS = {"classification": "cold"}
+
+
+def _count(db, sql, params=()):
+    conn = db.get_connection()
+    value = conn.execute(sql, params).fetchone()[0]
+    conn.close()
+    return value
+
+
+def _insert_campaign(db):
+    """Campanha 'running' sem distribuição (como se o processo tivesse caído logo após criá-la)"""
+    conn = db.get_connection()
+    cursor = conn.execute("""
+        INSERT INTO campaigns (name, template, filters, total) VALUES ('c', 'Oi {nome}', '{"classification": "cold"}', 4)
+    """)
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid
+
+
+def test_preview_renders_the_segment(service, leads):
+    preview = service.preview("Oi {nome}", FILTERS, limit=2)
+    assert preview["total"] == 4
+    assert [item["content"] for item in preview["sample"]] == ["Oi Lead 0", "Oi Lead 1"]
+
+
+def test_segment_requires_a_filter(service):
+    with pytest.raises(ValueError):
+        service.preview("Oi", {})
+
+
+def test_fan_out_and_delivery_complete_the_campaign(db, service, queue, leads):
+    campaign = service.create("Reativação", "Oi {nome}", FILTERS, USER)
+
+    campaign = service.get(campaign["id"])
+    assert (campaign["queued"], campaign["total"], campaign["fanout_done"]) == (4, 4, 1)
+    assert _count(db, "SELECT COUNT(*) FROM outbound_messages WHERE priority = ?", (PRIORITY_CAMPAIGN,)) == 4
+
+    while queue.dispatch_one():
+        pass
+
+    campaign = service.get(campaign["id"])
+    assert campaign["status"] == "completed"
+    assert service.progress(campaign)["percent"] == 100.0
+    assert campaign["sent"] == 4
+    assert _count(db, "SELECT COUNT(*) FROM campaign_recipients WHERE status = 'sent'") == 4
+
+
+def test_batch_after_cancel_writes_nothing(db, service, leads):
+    campaign_id = _insert_campaign(db)
+    campaign = service.get(campaign_id)
+    service.cancel(campaign_id)
+
+    assert service._write_batch(campaign, leads[:2]) is False
+    assert _count(db, "SELECT COUNT(*) FROM messages") == 0
+    assert _count(db, "SELECT COUNT(*) FROM outbound_messages") == 0
+
+
+def test_cancel_after_batch_takes_its_messages_off_the_queue(db, service, leads):
+    campaign_id = _insert_campaign(db)
+    assert service._write_batch(service.get(campaign_id), leads[:2]) is True
+
+    campaign = service.cancel(campaign_id)
+
+    assert campaign["status"] == "cancelled"
+    assert campaign["cancelled"] == 2
+    assert _count(db, "SELECT COUNT(*) FROM outbound_messages WHERE status = 'queued'") == 0
+    assert _count(db, "SELECT COUNT(*) FROM messages WHERE delivery_status = 'cancelled'") == 2
+
+
+def test_resume_continues_after_the_last_recipient(db, service, leads):
+    campaign_id = _insert_campaign(db)
+    service._write_batch(service.get(campaign_id), leads[:2])
+
+    assert service.resume_pending() == [campaign_id]
+
+    campaign = service.get(campaign_id)
+    assert (campaign["queued"], campaign["fanout_done"]) == (4, 1)
+    assert _count(db, "SELECT COUNT(*) FROM outbound_messages") == 4
+    assert service.resume_pending() == []
+
+
+def test_replayed_batch_does_not_duplicate(db, service, leads):
+    campaign_id = _insert_campaign(db)
+    campaign = service.get(campaign_id)
+    service._write_batch(campaign, leads[:2])
+    service._write_batch(campaign, leads[:3])
+
+    assert service.get(campaign_id)["queued"] == 3
+    assert _count(db, "SELECT COUNT(*) FROM outbound_messages") == 3
+    assert _count(db, "SELECT COUNT(*) FROM campaign_recipients") == 3
@@ -0,0 +1,103 @@
+"""CircuitBreaker: closed → open → half-open → closed/open"""
+import time
+
+import pytest
+
+from circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Relógio controlado pelo teste (time.time do módulo)"""
+    now = [1000.0]
+    monkeypatch.setattr("circuit_breaker.time.time", lambda: now[0])
+    return now
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("ponte", failure_threshold=3, reset_timeout=30)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker("ponte", failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_a_single_trial(clock):
+    breaker = CircuitBreaker("ponte", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock[0] += 29
+    assert not breaker.allow()
+
+    clock[0] += 1
+    # is_open não consome a chamada de teste
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+
+def test_trial_success_closes(clock):
+    breaker = CircuitBreaker("ponte", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_trial_failure_reopens_and_restarts_the_wait(clock):
+    breaker = CircuitBreaker("ponte", failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+
+
+def test_status_reports_transitions_and_retry_time(clock):
+    breaker = CircuitBreaker("ponte", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 10
+
+    status = breaker.get_status()
+    assert status["state"] == "open"
+    assert status["retry_in"] == 20
+    assert status["transitions"] == {"closed->open": 1}
+
+    clock[0] += 20
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.get_status()["transitions"] == {
+        "closed->open": 1, "open->half_open": 1, "half_open->closed": 1
+    }
+
+
+def test_real_clock_smoke():
+    breaker = CircuitBreaker("ponte", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
@@ -0,0 +1,72 @@
+"""Migrações: idempotentes e seguras com vários workers subindo juntos"""
+import multiprocessing
+import os
+import sys
+
+from database import Database
+from migrations import MIGRATIONS, apply_migrations, get_schema_version
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_second_run_applies_nothing(db):
+    assert get_schema_version(db) == max(version for version, _, _ in MIGRATIONS)
+    assert apply_migrations(db) == []
+
+
+def test_reopening_the_database_keeps_data(tmp_path):
+    path = str(tmp_path / "crm.db")
+    lead = Database(path).create_or_get_lead("5551999998888", "Lead")
+
+    again = Database(path)
+    assert again.get_lead(lead["id"])["phone"] == "5551999998888"
+
+
+def _start_worker(path, barrier, results):
+    sys.path.insert(0, BACKEND_DIR)
+    from database import Database as WorkerDatabase
+
+    barrier.wait()
+    try:
+        WorkerDatabase(path)
+        results.put("ok")
+    except Exception as e:  # pragma: no cover - só em caso de regressão
+        results.put(f"{type(e).__name__}: {e}")
+
+
+def test_concurrent_workers_do_not_crash(tmp_path):
+    path = str(tmp_path / "crm.db")
+    ctx = multiprocessing.get_context("spawn")
+    workers = 4
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+
+    processes = [ctx.Process(target=_start_worker, args=(path, barrier, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+
+    assert sorted(results.get(timeout=5) for _ in processes) == ["ok"] * workers
+
+    db = Database(path)
+    conn = db.get_connection()
+    versions = [row[0] for row in conn.execute("SELECT version FROM schema_migrations ORDER BY version")]
+    conn.close()
+    assert versions == [version for version, _, _ in MIGRATIONS]
+
+
+def test_phone_normalization_merges_only_brazilian_numbers(db):
+    from migrations import _normalize_lead_phones
+
+    conn = db.get_connection()
+    for phone in ("5551999998888", "51999998888", "14155550100", "+1 415 555 0100"):
+        conn.execute("INSERT INTO leads (phone, name) VALUES (?, 'Lead')", (phone,))
+    _normalize_lead_phones(conn)
+    conn.commit()
+    phones = sorted(row[0] for row in conn.execute("SELECT phone FROM leads"))
+    conn.close()
+
+    # O número brasileiro é unido; o estrangeiro já ocupado fica como está
+    assert phones == ["+1 415 555 0100", "14155550100", "5551999998888"]
@@ -0,0 +1,141 @@
+"""Fila de saída: FIFO por telefone, prioridade, novas tentativas e entregas adiadas/incertas"""
+import pytest
+
+from outbound_queue import (
+    OutboundQueue, TokenBucket, DeliveryDeferred, DeliveryUncertain,
+    PRIORITY_IA, PRIORITY_VENDEDOR, PRIORITY_CAMPAIGN,
+)
+
+
+class Bridge:
+    """deliver falso: registra os envios e levanta o erro programado para cada conteúdo"""
+
+    def __init__(self):
+        self.sent = []
+        self.errors = {}
+
+    def deliver(self, phone, content):
+        error = self.errors.get(content)
+        if error is not None:
+            raise error
+        self.sent.append((phone, content))
+
+
+@pytest.fixture
+def bridge():
+    return Bridge()
+
+
+@pytest.fixture
+def statuses():
+    return []
+
+
+@pytest.fixture
+def queue(db, bridge, statuses):
+    queue = OutboundQueue(db, deliver=bridge.deliver, on_status=statuses.append)
+    queue.bucket = TokenBucket(rate=1000, burst=1000)
+    queue.max_attempts = 2
+    return queue
+
+
+def _drain(queue):
+    while queue.dispatch_one():
+        pass
+
+
+def _make_due(db):
+    conn = db.get_connection()
+    conn.execute("UPDATE outbound_messages SET available_at = 0")
+    conn.commit()
+    conn.close()
+
+
+def test_priority_across_phones_fifo_within_phone(queue, bridge):
+    queue.enqueue("5551", "campanha 1", priority=PRIORITY_CAMPAIGN)
+    queue.enqueue("5551", "ia 1", priority=PRIORITY_IA)
+    queue.enqueue("5552", "vendedor", priority=PRIORITY_VENDEDOR)
+    queue.enqueue("5553", "ia 2", priority=PRIORITY_IA)
+
+    _drain(queue)
+
+    # IA de 5551 não fura a campanha enfileirada antes para o mesmo telefone
+    assert bridge.sent == [
+        ("5553", "ia 2"),
+        ("5552", "vendedor"),
+        ("5551", "campanha 1"),
+        ("5551", "ia 1"),
+    ]
+
+
+def test_failure_retries_then_fails_and_blocks_the_phone(db, queue, bridge, statuses):
+    bridge.errors["primeira"] = RuntimeError("HTTP 500")
+    first = queue.enqueue("5551", "primeira")
+    queue.enqueue("5551", "segunda")
+
+    assert queue.dispatch_one() is True
+    # Aguardando nova tentativa: a segunda mensagem não sai antes
+    assert queue.dispatch_one() is False
+    assert queue.get(first["id"])["status"] == "queued"
+
+    _make_due(db)
+    _drain(queue)
+
+    assert queue.get(first["id"])["status"] == "failed"
+    assert bridge.sent == [("5551", "segunda")]
+    assert [item["status"] for item in statuses] == ["failed", "sent"]
+
+
+def test_deferred_delivery_does_not_spend_attempts(db, queue, bridge):
+    bridge.errors["oi"] = DeliveryDeferred("circuito aberto")
+    handle = queue.enqueue("5551", "oi")
+
+    for _ in range(3):
+        assert queue.dispatch_one() is True
+        _make_due(db)
+
+    row = queue.get(handle["id"])
+    assert row["status"] == "queued"
+    assert row["attempts"] == 0
+    assert queue.deferred == 3
+
+
+def test_uncertain_delivery_is_not_resent(db, queue, bridge, statuses):
+    bridge.errors["oi"] = DeliveryUncertain("timeout de leitura")
+    handle = queue.enqueue("5551", "oi")
+
+    assert queue.dispatch_one() is True
+    _make_due(db)
+    assert queue.dispatch_one() is False
+
+    assert queue.get(handle["id"])["status"] == "unknown"
+    assert [item["status"] for item in statuses] == ["unknown"]
+
+
+def test_unavailable_bridge_keeps_messages_queued(db, bridge):
+    queue = OutboundQueue(db, deliver=bridge.deliver, is_available=lambda: False)
+    handle = queue.enqueue("5551", "oi")
+
+    assert queue.dispatch_one() is False
+    assert queue.get(handle["id"])["status"] == "queued"
+    assert bridge.sent == []
+
+
+def test_empty_queue_refunds_the_token(queue):
+    queue.bucket = TokenBucket(rate=0.001, burst=1)
+    assert queue.dispatch_one() is False
+    # Sem mensagem pronta a ficha volta: o próximo envio não espera
+    assert queue.bucket.tokens == pytest.approx(1)
+
+
+def test_cancel_only_takes_queued_messages(db, queue):
+    conn = db.get_connection()
+    conn.execute("INSERT INTO messages (lead_id, sender_type, sender_name, content) VALUES (1, 'campanha', 'c', 'a')")
+    conn.execute("INSERT INTO messages (lead_id, sender_type, sender_name, content) VALUES (1, 'campanha', 'c', 'b')")
+    conn.commit()
+    conn.close()
+    queue.enqueue("5551", "a", message_id=1)
+    queue.enqueue("5552", "b", message_id=2)
+
+    sending = queue.claim()
+    assert queue.cancel_messages([1, 2]) == [2 if sending["message_id"] == 1 else 1]
@@ -0,0 +1,131 @@
+"""Fila de webhooks: ordem por telefone, novas tentativas, dead letter, dedup e lease"""
+import json
+
+import pytest
+
+from webhook_outbox import WebhookOutbox
+
+
+def _make_due(db):
+    """Adianta o relógio das novas tentativas (espera exponencial)"""
+    conn = db.get_connection()
+    conn.execute("UPDATE webhook_outbox SET available_at = 0")
+    conn.commit()
+    conn.close()
+
+
+def _rows(db, table):
+    conn = db.get_connection()
+    rows = [dict(row) for row in conn.execute(f"SELECT * FROM {table} ORDER BY id").fetchall()]
+    conn.close()
+    return rows
+
+
+@pytest.fixture
+def outbox(db):
+    return WebhookOutbox(db, handler=lambda event: None, workers=0, max_attempts=2)
+
+
+def test_claim_keeps_per_phone_order(outbox):
+    first = outbox.enqueue("5551", {"n": 1})
+    outbox.enqueue("5551", {"n": 2})
+    other = outbox.enqueue("5552", {"n": 3})
+
+    claimed = outbox.claim()
+    assert claimed["id"] == first
+    # O segundo evento de 5551 espera o primeiro; 5552 segue livre
+    assert outbox.claim()["id"] == other
+    assert outbox.claim() is None
+
+    outbox.complete(claimed)
+    assert json.loads(outbox.claim()["payload"]) == {"n": 2}
+
+
+def test_failed_event_blocks_its_phone_until_retried(db, outbox):
+    outbox.enqueue("5551", {"n": 1})
+    outbox.enqueue("5551", {"n": 2})
+
+    event = outbox.claim()
+    assert outbox.fail(event, "erro") is True
+    # Aguardando nova tentativa: o evento seguinte do telefone não passa na frente
+    assert outbox.claim() is None
+
+    _make_due(db)
+    retried = outbox.claim()
+    assert retried["id"] == event["id"]
+    assert retried["attempts"] == 2
+
+
+def test_exhausted_attempts_go_to_dead_letter(db):
+    def handler(event):
+        raise RuntimeError("Sheets fora do ar")
+
+    outbox = WebhookOutbox(db, handler=handler, workers=0, max_attempts=2)
+    event_id = outbox.enqueue("5551", {"n": 1})
+
+    assert outbox.process_one() is True
+    _make_due(db)
+    assert outbox.process_one() is True
+    assert outbox.process_one() is False
+
+    assert _rows(db, "webhook_outbox") == []
+    dead = _rows(db, "webhook_dead_letter")
+    assert [(row["outbox_id"], row["attempts"]) for row in dead] == [(event_id, 2)]
+    assert "Sheets fora do ar" in dead[0]["last_error"]
+    assert outbox.get_stats()["dead_letters"] == 1
+
+
+def test_duplicate_keys_are_rejected_across_instances(db, outbox):
+    assert outbox.enqueue("5551", {"n": 1}, dedup_key="id:ABC") is not None
+    assert outbox.enqueue("5551", {"n": 1}, dedup_key="id:ABC") is None
+
+    # Outro processo: LRU vazio, o índice único decide
+    other = WebhookOutbox(db, handler=lambda event: None, workers=0)
+    assert other.enqueue("5551", {"n": 1}, dedup_key="id:ABC") is None
+    assert len(_rows(db, "webhook_outbox")) == 1
+
+
+def test_events_without_key_are_not_deduplicated(outbox):
+    assert outbox.enqueue("5551", {"n": 1}) is not None
+    assert outbox.enqueue("5551", {"n": 1}) is not None
+
+
+def test_stale_owner_cannot_complete_or_fail(db, outbox):
+    outbox.enqueue("5551", {"n": 1})
+    stale = outbox.claim()
+
+    # Lease expirado: o evento volta para a fila e outro worker o reserva
+    outbox.lease_seconds = -1
+    outbox.recover_abandoned()
+    owner = outbox.claim()
+    assert owner["id"] == stale["id"] and owner["locked_by"] != stale["locked_by"]
+
+    assert outbox.complete(stale) is False
+    assert outbox.fail(stale, "erro") is False
+    assert _rows(db, "webhook_outbox")[0]["status"] == "processing"
+
+    assert outbox.renew_lease(owner) is True
+    assert outbox.complete(owner) is True
+    assert _rows(db, "webhook_outbox") == []
+    assert outbox.get_stats()["lost_leases"] == 2
+
+
+def test_retry_after_recording_skips_the_insert(db):
+    calls = []
+
+    def handler(event):
+        calls.append(event["message_id"])
+        if event["message_id"] is None:
+            db.record_inbound_message(event["phone"], "Lead", event["content"], outbox_id=event["outbox_id"])
+            raise RuntimeError("notificação falhou")
+
+    outbox = WebhookOutbox(db, handler=handler, workers=0)
+    outbox.enqueue("5551999998888", {"phone": "5551999998888", "content": "oi"})
+
+    outbox.process_one()
+    _make_due(db)
+    outbox.process_one()
+
+    assert calls[0] is None and calls[1] is not None
+    assert len(_rows(db, "messages")) == 1
+    assert _rows(db, "webhook_outbox") == []
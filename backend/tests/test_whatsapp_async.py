@@ -0,0 +1,130 @@
+"""AsyncWhatsAppService contra uma ponte aiohttp local"""
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+from outbound_queue import OutboundQueue  # noqa: E402
+from whatsapp_service import AsyncWhatsAppService  # noqa: E402
+
+
+PHONE = "5551999998888"
+
+
+async def _bridge(send_status=200):
+    """Ponte falsa: /status conectado, /send responde send_status; retorna (runner, url, enviados)"""
+    sent = []
+
+    async def status(request):
+        return web.json_response({"connected": True, "phone": PHONE})
+
+    async def send(request):
+        sent.append(await request.json())
+        return web.Response(status=send_status, text="ok" if send_status == 200 else "erro")
+
+    app = web.Application()
+    app.router.add_get("/status", status)
+    app.router.add_post("/send", send)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", sent
+
+
+def _service(db, emitter, url):
+    service = AsyncWhatsAppService(db, emitter)
+    service.venom_url = url
+    service.retry_delay = 0
+    return service
+
+
+def test_send_message_records_vendedor_message(db, emitter):
+    lead = db.create_or_get_lead(PHONE, "Lead")
+
+    async def scenario():
+        runner, url, sent = await _bridge()
+        service = _service(db, emitter, url)
+        try:
+            ok = await service.send_message(PHONE, "Olá!", vendedor_id=1)
+        finally:
+            await service.close()
+            await runner.cleanup()
+        return ok, sent
+
+    ok, sent = asyncio.run(scenario())
+    assert ok is True
+    assert sent == [{"phone": PHONE, "message": "Olá!"}]
+    messages = db.get_messages_by_lead(lead["id"])
+    assert [(m["sender_type"], m["delivery_status"]) for m in messages] == [("vendedor", "sent")]
+
+
+def test_queue_message_without_queue_awaits_the_send(db, emitter):
+    db.create_or_get_lead(PHONE, "Lead")
+
+    async def scenario():
+        runner, url, sent = await _bridge(send_status=500)
+        service = _service(db, emitter, url)
+        service.max_retries = 1
+        try:
+            handle = await service.queue_message(PHONE, "Olá!", vendedor_id=1)
+        finally:
+            await service.close()
+            await runner.cleanup()
+        return handle, sent
+
+    handle, sent = asyncio.run(scenario())
+    # A ponte recusou: o handle não pode dizer "sent"
+    assert handle["status"] == "failed"
+    assert len(sent) == 1
+
+
+def test_queue_message_with_queue_enqueues(db, emitter):
+    lead = db.create_or_get_lead(PHONE, "Lead")
+
+    async def scenario():
+        service = AsyncWhatsAppService(db, emitter)
+        service.outbound = OutboundQueue(db, deliver=lambda phone, content: None)
+        try:
+            return await service.queue_message(PHONE, "Olá!", vendedor_id=1)
+        finally:
+            await service.close()
+
+    handle = asyncio.run(scenario())
+    assert handle["status"] == "queued"
+    assert handle["priority"] == "vendedor"
+    message = db.get_messages_by_lead(lead["id"])[0]
+    assert message["id"] == handle["message_id"]
+    assert message["delivery_status"] == "queued"
+
+
+def test_open_circuit_replays_through_the_queue(db, emitter):
+    db.create_or_get_lead(PHONE, "Lead")
+
+    async def scenario():
+        service = AsyncWhatsAppService(db, emitter)
+        queue = OutboundQueue(db, deliver=lambda phone, content: None)
+        service.outbound = queue
+        for _ in range(service.breaker.failure_threshold):
+            service.breaker.record_failure()
+        try:
+            ok = await service.send_message(PHONE, "Olá!", vendedor_id=1)
+        finally:
+            await service.close()
+        return ok, queue.get_stats()
+
+    ok, stats = asyncio.run(scenario())
+    assert ok is True
+    assert stats["by_priority"] == {"vendedor": 1}
+
+
+def test_thread_only_entry_points_raise(db, emitter):
+    service = AsyncWhatsAppService(db, emitter)
+    with pytest.raises(RuntimeError):
+        service.deliver(PHONE, "Olá!")
+    with pytest.raises(RuntimeError):
+        service.start_health_monitor()
+    asyncio.run(service.close())
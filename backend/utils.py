@@ -1,11 +1,63 @@
 """
 Utilidades para paginação, busca e performance
 """
-import sqlite3
-from typing import List, Dict, Any, Optional
+import base64
+import json
+import re
+from typing import List, Dict, Any, Optional, Sequence
 from datetime import datetime, timedelta
 
 
+# DDDs em uso no Brasil
+BRAZIL_DDDS = frozenset({
+    11, 12, 13, 14, 15, 16, 17, 18, 19, 21, 22, 24, 27, 28,
+    31, 32, 33, 34, 35, 37, 38, 41, 42, 43, 44, 45, 46, 47, 48, 49,
+    51, 53, 54, 55, 61, 62, 63, 64, 65, 66, 67, 68, 69,
+    71, 73, 74, 75, 77, 79, 81, 82, 83, 84, 85, 86, 87, 88, 89,
+    91, 92, 93, 94, 95, 96, 97, 98, 99,
+})
+
+
+def is_brazilian_local(digits: str) -> bool:
+    """DDD + número sem DDI: 10 dígitos (fixo) ou 11 com o 9 do celular"""
+    if len(digits) not in (10, 11) or int(digits[:2]) not in BRAZIL_DDDS:
+        return False
+    if len(digits) == 11:
+        return digits[2] == "9"
+    return digits[2] != "0" and digits[2] != "1"
+
+
+def is_brazilian_phone(phone: Optional[str]) -> bool:
+    """Telefone já normalizado com DDI 55 e DDD + número válidos"""
+    return bool(phone) and phone.startswith("55") and is_brazilian_local(phone[2:])
+
+
+def normalize_phone(phone) -> Optional[str]:
+    """
+    Normaliza telefone para a chave usada em leads.phone
+
+    Aceita JIDs do WhatsApp (5551999999999@c.us, ...@s.whatsapp.net),
+    "+55 51 99999-9999" etc. JIDs e números com "+" já trazem o DDI e
+    ficam como estão; sem DDI, só o que é DDD brasileiro + número (10 ou
+    11 dígitos) recebe o 55 na frente.
+
+    Returns:
+        Só os dígitos, ou None se não sobrar nenhum
+    """
+    if phone is None:
+        return None
+
+    text = str(phone).strip()
+    has_country_code = "@" in text or text.startswith("+")
+    raw = text.split("@")[0].split(":")[0]
+    digits = "".join(ch for ch in raw if ch.isdigit())
+
+    if not has_country_code and is_brazilian_local(digits):
+        digits = "55" + digits
+
+    return digits or None
+
+
 class Paginator:
     """
     Classe para paginar resultados
@@ -38,6 +90,101 @@ class Paginator:
         }
 
 
+def encode_cursor(values: Sequence[Any]) -> str:
+    """Codifica a chave da última linha da página num cursor opaco"""
+    raw = json.dumps(list(values), separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], size: int) -> Optional[tuple]:
+    """
+    Decodifica um cursor de encode_cursor
+
+    Returns:
+        Tupla com `size` valores, ou None para cursor vazio (primeira página)
+
+    Raises:
+        ValueError: cursor inválido ou de outra listagem
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Cursor inválido")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Cursor inválido")
+    return tuple(values)
+
+
+# Marcadores do trecho destacado nas buscas (negrito do WhatsApp, sem HTML)
+HIGHLIGHT_OPEN = "*"
+HIGHLIGHT_CLOSE = "*"
+
+
+def build_fts_query(term: Optional[str]) -> Optional[str]:
+    """
+    Converte o texto digitado numa consulta FTS5 segura
+
+    Cada palavra vira um prefixo entre aspas ("ola"* "mundo"*), então
+    operadores e aspas digitados pelo usuário não quebram o MATCH.
+
+    Returns:
+        Consulta para MATCH, ou None se não houver nenhuma palavra
+    """
+    if not term:
+        return None
+    words = re.findall(r"\w+", term)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class KeysetPaginator:
+    """
+    Paginação por cursor (keyset) feita no SQL
+
+    Em vez de OFFSET, a consulta continua a partir da chave da última
+    linha entregue (ex.: WHERE (updated_at, id) < (?, ?)), então o custo
+    de cada página não cresce com a profundidade.
+
+    Usage:
+        paginator = KeysetPaginator(request.args.get('cursor'), limit, ('updated_at', 'id'))
+        rows = db.get_leads_page(after=paginator.after, limit=paginator.fetch_limit)
+        return jsonify(paginator.to_dict(rows))
+    """
+    def __init__(self, cursor: Optional[str], limit: int = 50, key_fields: Sequence[str] = ("id",),
+                 max_limit: int = 200):
+        self.key_fields = tuple(key_fields)
+        self.limit = min(max_limit, max(1, limit))
+        self.after = decode_cursor(cursor, len(self.key_fields))
+
+    @property
+    def fetch_limit(self) -> int:
+        """Busca uma linha a mais para saber se existe próxima página"""
+        return self.limit + 1
+
+    def to_dict(self, rows: List[Dict[str, Any]], total_approx: Optional[int] = None) -> Dict[str, Any]:
+        """Converte para dicionário com metadados (mesmo formato do Paginator)"""
+        has_more = len(rows) > self.limit
+        items = rows[:self.limit]
+        next_cursor = None
+        if has_more and items:
+            last = items[-1]
+            next_cursor = encode_cursor([last[field] for field in self.key_fields])
+
+        pagination = {
+            "limit": self.limit,
+            "next_cursor": next_cursor,
+            "has_more": has_more
+        }
+        if total_approx is not None:
+            pagination["total_approx"] = total_approx
+
+        return {"items": items, "pagination": pagination}
+
+
 class MessageSearcher:
     """
     Busca otimizada de mensagens com filtros
@@ -53,7 +200,9 @@ class MessageSearcher:
         date_from: Optional[datetime] = None,
         date_to: Optional[datetime] = None,
         limit: int = 50,
-        offset: int = 0
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        include_total: bool = True
     ) -> Dict[str, Any]:
         """
         Busca mensagens com filtros avançados
@@ -66,50 +215,86 @@ class MessageSearcher:
             date_to: Data final
             limit: Quantidade máxima de resultados
             offset: Offset para paginação
+            cursor: Paginação por cursor (keyset em id); "" = primeira página.
+                Quando informado, offset é ignorado e o retorno traz next_cursor
+            include_total: Executa o COUNT(*) do total
         
         Returns:
             Dict com mensagens e total de resultados
         """
-        conn = sqlite3.connect(self.db.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        conn = self.db.get_connection()
+        db_cursor = conn.cursor()
         
-        # Construir query
-        query = "SELECT * FROM messages WHERE 1=1"
+        # Construir query (com termo: índice FTS5, ranking bm25 e trecho destacado)
+        fts_query = build_fts_query(search_term) if search_term else None
         params = []
         
+        if fts_query:
+            select = f"""
+                SELECT m.*,
+                       snippet(messages_fts, 0, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}', '…', 12) AS snippet,
+                       bm25(messages_fts) AS rank
+            """
+            query = " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ?"
+            params.append(fts_query)
+        else:
+            select = "SELECT m.*"
+            query = " FROM messages m WHERE 1=1"
+            if search_term:
+                # Termo sem nenhuma palavra (só pontuação): LIKE como antes
+                query += " AND m.content LIKE ?"
+                params.append(f"%{search_term}%")
+        
         # Filtros
         if lead_id:
-            query += " AND lead_id = ?"
+            query += " AND m.lead_id = ?"
             params.append(lead_id)
         
-        if search_term:
-            query += " AND content LIKE ?"
-            params.append(f"%{search_term}%")
-        
         if sender_type:
-            query += " AND sender_type = ?"
+            query += " AND m.sender_type = ?"
             params.append(sender_type)
         
         if date_from:
-            query += " AND timestamp >= ?"
+            query += " AND m.timestamp >= ?"
             params.append(date_from.isoformat())
         
         if date_to:
-            query += " AND timestamp <= ?"
+            query += " AND m.timestamp <= ?"
             params.append(date_to.isoformat())
         
         # Count total
-        count_query = query.replace("SELECT *", "SELECT COUNT(*)")
-        cursor.execute(count_query, params)
-        total = cursor.fetchone()[0]
+        total = None
+        if include_total:
+            db_cursor.execute("SELECT COUNT(*)" + query, params)
+            total = db_cursor.fetchone()[0]
+        
+        if cursor is not None:
+            # Keyset: continua depois do último id entregue
+            paginator = KeysetPaginator(cursor, limit, ("id",))
+            if paginator.after:
+                query += " AND m.id < ?"
+                params.append(paginator.after[0])
+            query += " ORDER BY m.id DESC LIMIT ?"
+            params.append(paginator.fetch_limit)
+            
+            db_cursor.execute(select + query, params)
+            page = paginator.to_dict([dict(row) for row in db_cursor.fetchall()], total)
+            conn.close()
+            
+            return {
+                "messages": page["items"],
+                "total": total,
+                "limit": paginator.limit,
+                "next_cursor": page["pagination"]["next_cursor"]
+            }
         
-        # Buscar com paginação
-        query += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
+        # Buscar com paginação (com termo: mais relevantes primeiro)
+        order = "rank, m.timestamp DESC" if fts_query else "m.timestamp DESC"
+        query += f" ORDER BY {order} LIMIT ? OFFSET ?"
         params.extend([limit, offset])
         
-        cursor.execute(query, params)
-        messages = [dict(row) for row in cursor.fetchall()]
+        db_cursor.execute(select + query, params)
+        messages = [dict(row) for row in db_cursor.fetchall()]
         
         conn.close()
         
@@ -120,45 +305,70 @@ class MessageSearcher:
             "offset": offset
         }
     
-    def search_in_lead(self, lead_id: int, search_term: str) -> List[Dict[str, Any]]:
+    def search_in_lead(self, lead_id: int, search_term: str, context_size: int = 2) -> List[Dict[str, Any]]:
         """
         Busca mensagens em um lead específico
         Retorna com contexto (mensagens antes e depois)
         """
-        conn = sqlite3.connect(self.db.db_name)
-        conn.row_factory = sqlite3.Row
+        fts_query = build_fts_query(search_term)
+        if not fts_query:
+            return []
+        
+        conn = self.db.get_connection()
         cursor = conn.cursor()
         
-        # Buscar mensagens que correspondem ao termo
-        cursor.execute("""
-            SELECT id, content, timestamp, sender_type, sender_name
-            FROM messages
-            WHERE lead_id = ? AND content LIKE ?
-            ORDER BY timestamp DESC
+        # Buscar mensagens que correspondem ao termo (mais relevantes primeiro)
+        cursor.execute(f"""
+            SELECT m.id, m.content, m.timestamp, m.sender_type, m.sender_name,
+                   snippet(messages_fts, 0, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}', '…', 12) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND m.lead_id = ?
+            ORDER BY bm25(messages_fts)
             LIMIT 10
-        """, (lead_id, f"%{search_term}%"))
+        """, (fts_query, lead_id))
+        
+        matches = [dict(row) for row in cursor.fetchall()]
+        if not matches:
+            conn.close()
+            return []
+        
+        # Contexto de todos os resultados numa única consulta: para cada
+        # resultado, context_size vizinhos de cada lado por keyset em
+        # (lead_id, id) — custo limitado, independente do tamanho da conversa
+        cursor.execute("""
+            SELECT hits.value AS hit_id, m.*
+            FROM json_each(?) AS hits
+            JOIN messages m ON m.id IN (
+                SELECT id FROM (
+                    SELECT id FROM messages
+                    WHERE lead_id = ? AND id < hits.value
+                    ORDER BY id DESC LIMIT ?
+                )
+                UNION ALL
+                SELECT hits.value
+                UNION ALL
+                SELECT id FROM (
+                    SELECT id FROM messages
+                    WHERE lead_id = ? AND id > hits.value
+                    ORDER BY id LIMIT ?
+                )
+            )
+            ORDER BY hits.value, m.id
+        """, (json.dumps([m['id'] for m in matches]), lead_id, context_size, lead_id, context_size))
         
-        results = []
+        context_by_hit = {}
         for row in cursor.fetchall():
-            message_id = row['id']
-            
-            # Buscar contexto (2 mensagens antes e 2 depois)
-            cursor.execute("""
-                SELECT * FROM messages
-                WHERE lead_id = ?
-                AND id BETWEEN ? AND ?
-                ORDER BY id ASC
-            """, (lead_id, message_id - 2, message_id + 2))
-            
-            context = [dict(r) for r in cursor.fetchall()]
-            
-            results.append({
-                "match": dict(row),
-                "context": context
-            })
+            message = dict(row)
+            hit_id = message.pop('hit_id')
+            context_by_hit.setdefault(hit_id, []).append(message)
         
         conn.close()
-        return results
+        
+        return [
+            {"match": match, "context": context_by_hit.get(match['id'], [])}
+            for match in matches
+        ]
 
 
 class LeadSearcher:
@@ -180,7 +390,9 @@ class LeadSearcher:
         sort_by: str = "updated_at",
         sort_order: str = "DESC",
         limit: int = 50,
-        offset: int = 0
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        include_total: bool = True
     ) -> Dict[str, Any]:
         """
         Busca leads com filtros avançados
@@ -197,30 +409,38 @@ class LeadSearcher:
             sort_order: ASC ou DESC
             limit: Quantidade máxima de resultados
             offset: Offset para paginação
+            cursor: Paginação por cursor (keyset em sort_by, id); "" = primeira
+                página. Quando informado, offset é ignorado e o retorno traz next_cursor
+            include_total: Executa o COUNT(*) do total
         
         Returns:
             Dict com leads e total de resultados
         """
-        conn = sqlite3.connect(self.db.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        conn = self.db.get_connection()
+        db_cursor = conn.cursor()
         
         # Construir query
         query = """
             SELECT l.*, u.name as vendedor_name,
-                   COUNT(DISTINCT m.id) as messages_count
+                   COALESCE(l.message_count, 0) as messages_count
             FROM leads l
             LEFT JOIN users u ON l.assigned_to = u.id
-            LEFT JOIN messages m ON l.id = m.lead_id
             WHERE 1=1
         """
         params = []
         
         # Filtros
         if search_term:
-            query += " AND (l.name LIKE ? OR l.phone LIKE ? OR l.email LIKE ?)"
-            search_pattern = f"%{search_term}%"
-            params.extend([search_pattern, search_pattern, search_pattern])
+            term = search_term.strip()
+            if len(term) >= 3:
+                # Índice trigram: mesmo resultado do LIKE '%termo%', sem varrer a tabela
+                query += " AND l.id IN (SELECT rowid FROM leads_fts WHERE leads_fts MATCH ?)"
+                params.append('"' + term.replace('"', '""') + '"')
+            else:
+                # Trigram precisa de 3+ caracteres
+                query += " AND (l.name LIKE ? OR l.phone LIKE ? OR l.email LIKE ?)"
+                search_pattern = f"%{term}%"
+                params.extend([search_pattern, search_pattern, search_pattern])
         
         if status:
             query += " AND l.status = ?"
@@ -249,27 +469,57 @@ class LeadSearcher:
             query += " AND l.created_at <= ?"
             params.append(date_to.isoformat())
         
-        query += " GROUP BY l.id"
-        
-        # Count total
-        count_query = f"SELECT COUNT(*) FROM ({query})"
-        cursor.execute(count_query, params)
-        total = cursor.fetchone()[0]
-        
         # Ordenação
         valid_sort_fields = ['id', 'name', 'phone', 'status', 'created_at', 'updated_at', 'last_message_at']
         if sort_by not in valid_sort_fields:
             sort_by = 'updated_at'
         
         sort_order = 'DESC' if sort_order.upper() == 'DESC' else 'ASC'
+        sort_expr = f"COALESCE(l.{sort_by}, '')"
+        
+        paginator = None
+        if cursor is not None:
+            paginator = KeysetPaginator(cursor, limit, ("_sort_key", "id"))
+        
+        # Count total
+        total = None
+        if include_total:
+            db_cursor.execute(f"SELECT COUNT(*) FROM ({query})", params)
+            total = db_cursor.fetchone()[0]
+        
+        if paginator and paginator.after:
+            # Keyset: continua depois do último (sort_by, id) entregue
+            comparison = "<" if sort_order == 'DESC' else ">"
+            query += f" AND ({sort_expr}, l.id) {comparison} (?, ?)"
+            params.extend(paginator.after)
+        
+        if paginator:
+            query = query.replace("SELECT l.*,", f"SELECT l.*, {sort_expr} as _sort_key,", 1)
+            query += f" ORDER BY {sort_expr} {sort_order}, l.id {sort_order} LIMIT ?"
+            params.append(paginator.fetch_limit)
+            
+            db_cursor.execute(query, params)
+            page = paginator.to_dict([dict(row) for row in db_cursor.fetchall()], total)
+            conn.close()
+            
+            for lead in page["items"]:
+                lead.pop("_sort_key", None)
+            
+            return {
+                "leads": page["items"],
+                "total": total,
+                "limit": paginator.limit,
+                "next_cursor": page["pagination"]["next_cursor"]
+            }
+        
         query += f" ORDER BY l.{sort_by} {sort_order}"
         
         # Paginação
         query += " LIMIT ? OFFSET ?"
         params.extend([limit, offset])
         
-        cursor.execute(query, params)
-        leads = [dict(row) for row in cursor.fetchall()]
+        db_cursor.execute(query, params)
+        leads = [dict(row) for row in db_cursor.fetchall()]
         
         conn.close()
         
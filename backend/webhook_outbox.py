@@ -0,0 +1,375 @@
+"""
+Fila durável (outbox SQLite) para os webhooks de mensagens recebidas
+
+O webhook só valida, grava o evento bruto em webhook_outbox e responde;
+um pool de workers processa os eventos depois (lead, Sheets, notificações,
+IA, resposta no WhatsApp).
+
+- Ordem por telefone: um evento só é pego quando não há evento mais
+  antigo do mesmo telefone na fila (nem em processamento, nem aguardando
+  nova tentativa)
+- Novas tentativas com espera exponencial; esgotadas, o evento vai para
+  webhook_dead_letter
+- Vale entre processos: a reserva é atômica no banco (BEGIN IMMEDIATE) e
+  eventos presos por um worker que morreu voltam para a fila
+- Lease (WEBHOOK_LEASE_SECONDS) renovado enquanto o handler roda; cada
+  reserva tem um dono único (locked_by) e complete/fail só valem para o
+  dono atual: um worker que perdeu o evento não apaga nem reagenda
+- Idempotente: com dedup_key, reenvios da mesma mensagem não entram na
+  fila (LRU em memória, depois índice único; ver inbound_dedup)
+- O evento só sai da fila depois do handler inteiro; o handler recebe o
+  payload com outbox_id e message_id (mensagem já gravada por uma
+  tentativa anterior, via Database.record_inbound_message)
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+from inbound_dedup import RecentKeys
+
+
+OUTBOX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS webhook_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        locked_by TEXT,
+        locked_at REAL,
+        last_error TEXT,
+        message_id INTEGER,
+        received_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_webhook_outbox_status_available ON webhook_outbox(status, available_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_webhook_outbox_phone_id ON webhook_outbox(phone, id)",
+    """CREATE TABLE IF NOT EXISTS webhook_dead_letter (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        outbox_id INTEGER NOT NULL,
+        phone TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        last_error TEXT,
+        received_at REAL NOT NULL,
+        failed_at REAL NOT NULL
+    )""",
+]
+
+
+class WebhookOutbox:
+    """
+    Fila de eventos de webhook com pool de workers
+
+    Usage:
+        outbox = WebhookOutbox(db, handler=process_inbound_event)
+        outbox.start()
+        outbox.enqueue(phone, {"phone": ..., "content": ...})
+    """
+
+    MAX_BACKOFF_SECONDS = 300
+
+    def __init__(self, database, handler: Callable[[Dict], None], workers: Optional[int] = None,
+                 max_attempts: Optional[int] = None):
+        self.db = database
+        self.handler = handler
+        self.workers = workers if workers is not None else int(os.getenv("WEBHOOK_WORKERS", "4"))
+        self.max_attempts = (
+            max_attempts if max_attempts is not None
+            else int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+        )
+        self.dedup_retention = float(os.getenv("WEBHOOK_DEDUP_RETENTION_HOURS", "48")) * 3600
+        # Evento sem renovação do lease há mais tempo que isso é considerado abandonado
+        self.lease_seconds = float(os.getenv("WEBHOOK_LEASE_SECONDS", "300"))
+        self.recent_keys = RecentKeys()
+        self.running = False
+        self._threads = []
+        self._wake = threading.Event()
+        self._last_recover = 0.0
+
+        # Estatísticas do processo
+        self.processed = 0
+        self.retried = 0
+        self.dead = 0
+        self.duplicates = 0
+        self.lost = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, field: str):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    # =============================
+    # ENFILEIRAMENTO
+    # =============================
+    def enqueue(self, phone: str, payload: Dict, dedup_key: Optional[str] = None) -> Optional[int]:
+        """
+        Grava o evento (durável ao retornar) e acorda um worker
+
+        Returns:
+            id do evento, ou None se dedup_key já foi vista (reenvio)
+        """
+        if dedup_key is not None and dedup_key in self.recent_keys:
+            self._count('duplicates')
+            return None
+
+        now = time.time()
+        with self.db.transaction() as conn:
+            if dedup_key is not None:
+                cursor = conn.execute("""
+                    INSERT OR IGNORE INTO webhook_dedup_keys (dedup_key, received_at) VALUES (?, ?)
+                """, (dedup_key, now))
+                duplicate = cursor.rowcount == 0
+            else:
+                duplicate = False
+
+            if not duplicate:
+                cursor = conn.execute("""
+                    INSERT INTO webhook_outbox (phone, payload, available_at, received_at)
+                    VALUES (?, ?, ?, ?)
+                """, (phone, json.dumps(payload, ensure_ascii=False), now, now))
+                event_id = cursor.lastrowid
+
+        if dedup_key is not None:
+            self.recent_keys.add(dedup_key)
+        if duplicate:
+            self._count('duplicates')
+            return None
+
+        self._wake.set()
+        return event_id
+
+    # =============================
+    # RESERVA / CONCLUSÃO
+    # =============================
+    def _worker_id(self) -> str:
+        """Dono de uma reserva: worker + token único (a mesma thread pode reservar o evento de novo)"""
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{uuid.uuid4().hex[:8]}"
+
+    def claim(self) -> Optional[Dict]:
+        """Reserva o próximo evento respeitando a ordem por telefone"""
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute("""
+                UPDATE webhook_outbox
+                SET status = 'processing', locked_by = ?, locked_at = ?, attempts = attempts + 1
+                WHERE id = (
+                    SELECT o.id FROM webhook_outbox o
+                    WHERE o.status = 'pending' AND o.available_at <= ?
+                      AND NOT EXISTS (
+                          SELECT 1 FROM webhook_outbox prev
+                          WHERE prev.phone = o.phone AND prev.id < o.id
+                      )
+                    ORDER BY o.id
+                    LIMIT 1
+                )
+                RETURNING *
+            """, (self._worker_id(), now, now)).fetchone()
+        return dict(row) if row else None
+
+    def _lost(self, event: Dict, action: str):
+        self._count('lost')
+        print(f"⚠️ Evento {event['id']} ({event['phone']}) reservado por outro worker (lease expirado), {action} ignorado")
+
+    def renew_lease(self, event: Dict) -> bool:
+        """Estende o lease do evento; False se a reserva já não é deste worker"""
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute("""
+                UPDATE webhook_outbox SET locked_at = ?
+                WHERE id = ? AND locked_by = ? AND status = 'processing'
+            """, (time.time(), event["id"], event["locked_by"]))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def complete(self, event: Dict) -> bool:
+        """Evento processado: sai da fila (se a reserva ainda é deste worker)"""
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute("""
+                DELETE FROM webhook_outbox WHERE id = ? AND locked_by = ? AND status = 'processing'
+            """, (event["id"], event["locked_by"]))
+            conn.commit()
+        finally:
+            conn.close()
+        if cursor.rowcount == 0:
+            self._lost(event, "conclusão")
+            return False
+        self._count('processed')
+        return True
+
+    def fail(self, event: Dict, error: str) -> bool:
+        """Agenda nova tentativa ou move para a dead letter (se a reserva ainda é deste worker)"""
+        now = time.time()
+        with self.db.transaction() as conn:
+            if event["attempts"] < self.max_attempts:
+                delay = min(2 ** event["attempts"], self.MAX_BACKOFF_SECONDS)
+                cursor = conn.execute("""
+                    UPDATE webhook_outbox
+                    SET status = 'pending', available_at = ?, locked_by = NULL, locked_at = NULL, last_error = ?
+                    WHERE id = ? AND locked_by = ? AND status = 'processing'
+                """, (now + delay, error, event["id"], event["locked_by"]))
+                retried = True
+            else:
+                cursor = conn.execute("""
+                    DELETE FROM webhook_outbox WHERE id = ? AND locked_by = ? AND status = 'processing'
+                """, (event["id"], event["locked_by"]))
+                if cursor.rowcount:
+                    conn.execute("""
+                        INSERT INTO webhook_dead_letter (outbox_id, phone, payload, attempts, last_error, received_at, failed_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (event["id"], event["phone"], event["payload"], event["attempts"], error,
+                          event["received_at"], now))
+                retried = False
+
+        if cursor.rowcount == 0:
+            self._lost(event, "falha")
+            return False
+        if retried:
+            self._count('retried')
+            print(f"🔁 Evento {event['id']} ({event['phone']}) falhou, nova tentativa em {delay}s: {error}")
+        else:
+            self._count('dead')
+            print(f"☠️ Evento {event['id']} ({event['phone']}) foi para a dead letter: {error}")
+        return True
+
+    def recover_abandoned(self) -> int:
+        """Devolve para a fila eventos presos por workers que morreram"""
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute("""
+                UPDATE webhook_outbox
+                SET status = 'pending', locked_by = NULL, locked_at = NULL
+                WHERE status = 'processing' AND locked_at < ?
+            """, (time.time() - self.lease_seconds,))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def prune_dedup_keys(self) -> int:
+        """Esquece chaves de deduplicação mais antigas que a retenção"""
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.execute(
+                "DELETE FROM webhook_dedup_keys WHERE received_at < ?",
+                (time.time() - self.dedup_retention,)
+            )
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def process_one(self) -> bool:
+        """Processa um evento; retorna False se a fila estava vazia"""
+        event = self.claim()
+        if event is None:
+            return False
+
+        # Renova o lease a cada terço do prazo enquanto o handler roda
+        # (IA, Sheets e notificações podem passar do lease)
+        done = threading.Event()
+
+        def keep_lease():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    if not self.renew_lease(event):
+                        return
+                except Exception as e:
+                    print(f"⚠️ Erro ao renovar o lease do evento {event['id']}: {e}")
+
+        renewer = threading.Thread(target=keep_lease, daemon=True)
+        renewer.start()
+        error = None
+        try:
+            self.handler({
+                **json.loads(event["payload"]),
+                "outbox_id": event["id"],
+                "message_id": event.get("message_id")
+            })
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            done.set()
+
+        if error is None:
+            self.complete(event)
+        else:
+            self.fail(event, error)
+        return True
+
+    # =============================
+    # WORKERS
+    # =============================
+    def _loop(self):
+        while self.running:
+            try:
+                if time.time() - self._last_recover > 60:
+                    self._last_recover = time.time()
+                    self.recover_abandoned()
+                    self.prune_dedup_keys()
+                if self.process_one():
+                    continue
+            except Exception as e:
+                print(f"❌ Erro no worker da fila de webhooks: {e}")
+            # Fila vazia: espera um enqueue deste processo (ou 1s, para os de outros)
+            self._wake.wait(timeout=1)
+            self._wake.clear()
+
+    def start(self):
+        """Inicia o pool de workers"""
+        if self.running:
+            return
+        self.running = True
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"📥 Fila de webhooks ativa ({self.workers} workers, até {self.max_attempts} tentativas)")
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    # =============================
+    # MONITORAMENTO
+    # =============================
+    def get_stats(self) -> Dict:
+        """Profundidade, atraso e dead letters (para o /health)"""
+        now = time.time()
+        conn = self.db.get_connection()
+        try:
+            row = conn.execute("""
+                SELECT
+                    COUNT(*) AS depth,
+                    SUM(CASE WHEN status = 'processing' THEN 1 ELSE 0 END) AS processing,
+                    SUM(CASE WHEN attempts > 0 AND status = 'pending' THEN 1 ELSE 0 END) AS retrying,
+                    MIN(received_at) AS oldest
+                FROM webhook_outbox
+            """).fetchone()
+            dead_letters = conn.execute("SELECT COUNT(*) FROM webhook_dead_letter").fetchone()[0]
+        finally:
+            conn.close()
+
+        return {
+            "depth": row["depth"],
+            "processing": row["processing"] or 0,
+            "retrying": row["retrying"] or 0,
+            "lag_seconds": round(now - row["oldest"], 3) if row["oldest"] else 0,
+            "dead_letters": dead_letters,
+            "workers": self.workers if self.running else 0,
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "duplicates": self.duplicates,
+            "lost_leases": self.lost
+        }
@@ -1,13 +1,35 @@
+import asyncio
+import os
+import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import time
 from functools import wraps
 
+from utils import normalize_phone, is_brazilian_phone
+from notification_service import lead_rooms
+from outbound_queue import PRIORITY_VENDEDOR, PRIORITY_NAMES, DeliveryDeferred, DeliveryUncertain
+from circuit_breaker import CircuitBreaker
+
+try:
+    import aiohttp
+except ImportError:  # só o AsyncWhatsAppService precisa
+    aiohttp = None
+
+
+def backoff_delay(attempt, base, cap=30):
+    """Espera exponencial com jitter total: aleatória entre 0 e min(cap, base * 2^tentativa)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
 class WhatsAppService:
     def __init__(self, database, socketio):
         self.db = database
         self.socketio = socketio
-        self.venom_url = "http://localhost:3001"
+        self.venom_url = os.getenv("WHATSAPP_SERVICE_URL", "http://localhost:3001")
+        self.pool_size = int(os.getenv("WHATSAPP_HTTP_POOL_SIZE", "20"))
         self.is_ready = False
         self.max_retries = 3
         self.retry_delay = 2  # segundos
@@ -15,78 +37,138 @@ class WhatsAppService:
         self.health_check_interval = 30  # segundos
         self.connection_errors = 0
         self.max_connection_errors = 5
+        self.outbound = None  # OutboundQueue, ligada pelo app (ver queue_message)
+
+        # Circuit breaker da ponte + monitor em segundo plano (start_health_monitor)
+        self.breaker = CircuitBreaker(
+            "whatsapp_bridge",
+            failure_threshold=int(os.getenv("WHATSAPP_BREAKER_FAILURES", "3")),
+            reset_timeout=float(os.getenv("WHATSAPP_BREAKER_RESET_SECONDS", "30"))
+        )
+        self.probe_interval = float(os.getenv("WHATSAPP_PROBE_INTERVAL", "10"))
+        self.monitor_running = False
+        self.last_status = {"connected": False}
+
+        # Sessão keep-alive: reaproveita as conexões TCP com a ponte
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
 
     # =============================
     # UTILITÁRIOS
     # =============================
     def validate_phone(self, phone):
-        """Valida e normaliza número de telefone para formato brasileiro"""
+        """Valida e normaliza número de telefone (brasileiro ou internacional, E.164)"""
         if not phone:
             return None
         
-        # Remove caracteres não numéricos
-        phone_clean = ''.join(filter(str.isdigit, str(phone)))
+        # Mesma normalização usada em leads.phone (55 só para DDD + número brasileiro)
+        phone_clean = normalize_phone(phone)
+        if not phone_clean:
+            return None
         
-        # Valida comprimento mínimo (DDD + número)
-        if len(phone_clean) < 10:
+        # Brasileiro (DDI 55): DDD + número completos, 12 ou 13 dígitos
+        if phone_clean.startswith("55") and len(phone_clean) <= 13:
+            if not is_brazilian_phone(phone_clean):
+                print(f"⚠️ Telefone brasileiro inválido: {phone}")
+                return None
+            # Formata para exibição: +55 51 994003224
+            formatted = f"+{phone_clean[:2]} {phone_clean[2:4]} {phone_clean[4:]}"
+            print(f"📱 Número formatado: {formatted}")
+            return phone_clean
+
+        # Demais países: faixa do E.164 (DDI + número, 8 a 15 dígitos)
+        if len(phone_clean) < 8:
             print(f"⚠️ Telefone inválido (muito curto): {phone}")
             return None
-        
-        # Valida comprimento máximo
         if len(phone_clean) > 15:
             print(f"⚠️ Telefone inválido (muito longo): {phone}")
             return None
-        
-        # Adiciona +55 se não tiver DDI
-        if not phone_clean.startswith('55'):
-            phone_clean = '55' + phone_clean
-        
-        # Formata para exibição: +55 51 994003224
-        if len(phone_clean) >= 12:
-            formatted = f"+{phone_clean[:2]} {phone_clean[2:4]} {phone_clean[4:]}"
-            print(f"📱 Número formatado: {formatted}")
-        
+
         return phone_clean  # Retorna só números para envio
 
     # =============================
     # STATUS DE CONEXÃO E HEALTH CHECK
     # =============================
-    def check_connection(self):
+    def _connection_ok(self, data):
+        was_ready = self.is_ready
+        first_check = self.last_health_check is None
+        self.is_ready = data.get("connected", False)
+        self.last_health_check = datetime.now()
+        self.last_status = data
+
+        if self.is_ready:
+            self.connection_errors = 0
+            self.breaker.record_success()
+            if not was_ready:
+                print(f"✅ WhatsApp conectado: {data.get('phone', 'N/A')}")
+        else:
+            # Ponte no ar mas WhatsApp desconectado: envios falhariam do mesmo jeito
+            self.breaker.record_failure()
+            if was_ready or first_check:
+                print(f"⚠️ WhatsApp não conectado")
+        return data
+
+    def _connection_failed(self, error):
+        print(f"❌ Erro ao verificar conexão com VenomBot: {error}")
+        self.is_ready = False
+        self.last_health_check = datetime.now()
+        self.last_status = {"connected": False}
+        self.connection_errors += 1
+        self.breaker.record_failure()
+
+        if self.connection_errors >= self.max_connection_errors:
+            print(f"🚨 ALERTA: {self.connection_errors} erros consecutivos de conexão!")
+        return {"connected": False}
+
+    def check_connection(self, max_attempts=2):
         """Verifica se VenomBot está conectado - COM RETRY"""
-        max_attempts = 2
-        delay = 1
-        
         for attempt in range(max_attempts):
             try:
-                response = requests.get(f"{self.venom_url}/status", timeout=5)
+                response = self.http.get(f"{self.venom_url}/status", timeout=5)
                 if response.status_code == 200:
-                    data = response.json()
-                    self.is_ready = data.get("connected", False)
-                    self.last_health_check = datetime.now()
-                    self.connection_errors = 0
-                    
-                    if self.is_ready:
-                        print(f"✅ WhatsApp conectado: {data.get('phone', 'N/A')}")
-                    else:
-                        print(f"⚠️ WhatsApp não conectado")
-                    
-                    return data
-                return {"connected": False}
+                    return self._connection_ok(response.json())
+                return self._connection_failed(f"HTTP {response.status_code}")
                 
             except requests.exceptions.RequestException as e:
                 if attempt < max_attempts - 1:
-                    print(f"⚠️ Tentativa {attempt + 1}/{max_attempts} falhou. Tentando novamente em {delay}s...")
+                    delay = backoff_delay(attempt, 1)
+                    print(f"⚠️ Tentativa {attempt + 1}/{max_attempts} falhou. Tentando novamente em {delay:.1f}s...")
                     time.sleep(delay)
                 else:
-                    print(f"❌ Erro ao verificar conexão com VenomBot: {e}")
-                    self.is_ready = False
-                    self.last_health_check = datetime.now()
-                    self.connection_errors += 1
-                    
-                    if self.connection_errors >= self.max_connection_errors:
-                        print(f"🚨 ALERTA: {self.connection_errors} erros consecutivos de conexão!")
-                    
-                    return {"connected": False}
+                    return self._connection_failed(e)
+
+    def _monitor_loop(self):
+        while self.monitor_running:
+            # Circuito aberto: só sonda quando chega a hora do teste (half-open)
+            if self.breaker.allow():
+                try:
+                    self.check_connection(max_attempts=1)
+                except Exception as e:
+                    self._connection_failed(e)
+            time.sleep(self.probe_interval)
+
+    def start_health_monitor(self):
+        """
+        Sonda a ponte em segundo plano (WHATSAPP_PROBE_INTERVAL s)
+
+        Com o monitor ativo, ensure_connected/get_status/health não fazem
+        chamadas à ponte: leem o estado que ele mantém.
+        """
+        if self.monitor_running:
+            return
+        self.monitor_running = True
+        thread = threading.Thread(target=self._monitor_loop, daemon=True)
+        thread.start()
+        print(f"🩺 Monitor da ponte WhatsApp ativo (a cada {self.probe_interval:.0f}s)")
+
+    def stop_health_monitor(self):
+        self.monitor_running = False
+
+    def bridge_available(self):
+        """Circuito deixaria um envio passar agora? (sem chamada de rede)"""
+        return not self.breaker.is_open() and (self.is_ready or not self.monitor_running)
     
     def should_check_health(self):
         """Verifica se deve fazer health check"""
@@ -97,6 +179,13 @@ class WhatsAppService:
     
     def ensure_connected(self):
         """Garante que está conectado antes de operações críticas"""
+        if self.monitor_running:
+            return self.is_ready and not self.breaker.is_open()
+
+        # Sem monitor: circuito aberto falha na hora, sem esperar timeout
+        if self.breaker.is_open():
+            return False
+
         if self.should_check_health():
             self.check_connection()
         
@@ -115,7 +204,7 @@ class WhatsAppService:
         Quando um lead envia mensagem para o número da empresa
         """
         try:
-            phone = message.get("from", "").replace("@c.us", "").replace("+", "").strip()
+            phone = message.get("from", "")
             content = message.get("body", "").strip()
             sender_name = message.get("notifyName", message.get("pushName", "Lead"))
 
@@ -136,24 +225,10 @@ class WhatsAppService:
 
             print(f"📨 Mensagem recebida de {sender_name} ({phone}): {content[:50]}...")
 
-            # Cria ou busca o lead no banco
-            lead = self.db.create_or_get_lead(phone, sender_name)
-
-            # Salva a mensagem recebida
-            self.db.add_message(
-                lead_id=lead["id"],
-                sender_type="lead",
-                sender_name=sender_name,
-                content=content
-            )
-
-            # Adiciona log na timeline do lead
-            self.db.add_lead_log(
-                lead_id=lead["id"],
-                action="mensagem_recebida",
-                user_name=sender_name,
-                details=content[:100]
-            )
+            # Cria ou busca o lead, salva a mensagem e o log (uma transação)
+            lead, message_id = self.db.record_inbound_message(phone, sender_name, content)
+            if not lead:
+                return
 
             # Emite atualização em tempo real pro front-end
             self.socketio.emit("new_message", {
@@ -163,7 +238,7 @@ class WhatsAppService:
                 "content": content,
                 "timestamp": datetime.now().isoformat(),
                 "sender_type": "lead"
-            })
+            }, room=lead_rooms(lead), key=("message", message_id))
 
             print("✅ Mensagem recebida e registrada com sucesso")
 
@@ -175,23 +250,88 @@ class WhatsAppService:
     # =============================
     # ENVIAR MENSAGEM (LEAD OU GESTOR)
     # =============================
-    def send_message(self, phone, content, vendedor_id=None, bypass_lead_check=False):
-        """Envia mensagem via Baileys com retry"""
-        
-        # Validações
+    def _validate_outgoing(self, phone, content):
+        """Telefone normalizado, ou None se a mensagem não pode ser enviada"""
         phone = self.validate_phone(phone)
         if not phone:
             print(f"❌ Telefone inválido: {phone}")
-            return False
+            return None
         
         if not content or not content.strip():
             print(f"❌ Mensagem vazia não pode ser enviada")
-            return False
+            return None
         
         if len(content) > 4096:
             print(f"❌ Mensagem muito grande (max 4096 caracteres)")
+            return None
+
+        return phone
+
+    def _record_outgoing(self, lead, phone, content, vendedor_id, delivery_status=None):
+        """Grava a mensagem do vendedor na conversa, o log e avisa o front; retorna o id"""
+        user = self.db.get_user(vendedor_id)
+        vendedor_name = user["name"] if user else "Vendedor"
+
+        message_id = self.db.add_message(
+            lead_id=lead["id"],
+            sender_type="vendedor",
+            sender_name=vendedor_name,
+            content=content,
+            delivery_status=delivery_status
+        )
+
+        self.db.add_lead_log(
+            lead_id=lead["id"],
+            action="mensagem_enviada",
+            user_name=vendedor_name,
+            details=content[:100]
+        )
+
+        # Emite evento de envio
+        self.socketio.emit("message_sent", {
+            "lead_id": lead["id"],
+            "message_id": message_id,
+            "phone": phone,
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+            "sender_type": "vendedor",
+            "sender_id": vendedor_id,
+            "delivery_status": delivery_status
+        }, room=lead_rooms(lead, vendedor_id))
+        return message_id
+
+    def _record_sent(self, phone, content, vendedor_id, bypass_lead_check, lead=None):
+        """Registra no CRM a mensagem que a ponte aceitou"""
+        # ✅ MODIFICADO: Só salvar se tiver vendedor_id (não é IA)
+        if vendedor_id is not None and vendedor_id > 0:
+            lead = lead or self.db.get_lead_by_phone(phone)
+            
+            if not lead and not bypass_lead_check:
+                print(f"⚠️ Nenhum lead encontrado com o número {phone}. Mensagem não será enviada.")
+                return False
+
+            if lead:
+                self._record_outgoing(lead, phone, content, vendedor_id, delivery_status="sent")
+
+        print("✅ Mensagem enviada com sucesso")
+        return True
+
+    def send_message(self, phone, content, vendedor_id=None, bypass_lead_check=False, lead=None):
+        """
+        Envia mensagem via Baileys com retry
+
+        Só repete quando a ponte recusou (HTTP != 200) ou a conexão nem
+        abriu; timeout de leitura não é repetido (a ponte pode ter enviado).
+        lead: o lead já carregado pelo chamador (evita buscá-lo de novo)
+        """
+        phone = self._validate_outgoing(phone, content)
+        if not phone:
             return False
         
+        # Circuito aberto: não espera a ponte; guarda para reenvio quando voltar
+        if self.breaker.is_open():
+            return self._queue_for_replay(phone, content, vendedor_id, lead)
+
         # Verifica conexão
         if not self.ensure_connected():
             print(f"❌ WhatsApp não conectado. Não é possível enviar mensagem.")
@@ -199,79 +339,147 @@ class WhatsAppService:
         
         # Tenta enviar com retry
         for attempt in range(self.max_retries):
+            print(f"📤 Enviando mensagem para {phone} (tentativa {attempt + 1}/{self.max_retries})")
             try:
-                print(f"📤 Enviando mensagem para {phone} (tentativa {attempt + 1}/{self.max_retries})")
-                
-                response = requests.post(
+                response = self.http.post(
                     f"{self.venom_url}/send",
                     json={"phone": phone, "message": content},
                     timeout=10
                 )
-
-                if response.status_code != 200:
-                    print(f"❌ Erro HTTP {response.status_code}: {response.text}")
-                    if attempt < self.max_retries - 1:
-                        time.sleep(self.retry_delay)
-                        continue
-                    return False
-
-                # ✅ MODIFICADO: Só salvar se tiver vendedor_id (não é IA)
-                if vendedor_id is not None and vendedor_id > 0:
-                    lead = self.db.get_lead_by_phone(phone)
-                    
-                    if not lead and not bypass_lead_check:
-                        print(f"⚠️ Nenhum lead encontrado com o número {phone}. Mensagem não será enviada.")
-                        return False
-
-                    if lead:
-                        vendedor_name = "Vendedor"
-                        users = self.db.get_all_users()
-                        user = next((u for u in users if u["id"] == vendedor_id), None)
-                        if user:
-                            vendedor_name = user["name"]
-
-                        self.db.add_message(
-                            lead_id=lead["id"],
-                            sender_type="vendedor",
-                            sender_name=vendedor_name,
-                            content=content
-                        )
-
-                        self.db.add_lead_log(
-                            lead_id=lead["id"],
-                            action="mensagem_enviada",
-                            user_name=vendedor_name,
-                            details=content[:100]
-                        )
-
-                        # Emite evento de envio
-                        self.socketio.emit("message_sent", {
-                            "lead_id": lead["id"],
-                            "phone": phone,
-                            "content": content,
-                            "timestamp": datetime.now().isoformat(),
-                            "sender_type": "vendedor",
-                            "sender_id": vendedor_id
-                        })
-
-                print("✅ Mensagem enviada com sucesso")
-                return True
-
+            except requests.exceptions.ConnectionError as e:
+                self.breaker.record_failure()
+                print(f"❌ Ponte inacessível: {e}")
+            except requests.exceptions.Timeout as e:
+                # Ponte travada conta para o circuito; sem nova tentativa (pode ter enviado)
+                self.breaker.record_failure()
+                print(f"❌ Timeout da ponte, mensagem não reenviada: {e}")
+                return False
+            except requests.exceptions.RequestException as e:
+                self.breaker.record_failure()
+                print(f"❌ Erro na requisição à ponte: {e}")
+                return False
             except Exception as e:
                 print(f"❌ Erro inesperado ao enviar mensagem: {e}")
                 import traceback
                 traceback.print_exc()
                 return False
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    return self._record_sent(phone, content, vendedor_id, bypass_lead_check, lead=lead)
+                self.breaker.record_failure()
+                print(f"❌ Erro HTTP {response.status_code}: {response.text}")
+
+            if self.breaker.is_open():
+                return self._queue_for_replay(phone, content, vendedor_id, lead)
+
+            if attempt < self.max_retries - 1:
+                time.sleep(backoff_delay(attempt, self.retry_delay))
         
         return False
 
+    def _queue_for_replay(self, phone, content, vendedor_id, lead=None):
+        """Circuito aberto: manda para a fila de saída (reenvio quando fechar), se houver"""
+        if self.outbound is None:
+            print(f"❌ Ponte indisponível (circuito aberto). Mensagem não enviada.")
+            return False
+        print(f"⏸️ Ponte indisponível (circuito aberto): mensagem para {phone} enfileirada para reenvio")
+        return self.queue_message(phone, content, vendedor_id=vendedor_id, lead=lead) is not None
+
+    # =============================
+    # FILA DE SAÍDA
+    # =============================
+    def queue_message(self, phone, content, priority=PRIORITY_VENDEDOR, vendedor_id=None, lead=None):
+        """
+        Enfileira a mensagem na fila de saída e retorna o handle na hora
+
+        Mensagem de vendedor para um lead entra na conversa já como
+        'queued'; o dispatcher atualiza para 'sent'/'failed'. Sem fila
+        (self.outbound None) envia na hora, como send_message.
+
+        Returns:
+            handle {"id", "message_id", "status", "priority"} ou None se inválida
+        """
+        phone = self._validate_outgoing(phone, content)
+        if not phone:
+            return None
+
+        if self.outbound is None:
+            success = self.send_message(phone, content, vendedor_id=vendedor_id, bypass_lead_check=True, lead=lead)
+            return self._direct_handle(priority, success)
+
+        return self._enqueue_outgoing(phone, content, priority, vendedor_id, lead)
+
+    @staticmethod
+    def _direct_handle(priority, success):
+        """Handle de um envio feito na hora (sem fila)"""
+        return {"id": None, "message_id": None, "status": "sent" if success else "failed",
+                "priority": PRIORITY_NAMES.get(priority, priority)}
+
+    def _enqueue_outgoing(self, phone, content, priority, vendedor_id, lead):
+        """Grava a mensagem do vendedor como 'queued' e a coloca na fila de saída"""
+        message_id = None
+        if vendedor_id is not None and vendedor_id > 0:
+            lead = lead or self.db.get_lead_by_phone(phone)
+            if lead:
+                message_id = self._record_outgoing(lead, phone, content, vendedor_id, delivery_status="queued")
+
+        return self.outbound.enqueue(
+            phone, content, priority=priority,
+            lead_id=lead["id"] if lead else None,
+            message_id=message_id
+        )
+
+    def deliver(self, phone, content):
+        """
+        Uma tentativa de entrega para a ponte (usada pela fila de saída)
+
+        Exceção = falhou; DeliveryDeferred = circuito aberto (a mensagem
+        espera na fila sem gastar tentativa); DeliveryUncertain = timeout de
+        leitura (a ponte pode ter enviado, então a fila não reenvia)
+        """
+        if not self.ensure_connected() or not self.breaker.allow():
+            raise DeliveryDeferred("ponte indisponível (circuito aberto)")
+
+        try:
+            response = self.http.post(
+                f"{self.venom_url}/send",
+                json={"phone": phone, "message": content},
+                timeout=10
+            )
+        except requests.exceptions.ReadTimeout as e:
+            self.breaker.record_failure()
+            raise DeliveryUncertain(f"timeout de leitura: {e}") from e
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+        if response.status_code != 200:
+            self.breaker.record_failure()
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+
+        self.breaker.record_success()
+        print(f"✅ Mensagem entregue para {phone}")
+
+    def delivery_status(self, item):
+        """Callback da fila de saída: atualiza messages e avisa o front"""
+        if not item.get("message_id"):
+            return
+
+        self.db.set_delivery_status(item["message_id"], item["status"])
+
+        lead = self.db.get_lead(item["lead_id"]) if item.get("lead_id") else None
+        if lead:
+            self.socketio.emit("message_status", {
+                "lead_id": lead["id"],
+                "message_id": item["message_id"],
+                "status": item["status"],
+                "error": item.get("last_error")
+            }, room=lead_rooms(lead), key=("message_status", item["message_id"]))
+
     # =============================
     # STATUS E DESCONECTAR
     # =============================
-    def get_status(self):
-        """Retorna status atual do VenomBot com informações detalhadas"""
-        status = self.check_connection()
-        
+    def _status_payload(self, status):
         return {
             "connected": status.get("connected", False),
             "phone": status.get("phone", "Não conectado"),
@@ -279,13 +487,21 @@ class WhatsAppService:
             "is_ready": self.is_ready,
             "last_health_check": self.last_health_check.isoformat() if self.last_health_check else None,
             "connection_errors": self.connection_errors,
-            "health_status": "healthy" if self.connection_errors == 0 else "degraded" if self.connection_errors < 3 else "critical"
+            "health_status": "healthy" if self.connection_errors == 0 else "degraded" if self.connection_errors < 3 else "critical",
+            "health_monitor": self.monitor_running,
+            "circuit_breaker": self.breaker.get_status()
         }
 
+    def get_status(self):
+        """Retorna status atual do VenomBot com informações detalhadas"""
+        if self.monitor_running or self.breaker.is_open():
+            return self._status_payload(self.last_status)
+        return self._status_payload(self.check_connection())
+
     def disconnect(self):
         """Força desconexão manual do VenomBot"""
         try:
-            response = requests.post(f"{self.venom_url}/disconnect", timeout=5)
+            response = self.http.post(f"{self.venom_url}/disconnect", timeout=5)
             if response.status_code == 200:
                 print("🔌 Desconectado do WhatsApp com sucesso")
                 self.is_ready = False
@@ -293,4 +509,175 @@ class WhatsAppService:
             return {"success": False, "error": response.text}
         except Exception as e:
             print(f"❌ Erro ao desconectar: {e}")
-            return {"success": False, "error": str(e)}
\ No newline at end of file
+            return {"success": False, "error": str(e)}
+
+    def close(self):
+        """Fecha as conexões do pool"""
+        self.http.close()
+
+
+class AsyncWhatsAppService(WhatsAppService):
+    """
+    Mesma API do WhatsAppService com corrotinas (aiohttp)
+
+    Para código asyncio: as esperas entre tentativas não ocupam thread e a
+    sessão mantém um pool de conexões keep-alive com a ponte. As escritas
+    no banco rodam em thread (asyncio.to_thread). Usa o mesmo circuit
+    breaker. send_message, queue_message, check_connection, get_status e
+    disconnect são corrotinas; o monitor em thread (start_health_monitor) e
+    o deliver da fila de saída (que roda nos workers em thread) são só da
+    versão síncrona e aqui levantam erro.
+
+    Usage:
+        whatsapp = AsyncWhatsAppService(db, socketio)
+        await whatsapp.send_message(phone, "Olá!", vendedor_id=3)
+        await whatsapp.close()
+    """
+
+    def __init__(self, database, socketio):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp não instalado (pip install aiohttp)")
+        super().__init__(database, socketio)
+        self.http.close()
+        self.http = None  # criada no loop que usar o serviço
+
+    async def _session(self):
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30)
+            )
+        return self.http
+
+    async def check_connection(self, max_attempts=2):
+        """Verifica se VenomBot está conectado - COM RETRY"""
+        session = await self._session()
+
+        for attempt in range(max_attempts):
+            try:
+                async with session.get(
+                    f"{self.venom_url}/status", timeout=aiohttp.ClientTimeout(total=5)
+                ) as response:
+                    if response.status == 200:
+                        return self._connection_ok(await response.json())
+                    return self._connection_failed(f"HTTP {response.status}")
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt < max_attempts - 1:
+                    delay = backoff_delay(attempt, 1)
+                    print(f"⚠️ Tentativa {attempt + 1}/{max_attempts} falhou. Tentando novamente em {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                else:
+                    return self._connection_failed(e)
+
+    async def ensure_connected(self):
+        """Garante que está conectado antes de operações críticas"""
+        if self.breaker.is_open():
+            return False
+
+        if self.should_check_health():
+            await self.check_connection()
+
+        if not self.is_ready:
+            print("⚠️ WhatsApp não está conectado. Tentando reconectar...")
+            await self.check_connection()
+
+        return self.is_ready
+
+    async def send_message(self, phone, content, vendedor_id=None, bypass_lead_check=False, lead=None):
+        """Envia mensagem via Baileys com retry (mesmas regras do WhatsAppService)"""
+        phone = self._validate_outgoing(phone, content)
+        if not phone:
+            return False
+
+        if self.breaker.is_open():
+            return await self._queue_for_replay(phone, content, vendedor_id, lead)
+
+        if not await self.ensure_connected():
+            print(f"❌ WhatsApp não conectado. Não é possível enviar mensagem.")
+            return False
+
+        session = await self._session()
+        for attempt in range(self.max_retries):
+            print(f"📤 Enviando mensagem para {phone} (tentativa {attempt + 1}/{self.max_retries})")
+            try:
+                async with session.post(
+                    f"{self.venom_url}/send",
+                    json={"phone": phone, "message": content},
+                    timeout=aiohttp.ClientTimeout(total=10)
+                ) as response:
+                    if response.status == 200:
+                        self.breaker.record_success()
+                        return await asyncio.to_thread(
+                            self._record_sent, phone, content, vendedor_id, bypass_lead_check, lead
+                        )
+                    self.breaker.record_failure()
+                    print(f"❌ Erro HTTP {response.status}: {await response.text()}")
+            except asyncio.TimeoutError as e:
+                self.breaker.record_failure()
+                print(f"❌ Timeout da ponte, mensagem não reenviada: {e}")
+                return False
+            except aiohttp.ClientConnectionError as e:
+                self.breaker.record_failure()
+                print(f"❌ Ponte inacessível: {e}")
+            except Exception as e:
+                print(f"❌ Erro inesperado ao enviar mensagem: {e}")
+                return False
+
+            if self.breaker.is_open():
+                return await self._queue_for_replay(phone, content, vendedor_id, lead)
+            if attempt < self.max_retries - 1:
+                await asyncio.sleep(backoff_delay(attempt, self.retry_delay))
+
+        return False
+
+    async def _queue_for_replay(self, phone, content, vendedor_id, lead=None):
+        """Circuito aberto: manda para a fila de saída (reenvio quando fechar), se houver"""
+        if self.outbound is None:
+            print(f"❌ Ponte indisponível (circuito aberto). Mensagem não enviada.")
+            return False
+        print(f"⏸️ Ponte indisponível (circuito aberto): mensagem para {phone} enfileirada para reenvio")
+        return await self.queue_message(phone, content, vendedor_id=vendedor_id, lead=lead) is not None
+
+    async def queue_message(self, phone, content, priority=PRIORITY_VENDEDOR, vendedor_id=None, lead=None):
+        """Enfileira a mensagem na fila de saída (mesmas regras do WhatsAppService)"""
+        phone = self._validate_outgoing(phone, content)
+        if not phone:
+            return None
+
+        if self.outbound is None:
+            success = await self.send_message(phone, content, vendedor_id=vendedor_id,
+                                              bypass_lead_check=True, lead=lead)
+            return self._direct_handle(priority, success)
+
+        return await asyncio.to_thread(self._enqueue_outgoing, phone, content, priority, vendedor_id, lead)
+
+    def deliver(self, phone, content):
+        raise RuntimeError("A fila de saída entrega pelo WhatsAppService síncrono (deliver roda em thread)")
+
+    def start_health_monitor(self):
+        raise RuntimeError("O monitor da ponte roda em thread: use o WhatsAppService síncrono")
+
+    async def get_status(self):
+        """Retorna status atual do VenomBot com informações detalhadas"""
+        return self._status_payload(await self.check_connection())
+
+    async def disconnect(self):
+        """Força desconexão manual do VenomBot"""
+        try:
+            session = await self._session()
+            async with session.post(
+                f"{self.venom_url}/disconnect", timeout=aiohttp.ClientTimeout(total=5)
+            ) as response:
+                if response.status == 200:
+                    print("🔌 Desconectado do WhatsApp com sucesso")
+                    self.is_ready = False
+                    return {"success": True}
+                return {"success": False, "error": await response.text()}
+        except Exception as e:
+            print(f"❌ Erro ao desconectar: {e}")
+            return {"success": False, "error": str(e)}
+
+    async def close(self):
+        """Fecha a sessão aiohttp"""
+        if self.http is not None and not self.http.closed:
+            await self.http.close()
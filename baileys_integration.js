@@ -13,6 +13,13 @@ let sock = null;
 let isConnected = false;
 const logger = P({ level: 'silent' });
 
+// messageTimestamp vem como number ou Long (protobuf); sem valor válido, o campo é omitido
+function providerTimestamp(ts) {
+    const seconds = typeof ts === 'number' ? ts : ts?.toNumber?.();
+    if (!Number.isFinite(seconds) || seconds <= 0) return undefined;
+    return new Date(seconds * 1000).toISOString();
+}
+
 async function connectToWhatsApp() {
     try {
         const { state, saveCreds } = await useMultiFileAuthState('auth_info_baileys');
@@ -68,7 +75,8 @@ async function connectToWhatsApp() {
                     phone,
                     content,
                     name,
-                    timestamp: new Date().toISOString()
+                    message_id: message.key.id,
+                    timestamp: providerTimestamp(message.messageTimestamp)
                 }, {
                     timeout: 5000
                 });
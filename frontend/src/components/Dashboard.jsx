@@ -41,6 +41,13 @@ export default function Dashboard({ user, onLogout }) {
       }
     });
 
+    // Backend agrupa eventos próximos num único frame 'batch'
+    newSocket.on('batch', ({ events }) => {
+      events.forEach(({ event, data }) => {
+        newSocket.listeners(event).forEach((listener) => listener(data));
+      });
+    });
+
     newSocket.on('new_message', (data) => {
       console.log('📨 Nova mensagem recebida:', data);
       
@@ -26,6 +26,13 @@ export const useNotifications = () => {
       newSocket.emit('join_room', { room: 'gestores' });
     });
 
+    // Backend agrupa eventos próximos num único frame 'batch'
+    newSocket.on('batch', ({ events }) => {
+      events.forEach(({ event, data }) => {
+        newSocket.listeners(event).forEach((listener) => listener(data));
+      });
+    });
+
     newSocket.on('notification', (notification) => {
       console.log('🔔 Nova notificação recebida:', notification);
       addNotification(notification);
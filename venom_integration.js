@@ -78,7 +78,7 @@ function start(client) {
       console.log('======================================================================');
 
       // Envia pro Flask
-      const payload = { phone, content, name };
+      const payload = { phone, content, name, message_id: message.id, timestamp: message.timestamp };
 
       const response = await fetch(FLASK_URL, {
         method: 'POST',